@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+##################################################################
+#
+# Title: bench_startup.py
+# Description: Measure the import time of each poltype dependency
+#               and the startup time of poltype itself
+#
+# Poltype is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Poltype is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+##################################################################
+
+import os
+import sys
+import time
+import getopt
+import subprocess
+
+# Dependencies in the order poltype loads them. The first group is imported when
+# poltype starts; the second only when torsions are fitted and plotted.
+STARTUP_MODULES = ['numpy', 'openbabel', 'valence', 'qmcache', 'symmcache', 'tinkerkey', 'procrunner']
+LAZY_MODULES = ['scipy.optimize', 'scipy.sparse.linalg', 'matplotlib.pyplot']
+
+def time_import(python, module, repeat):
+    """
+    Intent: Time 'import module' in 'repeat' fresh interpreters
+    Input:
+        python: python executable
+        module: module name
+        repeat: number of runs
+    Output:
+        list of import times in seconds, or None if the module cannot be imported
+    Description:
+    Each run starts a new interpreter, so nothing is cached in the process. Modules
+    that this one imports (e.g. numpy for matplotlib) are counted in its time.
+    """
+    code = ("import sys, time\n"
+            "sys.path.insert(0, %r)\n"
+            "start = time.time()\n"
+            "import %s\n"
+            "print(time.time() - start)\n") % (os.path.dirname(os.path.abspath(__file__)), module)
+    if module == 'matplotlib.pyplot':
+        code = code.replace("import %s\n" % module,
+                            "import matplotlib\nmatplotlib.use('Agg')\nimport %s\n" % module)
+    times = []
+    for i in range(repeat):
+        proc = subprocess.Popen([python, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            return None
+        times.append(float(out.decode().split()[-1]))
+    return times
+
+def time_command(cmd, repeat):
+    """
+    Intent: Time the command 'cmd' (a list of arguments) over 'repeat' runs
+    Output:
+        list of wall times in seconds, or None if the command ends with a traceback
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        times.append(time.time() - start)
+        if b'Traceback' in err:
+            return None
+    return times
+
+def report(label, times):
+    if times is None:
+        print('%-24s %10s' % (label, 'failed'))
+    else:
+        times = sorted(times)
+        print('%-24s %10.3f %10.3f' % (label, times[0], times[len(times) // 2]))
+
+def usage():
+    print('''bench_startup.py:
+    -h, --help      -- displays this help message
+    -n, --repeat    -- number of runs of each measurement (default 5)
+    --python        -- python executable to measure (default: this one)
+    --poltype       -- poltype script whose startup is timed with --help
+                       (default poltype_dft.py next to this script)''')
+
+def main():
+    try:
+        opts, xargs = getopt.getopt(sys.argv[1:], 'hn:', ["help", "repeat=", "python=", "poltype="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    repeat = 5
+    python = sys.executable
+    poltype = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poltype_dft.py')
+    for o, a in opts:
+        if o in ("-n", "--repeat"):
+            repeat = int(a)
+        elif o in ("--python"):
+            python = a
+        elif o in ("--poltype"):
+            poltype = a
+        elif o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+
+    print('%-24s %10s %10s' % ('seconds', 'min', 'median'))
+    report('python startup', time_command([python, '-c', 'pass'], repeat))
+    print('imported when poltype starts:')
+    for module in STARTUP_MODULES:
+        report(module, time_import(python, module, repeat))
+    print('only loaded when fitting or plotting torsions:')
+    for module in LAZY_MODULES:
+        report(module, time_import(python, module, repeat))
+    print('')
+    # --help parses the options and exits after all startup imports are done
+    report(os.path.basename(poltype) + ' --help', time_command([python, poltype, '--help'], repeat))
+
+if __name__ == '__main__':
+    main()
@@ -42,10 +42,6 @@ from socket import gethostname
 from math import *
 
 import numpy
-from scipy import optimize
-import matplotlib
-matplotlib.use('Agg')
-import pylab as plt
 import openbabel
 import valence
 
@@ -347,6 +343,19 @@ def print_error(errstrarr,kill=None):
         else:
             sys.exit(255)
 
+def import_pyplot():
+    """
+    Intent: Import matplotlib (with the non-interactive Agg backend) for plotting
+    Referenced By: fit_rot_bond_tors, eval_rot_bond_parms
+    Description:
+    matplotlib is only imported when the first plot is made, so that runs that do not
+    fit torsions (e.g. --qmonly, --omit-torsion) do not pay for loading it.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
 def write_arr_to_file(fname, array_list):
     """
     Intent: Write out information in array to file
@@ -1857,6 +1866,27 @@ def find_tor_restraint_idx(mol,b1,b2):
 
     return t1,t4
 
+def find_missed_torsions(mol):
+    """
+    Intent: Find the torsions that have no parameters in the look up table (valence.py)
+    Input:
+        mol: An openbabel molecule structure
+    Output:
+        missed_torsions: set of (a,b,c,d) atom index tuples, as returned by Valence.get_mt
+    Referenced By: get_torlist
+    Description:
+    Runs the torsion SMARTS search of Valence.torguess once for the whole molecule, with
+    every atom as its own class, so that rotatable bonds can be looked up in the result
+    """
+    v1 = valence.Valence(output_format)
+    idxtoclass = []
+    for i in range(mol.NumAtoms()):
+        idxtoclass.append(i+1)
+    v1.setidxtoclass(idxtoclass)
+    # dorot is set as false in valence.py
+    v1.torguess(mol,False,[])
+    return set(tuple(tor) for tor in v1.get_mt())
+
 def get_torlist(mol):
     """
     Intent: Find unique rotatable bonds.
@@ -1873,13 +1903,15 @@ def get_torlist(mol):
         a. Check 'IsRotor()' (is the bond rotatable?)
         b. Find the atoms 1 and 4 (of the highest possible sym_class) of a possible torsion about atoms t2 and t3 of the rotatable bond (calls find_tor_restraint_idx)
         c. Check if this torsion is in user provided toromitlist
-        d. Check if this torsion is found in the look up table
+        d. Check if this torsion is found in the look up table (the torsions that are not
+           are found once for the whole molecule by find_missed_torsions)
         e. If it neither c nor d are true, then append this torsion to 'rotbndlist' for future torsion scanning
         f. Find other possible torsions around the bond t2-t3 and repeat steps c through e
     """
 
     torlist = []
     rotbndlist = {}
+    missed_torsions = find_missed_torsions(mol)
 
     iterbond = openbabel.OBMolBondIter(mol)
     for bond in iterbond:
@@ -1895,15 +1927,7 @@ def get_torlist(mol):
 
             #Check to see if the torsion was found in the look up table or not
             #This decides whether it needs to be scanned for or not
-            v1 = valence.Valence(output_format)
-            idxtoclass = []
-            for i in range(mol.NumAtoms()):
-                idxtoclass.append(i+1)
-            v1.setidxtoclass(idxtoclass)
-            # dorot is set as false in valence.py
-            v1.torguess(mol,False,[])
-            missed_torsions = v1.get_mt()
-            if(not sorttorsion([t1.GetIdx(),t2.GetIdx(),t3.GetIdx(),t4.GetIdx()]) in missed_torsions):
+            if(not tuple(sorttorsion([t1.GetIdx(),t2.GetIdx(),t3.GetIdx(),t4.GetIdx()])) in missed_torsions):
                 skiptorsion = True
 
             rotbndkey = '%d %d' % (t2.GetIdx(), t3.GetIdx())
@@ -2994,6 +3018,8 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
         p. write out a plot of the fit
         q. write out the parameter estimates
     """
+    from scipy import optimize
+    plt = import_pyplot()
     fitfunc_dict = {}
     write_prm_dict = {}
     # For each rotatable bond 
@@ -3212,6 +3238,7 @@ def eval_rot_bond_parms(mol,anglelist,fitfunc_dict,tmpkey1basename,tmpkey2basena
         b. Plot the profiles
     """
     global mm_tor_count
+    plt = import_pyplot()
     # for each main torsion
     for tor in torlist:
         a,b,c,d = tor[0:4]
@@ -32,22 +32,28 @@ import string
 from collections import deque
 from types import *
 import re
+import shlex
 import getopt
 import tempfile
 import shutil
 import pprint
-import subprocess
 import inspect
+import functools
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.connection
+from concurrent import futures
 from socket import gethostname
 from math import *
 
 import numpy
-from scipy import optimize
-import matplotlib
-matplotlib.use('Agg')
-import pylab as plt
 import openbabel
 import valence
+import qmcache
+import symmcache
+import tinkerkey
+import procrunner
 
 # Implementation Notes
 # 1) Minimize Structure
@@ -56,97 +62,302 @@ import valence
 # 4) Run poledit (to extract atom types)  DONE (electrostatic-param.pl)
 # 4) Run avgmpoles.pl
 
-# Default starting index of atom type
-prmstartidx = 401
-
-# These values can be edited. Affect speed of QM calculations.
-numproc = 24
-maxmem = "55GB"
-maxdisk = "100GB"
-
 # Initilize directories
-gausdir = None
-gdmadir = None
-tinkerdir = None
-scratchdir = "/scratch/sdujk/maxscheurer/poltype"
 paramfname = sys.path[0] + "/amoeba_v2_new.prm"
-paramhead = sys.path[0] + "/amoeba_v2_new_head.prm"
 obdatadir = sys.path[0] + "/datadir"
 amoeba_conv_spec_fname = "amoeba_t5_t4.txt"
 
 # Initilize executables
 babelexe = "babel"
-gausexe =  "g09"
-formchkexe =  "formchk"
-cubegenexe =  "cubegen"
-gdmaexe = "gdma"
 eleparmexe = sys.path[0] + "/electrostatic-param.pl"
 groupsymexe = sys.path[0] + "/groupsym.exe"
 avgmpolesexe = sys.path[0] + "/avgmpoles.pl"
-peditexe = "poledit"
-potentialexe = "potential"
-valenceexe = "valence"
-minimizeexe = "minimize"
-analyzeexe = "analyze"
-superposeexe = "superpose"
-#peditexe = "poledit"
-#potentialexe = "potential"
-#valenceexe = "valence"
-#minimizeexe = "minimize"
-#analyzeexe = "analyze"
-#superposeexe = "superpose"
 
 # Initialize constants, basis sets
 defopbendval = 0.20016677990819662
 Hartree2kcal_mol = 627.5095
-optbasisset = "6-31G*"
-dmabasisset = "6-311G**"
-popbasisset = "6-31G*"
-espbasisset = "6-311++G(2d,2p)"
-m06lbasisset = "6-31G*"
 
 # Initialize some global variables such as arrays and booleans
-qmonly = False
-espfit = True
-parmtors = True
-uniqidx = False
-torkeyfname = None
 nfoldlist = list(range(1,4))
 foldoffsetlist = [ 0.0, 180.0, 0.0, 0.0, 0.0, 0.0 ]
-torlist = []
-rotbndlist = []
-mm_tor_count = 1
-output_format = 5
-toromit_list = []
-omittorsion2 = False
-do_tor_qm_opt = False
+# Relative size of the DMA and ESP single points, used to split numproc/maxmem
+# between them when they run at the same time
+dmajobweight = 1.0
+espjobweight = 2.0
+# Dihedral angles of torsions equivalent by symmetry differ by at most this (degrees)
+torduptol = 5.0
+# 'torsionunit' of parameter files, read once per process (see get_prm_torsionunit)
+prmtorsionunits = {}
+# Options that select the batch, worker or submit mode; not passed on to the molecules
+batchoptions = ("--batch", "--batch-dir", "--batch-cores", "--batch-mem", "--worker", "--submit")
+# Seconds a worker waits before looking at an empty job queue again
+workerpoll = 2.0
+
+class Session:
+    """
+    Intent: Options, file names and results of the parameterization of one molecule
+    Input:
+        workdir: directory in which the molecule is run (default: current directory)
+    Description:
+    Every stage of the pipeline takes the session as its first argument, so several
+    molecules can be run in one process, one after the other or at the same time.
+    The process working directory is never changed: relative file names are taken
+    from 'cwd' (see 'path'), which starts at 'workdir' and is moved to subdirectories
+    with 'chdir'. External programs are run in 'cwd'.
+    """
+    def __init__(self, workdir=None):
+        if workdir is None:
+            workdir = os.getcwd()
+        self.workdir = os.path.abspath(workdir)
+        self.cwd = self.workdir
+
+        # Default starting index of atom type
+        self.prmstartidx = 401
+
+        # These values can be edited. Affect speed of QM calculations.
+        self.numproc = 24
+        self.maxmem = "55GB"
+        self.maxdisk = "100GB"
+
+        # Initilize directories
+        self.gausdir = None
+        self.scratchdir = "/scratch/sdujk/maxscheurer/poltype"
+        self.tinkerdir = None
+        self.paramhead = sys.path[0] + "/amoeba_v2_new_head.prm"
+
+        # Initilize executables
+        self.gausexe =  "g09"
+        self.formchkexe =  "formchk"
+        self.cubegenexe =  "cubegen"
+        self.gdmaexe = "gdma"
+        self.peditexe = "poledit"
+        self.potentialexe = "potential"
+        self.valenceexe = "valence"
+        self.minimizeexe = "minimize"
+        self.analyzeexe = "analyze"
+        self.superposeexe = "superpose"
+
+        # Basis sets
+        self.optbasisset = "6-31G*"
+        self.dmabasisset = "6-311G**"
+        self.popbasisset = "6-31G*"
+        self.espbasisset = "6-311++G(2d,2p)"
+        self.m06lbasisset = "6-31G*"
+
+        # Options
+        self.qmonly = False
+        self.espfit = True
+        self.parmtors = True
+        self.uniqidx = False
+        self.torkeyfname = None
+        self.output_format = 5
+        self.omittorsion2 = False
+        self.do_tor_qm_opt = False
+        # Number of QM jobs (e.g. torsion scan points) allowed to run at the same time
+        self.maxqmjobs = 1
+        # Persistent QM result cache (off unless a directory is given)
+        self.qmcachedir = None
+        self.qmcachesize = "50GB"
+        self.qmresultcache = None
+        self.symmcache = None
+        # Evaluate all conformers of a torsion scan with a single tinker analyze run
+        self.mmbatchanalyze = False
+        # Find the post-fit MM profiles with tinker analyze instead of in-process
+        # (see postfit_mm_tor_energy)
+        self.mmpostfitanalyze = False
+        # Torsion scan grid (degrees). With 'torscanadaptive', the scan starts on a
+        # 'torscancoarsestep' grid and points are added down to 'torscanstep' where the
+        # QM profile is not smooth (see refine_tor_phases)
+        self.torscanstep = 30
+        self.torscanadaptive = False
+        self.torscancoarsestep = 60
+        self.torrefinetol = 0.5
+        self.torrefinecurv = 10.0
+        # Scan only one of the torsions in torlist that are equivalent by symmetry: same
+        # class key and optimized dihedral angles within 'torduptol' degrees
+        self.tordedup = True
+        # Fit the torsion parameters of all rotatable bonds in one least squares system
+        self.globaltorfit = False
+        # Seconds after which an external program is killed (no limit if None)
+        self.jobtimeout = None
+        # Batch mode: manifest of structure files, directory for the per-molecule working
+        # directories, and total cores and memory the molecules may share (default: this machine)
+        self.batchfname = None
+        self.batchdir = "."
+        self.batchcores = None
+        self.batchmem = None
+        # Spool directory of the job queue to work on (--worker) or to add a job to (--submit)
+        self.workerdir = None
+        self.submitdir = None
+
+        # Torsion fit plots: 'on', 'off' or 'deferred' (made at the end, see plot_profiles)
+        self.plotmode = "on"
+        self.plotjobs = []
+
+        # File names, given as options or else set by init_filenames and run_gaussian
+        self.molstructfname = None
+        self.molecprefix = None
+        self.logfname = None
+        self.chkname = None
+        self.fname = None
+        self.gausfname = None
+        self.gausoptfname = None
+        self.gdmafname = None
+        self.keyfname = None
+        self.xyzfname = None
+        self.peditinfile = None
+        self.valinfile = None
+        self.superposeinfile = None
+        self.espgrdfname = None
+        self.qmespfname = None
+        self.qmesp2fname = None
+        self.grpfname = None
+        self.key2fname = None
+        self.key3fname = None
+        self.key4fname = None
+        self.key5fname = None
+        self.xyzoutfile = None
+        self.valoutfname = None
+        self.scrtmpdir = None
+        self.tmpxyzfile = None
+        self.tmpkeyfile = None
+        self.comfname = None
+        self.comoptfname = None
+        self.chkoptfname = None
+        self.fckoptfname = None
+        self.logoptfname = None
+        self.compopfname = None
+        self.chkpopfname = None
+        self.fckpopfname = None
+        self.logpopfname = None
+        self.comdmafname = None
+        self.chkdmafname = None
+        self.fckdmafname = None
+        self.logdmafname = None
+        self.comespfname = None
+        self.chkespfname = None
+        self.fckespfname = None
+        self.logespfname = None
+
+        # log file object
+        self.logfh = None
+        # Serializes writes to 'logfh' from commands that run at the same time
+        self.logfhlock = threading.Lock()
+        # the OBMol object
+        self.mol = None
+        # An array that maps atom ids to the symmetry class they belong to
+        self.symmetryclass = []
+        self.canonicallabel = []
+        self.localframe1 = []
+        self.localframe2 = []
+        self.torlist = []
+        self.rotbndlist = []
+        self.mm_tor_count = 1
+        self.toromit_list = []
+        # Torsions that are scanned and fitted (torlist without duplicates, see dedup_torlist)
+        self.scantorlist = []
+        # Phase angles scanned for each torsion in scantorlist, filled in by gen_torsion
+        self.torphasedict = {}
+
+    def path(self, fname):
+        """
+        Intent: Return the absolute path of 'fname', taken relative to 'cwd'
+        """
+        return os.path.join(self.cwd, fname)
+
+    def chdir(self, dirname):
+        """
+        Intent: Move the session's current directory to 'dirname' (relative to 'cwd')
+        """
+        self.cwd = os.path.normpath(self.path(dirname))
 
 # Poltype begins with the 'main' method which is found towards the bottom of the program
 
-def call_subsystem(cmdstr, iscritical=False):
+def call_subsystem(session, cmdstr, iscritical=False, env=None, timeout=None):
     """
     Intent: Run 'cmdstr' on the command line
     Input:
         cmdstr: command string to be run on command line
+        iscritical: exit poltype if the command fails
+        env: extra environment variables for the command
+        timeout: seconds after which the command is killed (default 'jobtimeout')
     Output:
-    Description: -
+        exit code of the command
+    Description:
+    The command is run by 'procrunner.run_process'. Its output is captured and written
+    to the log file in one piece when it finishes, so commands run from several
+    threads at once do not interleave their output.
+    """
+    if timeout is None:
+        timeout = session.jobtimeout
+    job = procrunner.ProcessJob(cmdstr, cwd=session.cwd, env=env, timeout=timeout)
+    log_call_start(session, job)
+    result = procrunner.run_process(job)
+    log_call_result(session, job, result)
+    if result.returncode != 0 and iscritical:
+        sys.exit(1)
+    return result.returncode
+
+def call_subsystems(session, cmdstrs, maxjobs=1, iscritical=False, env=None, timeout=None, logoutput=True):
+    """
+    Intent: Run all commands in 'cmdstrs', at most 'maxjobs' at a time
+    Input:
+        cmdstrs: list of command strings
+        maxjobs: number of commands run at the same time
+        iscritical: exit poltype if any command fails
+        env: extra environment variables for the commands
+        timeout: seconds after which a command is killed (default 'jobtimeout')
+        logoutput: write the output of each command to the log file
+    Output:
+        results: list of procrunner.ProcessResult, in the order of 'cmdstrs'
+    Referenced By: compute_mm_tor_energy, main
+    """
+    if timeout is None:
+        timeout = session.jobtimeout
+    jobs = [procrunner.ProcessJob(cmdstr, cwd=session.cwd, env=env, timeout=timeout)
+            for cmdstr in cmdstrs]
+    for job in jobs:
+        log_call_start(session, job)
+    callback = functools.partial(log_call_result, session, logoutput=logoutput)
+    results = procrunner.run_processes(jobs, maxjobs, callback)
+    if iscritical and any(result.returncode != 0 for result in results):
+        sys.exit(1)
+    return results
+
+def log_call_start(session, job):
+    """
+    Intent: Note in the log file that 'job' is about to run
+    Referenced By: call_subsystem, call_subsystems
     """
     now = time.strftime("%c",time.localtime())
-    logfh.write(now + " Calling: " + cmdstr + "\n")
-    logfh.flush()
     print(now)
-    os.fsync(logfh.fileno())
-    p = subprocess.Popen(cmdstr, shell=True,
-       stdout=logfh, stderr=logfh)
-    if p.wait() != 0:
-        now = time.strftime("%c",time.localtime())
-        print(cmdstr)
-        logfh.write(now + " ERROR: " + cmdstr + "\n")
-        logfh.flush()
-        os.fsync(logfh.fileno())
-        if iscritical:
-            sys.exit(1)
-    return p.wait()
+    with session.logfhlock:
+        session.logfh.write(now + " Calling: " + job.cmdstr() + "\n")
+        session.logfh.flush()
+
+def log_call_result(session, job, result, logoutput=True):
+    """
+    Intent: Write the output, exit code, wall time and peak memory of a finished 'job'
+    to the log file
+    Referenced By: call_subsystem, call_subsystems
+    """
+    now = time.strftime("%c",time.localtime())
+    lines = []
+    if logoutput and result.output:
+        lines.append(result.output)
+        if not result.output.endswith("\n"):
+            lines.append("\n")
+    if result.timedout:
+        lines.append("%s ERROR: killed after %s s: %s\n" % (now, job.timeout, result.cmd))
+    elif result.returncode != 0:
+        lines.append(now + " ERROR: " + result.cmd + "\n")
+    lines.append("%s Finished: %s (exit %d, %.1f s, %.0f MB peak)\n" %
+        (now, result.cmd, result.returncode, result.walltime, result.maxrss / 1024.0))
+    if result.returncode != 0:
+        print(result.cmd)
+    with session.logfhlock:
+        session.logfh.write(''.join(lines))
+        session.logfh.flush()
 
 def which(program,pathlist=os.environ["PATH"]):
     """
@@ -174,12 +385,62 @@ def which(program,pathlist=os.environ["PATH"]):
                 return exe_file
     return None
 
+def run_job_graph(jobs, maxjobs=1):
+    """
+    Intent: Run a set of jobs that may depend on each other, at most 'maxjobs' at a time
+    Input:
+        jobs: list of (jobkey, depkeys, func, args) tuples. A job is started once all of the
+              jobs in 'depkeys' have finished; it is called as func(*args, *depresults)
+              where depresults are the return values of the jobs in 'depkeys'
+        maxjobs: maximum number of jobs running at the same time
+    Output:
+        results: dict mapping jobkey to the return value of that job
+    Referenced By: gen_torsion, run_gaussian
+    Description:
+    1. If only one job may run at a time, run the jobs in the order given
+       (the list must then already be in dependency order)
+    2. Otherwise, submit every job whose dependencies are done to a thread pool and
+       wait for any running job to finish before submitting more
+    3. If a job fails, jobs that have not started yet are cancelled and the error is raised
+    """
+    results = {}
+    if maxjobs <= 1:
+        for (jobkey, depkeys, func, args) in jobs:
+            depresults = [results[dk] for dk in depkeys]
+            results[jobkey] = func(*(tuple(args) + tuple(depresults)))
+        return results
+
+    pending = list(jobs)
+    running = {}
+    with futures.ThreadPoolExecutor(max_workers=maxjobs) as executor:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= maxjobs:
+                    break
+                (jobkey, depkeys, func, args) = job
+                if all(dk in results for dk in depkeys):
+                    depresults = [results[dk] for dk in depkeys]
+                    fut = executor.submit(func, *(tuple(args) + tuple(depresults)))
+                    running[fut] = jobkey
+                    pending.remove(job)
+            assert running, "Error: job graph has unmet or circular dependencies"
+            done, notdone = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for fut in done:
+                jobkey = running.pop(fut)
+                try:
+                    results[jobkey] = fut.result()
+                except BaseException:
+                    for notdonefut in notdone:
+                        notdonefut.cancel()
+                    raise
+    return results
+
 def rotate_list(l1):
     deq = deque(l1)
     deq.rotate(-1)
     return list(deq)
 
-def parse_options(argv):
+def parse_options(session, argv):
     """
     Intent: Set up variables based on arguments supplied by user
     Input:
@@ -188,50 +449,8 @@ def parse_options(argv):
     Referenced By: main
     Description:
     """
-    global molecprefix
-    global qmonly
-    global molstructfname
-    global chkname
-    global fname
-    global gausfname
-    global gausoptfname
-    global gdmafname
-    global comfname
-    global prmstartidx
-    global numproc
-    global maxmem
-    global maxdisk
-#   global gausdir
-    global espfit
-    global parmtors
-    global uniqidx
-    global torkeyfname
-    global optbasisset
-    global dmabasisset
-    global popbasisset
-    global espbasisset
-    global comoptfname
-    global chkoptfname
-    global fckoptfname
-    global logoptfname
-    global compopfname
-    global chkpopfname
-    global fckpopfname
-    global logpopfname
-    global comdmafname
-    global chkdmafname
-    global fckdmafname
-    global logdmafname
-    global comespfname
-    global chkespfname
-    global fckespfname
-    global logespfname
-    global output_format
-    global paramhead
-    global omittorsion2
-    global do_tor_qm_opt
     try:
-        opts, xargs = getopt.getopt(argv[1:],'hqn:m:M:a:s:p:d:u:',["help","qmonly","optbasisset=","dmabasisset=","popbasisset=","espbasisset=","m06lbasisset=","optlog=","dmalog=","esplog=","dmafck=","espfck=","numproc=","maxmem=","maxdisk=","atmidx=","structure=","prefix=","gdmaout=","gbindir=","qm-scratch-dir=","omit-espfit","omit-torsion","test-tor-key=","uniqidx","tinker4format","omit-torsion2","do-tor-qm-opt"])
+        opts, xargs = getopt.getopt(argv[1:],'hqn:m:M:a:s:p:d:u:',["help","qmonly","optbasisset=","dmabasisset=","popbasisset=","espbasisset=","m06lbasisset=","optlog=","dmalog=","esplog=","dmafck=","espfck=","numproc=","maxmem=","maxdisk=","atmidx=","structure=","prefix=","gdmaout=","gbindir=","qm-scratch-dir=","omit-espfit","omit-torsion","test-tor-key=","uniqidx","tinker4format","omit-torsion2","do-tor-qm-opt","max-qm-jobs=","qm-cache-dir=","qm-cache-size=","job-timeout=","mm-batch-analyze","mm-postfit-analyze","global-tor-fit","tor-scan-step=","tor-scan-adaptive","tor-scan-coarse-step=","tor-refine-tol=","tor-refine-curv=","no-tor-dedup","batch=","batch-dir=","batch-cores=","batch-mem=","worker=","submit=","plots="])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -239,59 +458,100 @@ def parse_options(argv):
 
     for o, a in opts:
         if o in ("-s", "--structure"):
-            molstructfname = a
+            session.molstructfname = a
         elif o in ("-n", "--numproc"):
-            numproc = a
+            session.numproc = a
         elif o in ("-m", "--maxmem"):
-            maxmem = a
+            session.maxmem = a
         elif o in ("-M", "--maxdisk"):
-            maxdisk = a
+            session.maxdisk = a
         elif o in ("-a", "--atmidx"):
-            prmstartidx = int(a)
+            session.prmstartidx = int(a)
         elif o in ("--optbasisset"):
-            optbasisset = a
+            session.optbasisset = a
         elif o in ("--dmabasisset"):
-            dmabasisset = a
+            session.dmabasisset = a
         elif o in ("--popbasisset"):
-            popbasisset = a
+            session.popbasisset = a
         elif o in ("--espbasisset"):
-            espbasisset = a
+            session.espbasisset = a
         elif o in ("--m06lbasisset"):
-            m06lbasisset = a
+            session.m06lbasisset = a
         elif o in ("--optlog"):
-            logoptfname = a
+            session.logoptfname = a
         elif o in ("--dmalog"):
-            logdmafname = a
+            session.logdmafname = a
         elif o in ("--esplog"):
-            logespfname = a
+            session.logespfname = a
         elif o in ("--dmafck"):
-            fckdmafname = a
+            session.fckdmafname = a
         elif o in ("--espfck"):
-            fckespfname = a
+            session.fckespfname = a
         elif o in ("--dmachk"):
-            chkdmafname = a
+            session.chkdmafname = a
         elif o in ("--espchk"):
-            chkespfname = a
+            session.chkespfname = a
         elif o in ("-f", "--formchk"):
-            fname = a
+            session.fname = a
         elif o in ("-d", "--gdmaout"):
-            gdmafname = a
+            session.gdmafname = a
         elif o in ("-u", "--gbindir"):
-            gausdir = a
+            session.gausdir = a
         elif o in ("-q", "--qmonly"):
-            qmonly = True
+            session.qmonly = True
         elif o in ("--omit-espfit"):
-            espfit = False
+            session.espfit = False
         elif o in ("--omit-torsion"):
-            parmtors = False
+            session.parmtors = False
         elif o in ("--omit-torsion2"):
-            omittorsion2 = True
+            session.omittorsion2 = True
         elif o in ("--do-tor-qm-opt"):
-            do_tor_qm_opt = True
+            session.do_tor_qm_opt = True
+        elif o in ("--max-qm-jobs"):
+            session.maxqmjobs = int(a)
+        elif o in ("--qm-cache-dir"):
+            session.qmcachedir = a
+        elif o in ("--qm-cache-size"):
+            session.qmcachesize = a
+        elif o in ("--job-timeout"):
+            session.jobtimeout = float(a)
+        elif o in ("--mm-batch-analyze"):
+            session.mmbatchanalyze = True
+        elif o in ("--mm-postfit-analyze"):
+            session.mmpostfitanalyze = True
+        elif o in ("--global-tor-fit"):
+            session.globaltorfit = True
+        elif o in ("--tor-scan-step"):
+            session.torscanstep = int(a)
+        elif o in ("--tor-scan-adaptive"):
+            session.torscanadaptive = True
+        elif o in ("--tor-scan-coarse-step"):
+            session.torscancoarsestep = int(a)
+        elif o in ("--tor-refine-tol"):
+            session.torrefinetol = float(a)
+        elif o in ("--tor-refine-curv"):
+            session.torrefinecurv = float(a)
+        elif o in ("--no-tor-dedup"):
+            session.tordedup = False
+        elif o in ("--batch"):
+            session.batchfname = a
+        elif o in ("--batch-dir"):
+            session.batchdir = a
+        elif o in ("--batch-cores"):
+            session.batchcores = int(a)
+        elif o in ("--batch-mem"):
+            session.batchmem = a
+        elif o in ("--worker"):
+            session.workerdir = a
+        elif o in ("--submit"):
+            session.submitdir = a
+        elif o in ("--plots"):
+            assert a in ("on", "off", "deferred"), "Error: --plots must be on, off or deferred"
+            session.plotmode = a
         elif o in ("--test-tor-key"):
-            torkeyfname = a
+            session.torkeyfname = a
         elif o in ("--uniqidx"):
-            uniqidx = True
+            session.uniqidx = True
         elif o in ("-h", "--help"):
             usage()
             sys.exit(2)
@@ -299,12 +559,13 @@ def parse_options(argv):
             printversion()
             sys.exit(2)
         elif o in ("--tinker4format"):
-            output_format = 4 
-            paramhead = sys.path[0] + "/amoeba_v2_new_head_tinker_4.prm"
+            session.output_format = 4 
+            session.paramhead = sys.path[0] + "/amoeba_v2_new_head_tinker_4.prm"
         else:
             assert False, "unhandled option"
 
-        assert "molstructfname" in globals(), "Molecule structure file (-s) needs to be defined."
+    assert session.molstructfname is not None or session.batchfname is not None or \
+        session.workerdir is not None, "Molecule structure file (-s) needs to be defined."
 
 class PrettyFloat(float):
     def __repr__(self):
@@ -330,17 +591,17 @@ def dispvar(label, *vars):
         print(pretty_floats(var), end=' ')
     print("")
 
-def print_error(errstrarr,kill=None):
+def print_error(session, errstrarr,kill=None):
     now = time.strftime("%c",time.localtime())
     sys.stderr.write('ERROR (%s): ' % now)
-    logfh.write('ERROR (%s): ' % now)
+    session.logfh.write('ERROR (%s): ' % now)
     if isinstance(errstrarr, (list,tuple)):
         for errstr in errstrarr:
             sys.stderr.write(str(pretty_floats(errstr)) + '\n')
-            logfh.write(str(pretty_floats(errstr)) + '\n')
+            session.logfh.write(str(pretty_floats(errstr)) + '\n')
     else:
         sys.stderr.write(str(pretty_floats(errstrarr)) + '\n')
-        logfh.write(str(pretty_floats(errstrarr)) + '\n')
+        session.logfh.write(str(pretty_floats(errstrarr)) + '\n')
 
 
     if kill is not None:
@@ -349,6 +610,108 @@ def print_error(errstrarr,kill=None):
         else:
             sys.exit(255)
 
+def import_pyplot():
+    """
+    Intent: Import matplotlib (with the non-interactive Agg backend) for plotting
+    Referenced By: render_plot
+    Description:
+    matplotlib is only imported when the first plot is made, so that runs that do not
+    fit torsions (e.g. --qmonly, --omit-torsion) do not pay for loading it.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def plot_profiles(session, figfname, lines, legendloc=None, margins=None):
+    """
+    Intent: Plot energy profiles to the file 'figfname', as set by 'plotmode'
+    Input:
+        figfname: png file name
+        lines: list of (angles, energies, line format, label), one per profile
+        legendloc: 'loc' of the legend (default: matplotlib's choice)
+        margins: keyword arguments for Figure.subplots_adjust
+    Output:
+    Referenced By: fit_rot_bond_tors, fit_rot_bond_tors_global, eval_rot_bond_parms
+    Description:
+    'off': no plot is made. 'on': the plot is made right away. 'deferred': the plot is
+    added to 'plotjobs' and made by 'start_deferred_plots' at the end of the run.
+    """
+    if session.plotmode == 'off':
+        return
+    lines = [(list(x), list(y), fmt, label) for (x, y, fmt, label) in lines]
+    plot = (session.path(figfname), lines, legendloc, margins)
+    if session.plotmode == 'deferred':
+        session.plotjobs.append(plot)
+    else:
+        render_plot(plot)
+
+def render_plot(plot):
+    """
+    Intent: Make one plot from 'plot_profiles' and release its figure
+    Input:
+        plot: (png file name, lines, legendloc, margins), as in 'plot_profiles'
+    Output:
+        png file name
+    Referenced By: plot_profiles, start_deferred_plots, finish_deferred_plots
+    """
+    (figfname, lines, legendloc, margins) = plot
+    plt = import_pyplot()
+    fig = plt.figure()
+    if margins is not None:
+        fig.subplots_adjust(**margins)
+    ax = fig.add_subplot(111)
+    for (x, y, fmt, label) in lines:
+        ax.plot(x, y, fmt, label=label)
+    if legendloc is None:
+        ax.legend()
+    else:
+        ax.legend(loc=legendloc)
+    fig.savefig(figfname)
+    plt.close(fig)
+    return figfname
+
+def start_deferred_plots(session):
+    """
+    Intent: Start making the plots collected in 'plotjobs', in a pool of processes
+    Input:
+    Output:
+        pending: list of (plot, future) to pass to 'finish_deferred_plots'
+    Referenced By: run_poltype
+    Description:
+    The plots are made while the final tests of the parameters run. The worker
+    processes of a batch cannot start processes of their own; there the future is None
+    and the plot is made by 'finish_deferred_plots'.
+    """
+    plots = session.plotjobs
+    session.plotjobs = []
+    if not plots:
+        return []
+    if multiprocessing.current_process().daemon:
+        return [(plot, None) for plot in plots]
+    nworkers = max(1, min(len(plots), get_total_qm_resources(session)[0]))
+    executor = futures.ProcessPoolExecutor(nworkers, mp_context=multiprocessing.get_context('fork'))
+    pending = [(plot, executor.submit(render_plot, plot)) for plot in plots]
+    # the pool finishes the submitted plots and then exits
+    executor.shutdown(wait=False)
+    return pending
+
+def finish_deferred_plots(session, pending):
+    """
+    Intent: Wait for the plots started by 'start_deferred_plots'
+    Referenced By: run_poltype
+    Description:
+    A plot that cannot be made is noted in the log file; the parameters do not depend on it.
+    """
+    for (plot, future) in pending:
+        try:
+            if future is None:
+                render_plot(plot)
+            else:
+                future.result()
+        except Exception as err:
+            session.logfh.write("Cannot plot %s: %s\n" % (plot[0], err))
+
 def write_arr_to_file(fname, array_list):
     """
     Intent: Write out information in array to file
@@ -367,7 +730,7 @@ def write_arr_to_file(fname, array_list):
             outfh.write("%10.4f" % ele)
         outfh.write("\n")
 
-def initialize ():
+def initialize (session):
     """
     Intent: Initialize all paths to needed executables
     Input:
@@ -375,76 +738,73 @@ def initialize ():
     Referenced By: main
     Description: -
     """
-    global gausdir
-    global gausexe
-    global formchkexe
-    global cubegenexe
-    global tinkerdir
-    global peditexe
-    global potentialexe
-    global valenceexe
-    global minimizeexe
-    global analyzeexe
-    global superposeexe
-    global gdmaexe
-
-    if (gausdir is not None):
-        if which(os.path.join(gausdir,"g09")) is not None:
-            gausexe    = os.path.join(gausdir,"g09")
-            formchkexe = os.path.join(gausdir,formchkexe)
-            cubegenexe = os.path.join(gausdir,cubegenexe)
-        elif which(os.path.join(gausdir,"g03")) is not None:
-            gausexe    = os.path.join(gausdir,"g03")
-            formchkexe = os.path.join(gausdir,formchkexe)
-            cubegenexe = os.path.join(gausdir,cubegenexe)
+
+    if (session.gausdir is not None):
+        if which(os.path.join(session.gausdir,"g09")) is not None:
+            session.gausexe    = os.path.join(session.gausdir,"g09")
+            session.formchkexe = os.path.join(session.gausdir,session.formchkexe)
+            session.cubegenexe = os.path.join(session.gausdir,session.cubegenexe)
+        elif which(os.path.join(session.gausdir,"g03")) is not None:
+            session.gausexe    = os.path.join(session.gausdir,"g03")
+            session.formchkexe = os.path.join(session.gausdir,session.formchkexe)
+            session.cubegenexe = os.path.join(session.gausdir,session.cubegenexe)
         else:
-            print("ERROR: Invalid Gaussian directory: ", gausdir)
+            print("ERROR: Invalid Gaussian directory: ", session.gausdir)
             sys.exit(1)
     else:
         if which("g09") is not None:
-            gausexe    = "g09"
+            session.gausexe    = "g09"
         elif which("g03") is not None:
-            gausexe    = "g03"
+            session.gausexe    = "g03"
         else:
             print("ERROR: Cannot find Gaussian executable in $PATH. Please install Gaussian or specify Gaussian directory with --gbindir flag.")
             sys.exit(1)
 
     if ("TINKERDIR" in os.environ):
-        tinkerdir = os.environ["TINKERDIR"]
-        peditexe = os.path.join(tinkerdir,peditexe)
-        potentialexe = os.path.join(tinkerdir,potentialexe)
-        valenceexe = os.path.join(tinkerdir,valenceexe)
-        minimizeexe = os.path.join(tinkerdir,minimizeexe)
-        analyzeexe = os.path.join(tinkerdir,analyzeexe)
-        superposeexe = os.path.join(tinkerdir,superposeexe)
-
-    if (not which(analyzeexe)):
+        session.tinkerdir = os.environ["TINKERDIR"]
+        session.peditexe = os.path.join(session.tinkerdir,session.peditexe)
+        session.potentialexe = os.path.join(session.tinkerdir,session.potentialexe)
+        session.valenceexe = os.path.join(session.tinkerdir,session.valenceexe)
+        session.minimizeexe = os.path.join(session.tinkerdir,session.minimizeexe)
+        session.analyzeexe = os.path.join(session.tinkerdir,session.analyzeexe)
+        session.superposeexe = os.path.join(session.tinkerdir,session.superposeexe)
+
+    if (not which(session.analyzeexe)):
         print("ERROR: Cannot find TINKER analyze executable")
         sys.exit(2)
 
     if ("GDMADIR" in os.environ):
         gdmadir = os.environ["GDMADIR"]
-        gdmaexe = os.path.join(gdmadir,gdmaexe)
+        session.gdmaexe = os.path.join(gdmadir,session.gdmaexe)
 
-    if (not which(gdmaexe)):
+    if (not which(session.gdmaexe)):
         print("ERROR: Cannot find GDMA executable")
         sys.exit(2)
 
     if ("GAUSS_SCRDIR" in os.environ):
-        scratchdir = os.environ["GAUSS_SCRDIR"]
-        vfs = os.statvfs(scratchdir)
+        session.scratchdir = os.environ["GAUSS_SCRDIR"]
+        vfs = os.statvfs(session.scratchdir)
         gbfree = (vfs.f_bavail * vfs.f_frsize) / (1024*1024*1024)
-        if(float(maxdisk[:-2]) > gbfree):
+        if(float(session.maxdisk[:-2]) > gbfree):
             print("ERROR: maxdisk greater than free space in scratch directory")
             sys.exit(2)
 
-    if (not which(scratchdir)):
+    if (not which(session.scratchdir)):
         print("ERROR: Cannot find Gaussian scratch directory")
         sys.exit(2)
 
+    cachedir = session.qmcachedir
+    if cachedir is None and "POLTYPE_QMCACHE" in os.environ:
+        cachedir = os.environ["POLTYPE_QMCACHE"]
+    if cachedir is not None:
+        cachesize = mem_str_to_mb(session.qmcachesize) * 1024 * 1024
+        session.qmresultcache = qmcache.QMCache(session.path(cachedir), cachesize, session.gausexe)
+        session.symmcache = symmcache.SymmetryCache(session.path(cachedir),
+                                                    "openbabel " + openbabel.OBReleaseVersion())
+
     #os.putenv('BABEL_DATADIR',obdatadir)
 
-def init_filenames ():
+def init_filenames (session):
     """
     Intent: Initialize file names
     Input:
@@ -452,66 +812,39 @@ def init_filenames ():
     Referenced By: main
     Description: -
     """
-    global logfname
-    global molecprefix
-    global molstructfname
-    global chkname
-    global fname
-    global gausfname
-    global gausoptfname
-    global gdmafname
-    global keyfname
-    global xyzfname
-    global peditinfile
-    global valinfile
-    global superposeinfile
-    global espgrdfname
-    global qmespfname
-    global qmesp2fname
-    global grpfname
-    global key2fname
-    global key3fname
-    global key4fname
-    global key5fname
-    global xyzoutfile
-    global valoutfname
-    global scrtmpdir
-    global tmpxyzfile
-    global tmpkeyfile
-
-    molecprefix =  os.path.splitext(molstructfname)[0]
-    logfname = assign_filenames ( "logfname" , "-poltype.log")
-    chkname = assign_filenames ( "chkname" , ".chk")
-    fname = assign_filenames ( "fname" , ".fchk")
-    gausfname = assign_filenames ( "gausfname" , ".log")
-    gausoptfname = assign_filenames ( "gausoptfname" , "-opt.log")
-    gdmafname = assign_filenames ( "gdmafname" , ".gdmaout")
-    keyfname = assign_filenames ( "keyfname" , ".key")
-    xyzfname = assign_filenames ( "xyzfname" , ".xyz")
-    peditinfile = assign_filenames ( "peditinfile" , "-peditin.txt")
-    valinfile = assign_filenames ( "valinfile" , "-valin.txt")
-    superposeinfile = assign_filenames ( "superposeinfile" , "-superin.txt")
-    espgrdfname = assign_filenames ( "espgrdfname" , ".grid")
-    qmespfname = assign_filenames ( "qmespfname" , ".cube")
+
+    session.molecprefix =  os.path.splitext(session.molstructfname)[0]
+    session.logfname = assign_filenames (session,  "logfname" , "-poltype.log")
+    session.chkname = assign_filenames (session,  "chkname" , ".chk")
+    session.fname = assign_filenames (session,  "fname" , ".fchk")
+    session.gausfname = assign_filenames (session,  "gausfname" , ".log")
+    session.gausoptfname = assign_filenames (session,  "gausoptfname" , "-opt.log")
+    session.gdmafname = assign_filenames (session,  "gdmafname" , ".gdmaout")
+    session.keyfname = assign_filenames (session,  "keyfname" , ".key")
+    session.xyzfname = assign_filenames (session,  "xyzfname" , ".xyz")
+    session.peditinfile = assign_filenames (session,  "peditinfile" , "-peditin.txt")
+    session.valinfile = assign_filenames (session,  "valinfile" , "-valin.txt")
+    session.superposeinfile = assign_filenames (session,  "superposeinfile" , "-superin.txt")
+    session.espgrdfname = assign_filenames (session,  "espgrdfname" , ".grid")
+    session.qmespfname = assign_filenames (session,  "qmespfname" , ".cube")
     #qmesp2fname = assign_filenames ( "qmesp2fname" , ".cube_2")
-    qmesp2fname = assign_filenames ( "qmesp2fname" , ".pot")
-    grpfname = assign_filenames ( "grpfname" , "-groups.txt")
-    key2fname = assign_filenames ( "key2fname" , ".key_2")
-    key3fname = assign_filenames ( "key3fname" , ".key_3")
-    key4fname = assign_filenames ( "key4fname" , ".key_4")
-    key5fname = assign_filenames ( "key5fname" , ".key_5")
-    xyzoutfile = assign_filenames ( "xyzoutfile" , ".xyz_2")
-    valoutfname = assign_filenames ( "valoutfname" , "sp.valout")
-    scrtmpdir = scratchdir + '/Gau-' + molecprefix
-    tmpxyzfile = 'ttt.xyz'
-    tmpkeyfile = 'ttt.key'
-
-def assign_filenames (filename,suffix):
-    global molecprefix
-    if filename in globals():
-        return eval(filename)
+    session.qmesp2fname = assign_filenames (session,  "qmesp2fname" , ".pot")
+    session.grpfname = assign_filenames (session,  "grpfname" , "-groups.txt")
+    session.key2fname = assign_filenames (session,  "key2fname" , ".key_2")
+    session.key3fname = assign_filenames (session,  "key3fname" , ".key_3")
+    session.key4fname = assign_filenames (session,  "key4fname" , ".key_4")
+    session.key5fname = assign_filenames (session,  "key5fname" , ".key_5")
+    session.xyzoutfile = assign_filenames (session,  "xyzoutfile" , ".xyz_2")
+    session.valoutfname = assign_filenames (session,  "valoutfname" , "sp.valout")
+    session.scrtmpdir = session.scratchdir + '/Gau-' + session.molecprefix
+    session.tmpxyzfile = 'ttt.xyz'
+    session.tmpkeyfile = 'ttt.key'
+
+def assign_filenames (session, filename,suffix):
+    if getattr(session, filename, None) is not None:
+        return getattr(session, filename)
     else:
-        return molecprefix + suffix
+        return session.molecprefix + suffix
 
 def printversion ():
     print(os.path.basename(sys.argv[0]) + \
@@ -546,6 +879,47 @@ def usage ():
     --m06lbasisset
     --omit-espfit
     --omit-torsion
+    --max-qm-jobs   -- number of QM jobs run at the same time (default 1)
+    --qm-cache-dir  -- directory of the QM result cache shared between runs
+                       (default $POLTYPE_QMCACHE, cache off if neither is set);
+                       atom symmetry classes are cached there too
+    --qm-cache-size -- size limit of the QM result cache (default 50GB)
+    --job-timeout   -- seconds after which an external program is killed
+                       (default no limit)
+    --mm-batch-analyze -- evaluate the MM energies of a torsion scan with one
+                       tinker analyze run on a multi-frame archive
+    --mm-postfit-analyze -- run tinker analyze for the post-fit MM profiles
+                       instead of only re-evaluating the torsion terms
+    --global-tor-fit -- fit the torsion parameters of all rotatable bonds at once,
+                       sharing parameters between bonds with the same class keys
+    --tor-scan-step -- torsion scan step in degrees, must divide 180 (default 30)
+    --tor-scan-adaptive -- start the torsion scan on a coarse grid and add points
+                       only where the QM profile needs them
+    --tor-scan-coarse-step -- first grid of the adaptive scan, a multiple of the
+                       scan step (default 60)
+    --tor-refine-tol -- adaptive scan: largest allowed deviation (kcal/mol) of the
+                       QM profile from a fitted cosine series (default 0.5)
+    --tor-refine-curv -- adaptive scan: largest allowed curvature (kcal/mol/rad^2)
+                       of the QM profile (default 10.0)
+    --no-tor-dedup  -- scan every rotatable bond, also those equivalent by symmetry
+    --plots         -- plots of the torsion fits: on (default), off, or deferred (made
+                       in separate processes at the end of the run; the .txt data files
+                       are always written)
+    --batch         -- manifest of structure files, one per line, each optionally
+                       followed by poltype options for that molecule only; every
+                       molecule runs in its own directory, with the other options
+                       on the command line applied to all of them
+    --batch-dir     -- directory for the per-molecule directories (default .)
+    --batch-cores   -- cores shared by the molecules of a batch (default all); each
+                       molecule uses -n of them
+    --batch-mem     -- memory shared by the molecules of a batch (default all); each
+                       molecule uses -m of it
+    --worker        -- run as a worker on the job queue in this spool directory, until
+                       a file named 'stop' appears in it; --batch-cores and --batch-mem
+                       set how many jobs run at the same time, and the other options
+                       apply to every job
+    --submit        -- add the molecule -s, with the other options, to the job queue
+                       in this spool directory
     --version       -- displays version of script''')
 
 def load_structfile(structfname):
@@ -586,38 +960,38 @@ def rebuild_bonds(newmol, refmol):
 
     return True 
 
-def get_class_number(idx):
+def get_class_number(session, idx):
     """
     Intent: Given an atom idx, return the atom's class number
     """
-    maxidx =  max(symmetryclass)
-    return prmstartidx + (maxidx - symmetryclass[idx - 1])
+    maxidx =  max(session.symmetryclass)
+    return session.prmstartidx + (maxidx - session.symmetryclass[idx - 1])
 
-def get_class_key(a, b, c, d):
+def get_class_key(session, a, b, c, d):
     """
     Intent: Given a set of atom idx's, return the class key for the set (the class numbers of the atoms appended together)
     """
-    cla = get_class_number(a)
-    clb = get_class_number(b)
-    clc = get_class_number(c)
-    cld = get_class_number(d)
+    cla = get_class_number(session, a)
+    clb = get_class_number(session, b)
+    clc = get_class_number(session, c)
+    cld = get_class_number(session, d)
 
     if ((clb > clc) or (clb == clc and cla > cld)):
         return '%d %d %d %d' % (cld, clc, clb, cla)
     return '%d %d %d %d' % (cla, clb, clc, cld)
 
-def get_uniq_rotbnd(a, b, c, d):
+def get_uniq_rotbnd(session, a, b, c, d):
     """
     Intent: Return the atom idx's defining a rotatable bond in the order of the class key
     found by 'get_class_key'
     """
-    cla = get_class_number(a)
-    clb = get_class_number(b)
-    clc = get_class_number(c)
-    cld = get_class_number(d)
+    cla = get_class_number(session, a)
+    clb = get_class_number(session, b)
+    clc = get_class_number(session, c)
+    cld = get_class_number(session, d)
 
     tmpkey = '%d %d %d %d' % (cla,clb,clc,cld)
-    if (get_class_key(a,b,c,d) == tmpkey):
+    if (get_class_key(session, a,b,c,d) == tmpkey):
         return (a, b, c, d)
     return (d, c, b, a)
 
@@ -631,7 +1005,7 @@ def obatom2idx(obatoms):
         atmidxlist.append(obatm.GetIdx())
     return atmidxlist
 
-def save_structfile(molstruct, structfname):
+def save_structfile(session, molstruct, structfname):
     """
     Intent: Output the data in the OBMol structure to a file (such as *.xyz)
     Input:
@@ -642,16 +1016,17 @@ def save_structfile(molstruct, structfname):
     Referenced By: tor_opt_sp, compute_mm_tor_energy
     Description: -
     """
+    structfname = session.path(structfname)
     strctext = os.path.splitext(structfname)[1]
     tmpconv = openbabel.OBConversion()
     if strctext in '.xyz':
         tmpfh = open(structfname, "w")
-        maxidx =  max(symmetryclass)
+        maxidx =  max(session.symmetryclass)
         iteratom = openbabel.OBMolAtomIter(molstruct)
         etab = openbabel.OBElementTable()
         tmpfh.write('%6d   %s\n' % (molstruct.NumAtoms(), molstruct.GetTitle()))
         for ia in iteratom:
-            tmpfh.write( '%6d %2s %13.6f %11.6f %11.6f %5d' % (ia.GetIdx(), etab.GetSymbol(ia.GetAtomicNum()), ia.x(), ia.y(), ia.z(), prmstartidx + (maxidx - symmetryclass[ia.GetIdx() - 1])))
+            tmpfh.write( '%6d %2s %13.6f %11.6f %11.6f %5d' % (ia.GetIdx(), etab.GetSymbol(ia.GetAtomicNum()), ia.x(), ia.y(), ia.z(), session.prmstartidx + (maxidx - session.symmetryclass[ia.GetIdx() - 1])))
             iteratomatom = openbabel.OBAtomAtomIter(ia)
             neighbors = []
             for iaa in iteratomatom:
@@ -667,14 +1042,14 @@ def save_structfile(molstruct, structfname):
 
 def rads(degrees):
     """
-    Intent: Convert degrees to radians
+    Intent: Convert degrees to radians (a number, list or numpy array)
     """
-    if type(degrees) == ListType:
+    if isinstance(degrees, list):
         return [ deg * pi / 180 for deg in degrees ]
     else:
         return degrees * pi / 180
 
-def getCan(x):
+def getCan(session, x):
     """
     Intent: For a given atom, output it's canonical label if it exists
     Input: 
@@ -682,12 +1057,12 @@ def getCan(x):
     Output:
         canonical label if it exists, -1 if not
     """
-    if (str(type(mol.GetAtom(x))).find("OBAtom") >= 0):
-        return canonicallabel[x-1]
+    if (str(type(session.mol.GetAtom(x))).find("OBAtom") >= 0):
+        return session.canonicallabel[x-1]
     else:
         return -1
 
-def get_symm_class(x):
+def get_symm_class(session, x):
     """
     Intent: For a given atom, output it's symmetry class if it exists
     Input: 
@@ -695,29 +1070,23 @@ def get_symm_class(x):
     Output:
         symmetry class if it exists, -1 if not
     """
-    if (str(type(mol.GetAtom(x))).find("OBAtom") >= 0):
-        return symmetryclass[x-1]
+    if (str(type(session.mol.GetAtom(x))).find("OBAtom") >= 0):
+        return session.symmetryclass[x-1]
     else:
         return -1
 
-def prepend_keyfile(keyfilename):
+def prepend_keyfile(session, keyf):
     """
-    Intent: Adds a header to the key file given by 'keyfilename'
+    Intent: Adds a header to the key file 'keyf' (tinkerkey.KeyFile)
     """
-    tmpfname = keyfilename + "_tmp"
-    tmpfh = open(tmpfname, "w")
-    keyfh = open(keyfilename, "r")
-
-    tmpfh.write("parameters " + paramhead + "\n")
-    tmpfh.write("bondterm none\n")
-    tmpfh.write("angleterm none\n")
-    tmpfh.write("torsionterm none\n")
-    tmpfh.write("vdwterm none\n")
-    tmpfh.write("fix-monopole\n")
-    tmpfh.write("potential-offset 1.0\n\n")
-    for line in keyfh:
-        tmpfh.write(line)
-    shutil.move(tmpfname, keyfilename)
+    keyf.prepend(["parameters " + session.paramhead + "\n",
+                  "bondterm none\n",
+                  "angleterm none\n",
+                  "torsionterm none\n",
+                  "vdwterm none\n",
+                  "fix-monopole\n",
+                  "potential-offset 1.0\n",
+                  "\n"])
 
 def scale_multipoles (symmclass, mpolelines,scalelist):
     """
@@ -737,161 +1106,81 @@ def scale_multipoles (symmclass, mpolelines,scalelist):
         mpolelines[4] = '%46.5f %10.5f %10.5f\n' % tuple(qp3)
     return mpolelines
 
-def rm_esp_terms_keyfile(keyfilename):
+def rm_esp_terms_keyfile(session, keyf):
     """
     Intent: Remove unnecessary terms from the key file
+    Input:
+        keyf: tinkerkey.KeyFile written by the potential fitting
+    Output: 'keyf' is edited
+    Referenced By: main
+    Description:
+    1. Drop comments, 'fix' and 'potential-offset' lines and terms whose value is 'none'
+    2. Potential fitting appends a new multipole block for every atom type.
+    Each atom type keeps the place of its first multipole block and the values of
+    its last one.
     """
-    tmpfname = keyfilename + "_tmp"
-    cmdstr = "sed -e \'/\(.* none$\|^#\|^fix\|^potential-offset\)/d\' " +  keyfilename + " > " + tmpfname
-    call_subsystem(cmdstr)
-    shutil.move(tmpfname, keyfilename)
-    # Removes redundant multipole definitions created after potential fitting
-    keyfh = open(keyfilename)
-    lines = keyfh.readlines()
-    newlines = []
-    tmpfh = open(tmpfname, "w")
-    mpolelines = 0
-    for ln1 in range(len(lines)):
-        if mpolelines > 0:
-            mpolelines -= 1
-            continue
-        if 'multipole' in lines[ln1]:
-            nllen = len(newlines)
-            for ln2 in range(len(newlines)):
-                if len(lines[ln1].split()) <= 1 or len(lines[ln2].split()) <= 1:
-                    continue
-                if lines[ln1].split()[0] in newlines[ln2].split()[0] and \
-                lines[ln1].split()[0] in 'multipole' and \
-                lines[ln1].split()[1] in newlines[ln2].split()[1]:
-                    newlines[ln2] = lines[ln1]
-                    newlines[ln2+1] = lines[ln1+1]
-                    newlines[ln2+2] = lines[ln1+2]
-                    newlines[ln2+3] = lines[ln1+3]
-                    newlines[ln2+4] = lines[ln1+4]
-                    mpolelines = 4
-                    break
-            if mpolelines == 0:
-                newlines.append(lines[ln1])
-        else:
-            newlines.append(lines[ln1])
+    keyf.remove(lambda term: term.lines[0].rstrip("\n").endswith(" none") or
+                             term.lines[0].startswith(("#", "fix", "potential-offset")))
+    keyf.merge_duplicates("multipole")
 
-    for nline in newlines:
-        tmpfh.write(nline)
-    tmpfh.close()
-    keyfh.close()
-    shutil.move(tmpfname, keyfilename)
-
-def post_proc_localframes(keyfilename, lfzerox):
+def post_proc_localframes(session, keyf, lfzerox):
     """
     Intent: This method runs after the tinker tool Poledit has run and created an
     initial *.key file. The local frames for each multipole are "post processed". 
     Zeroed out x-components of the local frame are set back to their original values
     If certain multipole values were not zeroed out by poltype this method zeroes them out
     Input:
-       keyfilename: string containing file name of *.key file
+       keyf: tinkerkey.KeyFile of the *.key file
        lfzerox: array containing a boolean about whether the x-component of the local frame
                 for a given atom should be zeroed or not. Filled in method 'gen_peditin'.
                 'lfzerox' is true for atoms that are only bound to one other atom (valence = 1)
                 that have more than one possible choice for the x-component of their local frame
-    Output: *.key file is edited
+    Output: 'keyf' is edited
     Referenced By: main
     Description:
-    1. Move the original *.key file to *.keyb
-    2. Create new empty file *.key
-    3. Iterate through the lines of *.keyb. 
+    Iterate through the multipole terms of 'keyf'. 
         a. If poledit wrote out the local frame with an x-component missing or as 0
         Then rewrite it with the original x-component (lf2) found in gen_peditin
         b. If poledit did not zero out the local frame x-component for an atom but 
         lfzerox is true, zero out the necessary multipole components manually
-    4.  Write the edited multipole information to *.key 
-    """
-    # mv *.key to *.keyb
-    tmpfname = keyfilename + "b"
-    shutil.move(keyfilename, tmpfname)
-    keyfh = open(tmpfname)
-    lines = keyfh.readlines()
-    newlines = []
-    # open *.key which is currently empty
-    tmpfh = open(keyfilename, "w")
-    mpolelines = 0
-    # iterate over lines in the *.key file
-    for ln1 in range(len(lines)):
-        # skip over the lines containing multipole values
-        if mpolelines > 0:
-            mpolelines -= 1
-            continue
-        elif 'multipole' in lines[ln1]:
-            # Check what poledit wrote as localframe2
-            tmplst = lines[ln1].split()
-            if len(tmplst) == 5:
-                (keywd,atmidx,lf1,lf2,chg) = tmplst
-            elif len(tmplst) == 4:
-                (keywd,atmidx,lf1,chg) = tmplst
-                lf2 = '0'
-            
-            # If poledit set lf2 to 0, then replace it with the lf2 found in gen_peditin
-            if int(lf2) == 0:
-                lf2 = localframe2[int(atmidx) - 1]
-                lines[ln1] = '%s %5s %4s %4d %21s\n' % (keywd,
-                    atmidx, lf1, lf2, chg)
-            # manually zero out components of the multipole if they were not done by poledit
-            elif lfzerox[int(atmidx) - 1]:
-                tmpmp = list(map(float, lines[ln1+1].split()))
-                tmpmp[0] = 0.
-                lines[ln1+1] = '%46.5f %10.5f %10.5f\n' % tuple(tmpmp)
-                tmpmp = list(map(float, lines[ln1+4].split()))
-                tmpmp[0] = 0.
-                lines[ln1+4] = '%46.5f %10.5f %10.5f\n' % tuple(tmpmp)
-                
-            newlines.extend(lines[ln1:ln1+5])
-            mpolelines = 4
-        # append any lines unrelated to multipoles as is
-        else:
-            newlines.append(lines[ln1])
-
-    # write out the new lines to *.key
-    for nline in newlines:
-        tmpfh.write(nline)
-    tmpfh.close()
-    keyfh.close()
-
-def post_process_mpoles(keyfilename, scalelist):
     """
-    Intent: Iterate through multipoles in 'keyfilename' and scale them if necessary
+    for term in keyf.multipoles():
+        # Check what poledit wrote as localframe2
+        tmplst = term.fields
+        if len(tmplst) == 5:
+            (keywd,atmidx,lf1,lf2,chg) = tmplst
+        elif len(tmplst) == 4:
+            (keywd,atmidx,lf1,chg) = tmplst
+            lf2 = '0'
+
+        # If poledit set lf2 to 0, then replace it with the lf2 found in gen_peditin
+        if int(lf2) == 0:
+            lf2 = session.localframe2[int(atmidx) - 1]
+            term.lines[0] = '%s %5s %4s %4d %21s\n' % (keywd,
+                atmidx, lf1, lf2, chg)
+        # manually zero out components of the multipole if they were not done by poledit
+        # (lines 1 and 4 of the term are the dipole and the last quadrupole row)
+        elif lfzerox[int(atmidx) - 1]:
+            tmpmp = list(map(float, term.lines[1].split()))
+            tmpmp[0] = 0.
+            term.lines[1] = '%46.5f %10.5f %10.5f\n' % tuple(tmpmp)
+            tmpmp = list(map(float, term.lines[4].split()))
+            tmpmp[0] = 0.
+            term.lines[4] = '%46.5f %10.5f %10.5f\n' % tuple(tmpmp)
+
+def post_process_mpoles(keyf, scalelist):
+    """
+    Intent: Iterate through multipoles in 'keyf' and scale them if necessary
     Calls 'scale_multipoles'
     Input:
-        keyfilename: file name for key file
+        keyf: tinkerkey.KeyFile
         scalelist: structure containing scaling information. Found in process_types
-    Output: new *.key file
+    Output: 'keyf' is edited
     Referenced By: main
-    Description: 
-    1. Move old keyfile to tmpfname
-    2. open an empty key file
-    3. iterate through tmpfname scaling the multipoles if necessary
-    4. output new multipoles to the new key file
-    """
-    tmpfname = keyfilename + "b"
-    shutil.move(keyfilename, tmpfname)
-    keyfh = open(tmpfname)
-    lines = keyfh.readlines()
-    newlines = []
-    tmpfh = open(keyfilename, "w")
-    mpolelines = 0
-    for ln1 in range(len(lines)):
-        if mpolelines > 0:
-            mpolelines -= 1
-            continue
-        elif 'multipole' in lines[ln1]:
-            (keywd,symcls,lf1,lf2,chg) = lines[ln1].split()
-            newlines.extend(scale_multipoles(symcls,lines[ln1:ln1+5],scalelist))
-            mpolelines = 4
-        else:
-            newlines.append(lines[ln1])
-
-    for nline in newlines:
-        tmpfh.write(nline)
-    tmpfh.close()
-    keyfh.close()
+    """
+    for term in keyf.multipoles():
+        (keywd,symcls,lf1,lf2,chg) = term.fields
+        term.lines = scale_multipoles(symcls,term.lines,scalelist)
 
 def append_basisset (comfname, spacedformulastr,basissetstr):
     """
@@ -974,14 +1263,14 @@ def append_basisset (comfname, spacedformulastr,basissetstr):
         fh.write(' ****\n\n')
         fh.close()
 
-def is_qm_normal_termination(logfname):
+def is_qm_normal_termination(session, logfname):
     """
     Intent: Checks the *.log file for normal termination
     """
-    if os.path.isfile(logfname):
-        for line in open(logfname):
+    if os.path.isfile(session.path(logfname)):
+        for line in open(session.path(logfname)):
             if "Normal termination" in line:
-                logfh.write("Normal termination: %s\n" % logfname)
+                session.logfh.write("Normal termination: %s\n" % logfname)
                 return True
     return False
 
@@ -1030,24 +1319,105 @@ def append_restraint(restraintlist,comfname):
                     fh.write("%9.3f" % ele)
             fh.write(" F\n")
 
-def write_com_header(comfname,chkfname):
+def mem_str_to_mb(memstr):
     """
-    Intent: Add header to *.com file
-    Referenced By: gen_optcomfile
+    Intent: Convert a Gaussian memory size (e.g. 700MB, 55GB, 100MW) to megabytes
+    Sizes without a B or W suffix are taken as words (8 bytes), as Gaussian does.
     """
-    tmpfh = open(comfname, "w")
+    m = re.match(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)([BW]?)\s*$', str(memstr), re.I)
+    assert m, "Error: Cannot read memory size " + str(memstr)
+    unitscale = {'':1.0/(1024*1024), 'K':1.0/1024, 'M':1.0, 'G':1024.0, 'T':1024.0*1024}
+    mb = float(m.group(1)) * unitscale[m.group(2).upper()]
+    if m.group(3).upper() != 'B':
+        mb *= 8
+    return int(mb)
+
+def get_machine_resources():
+    """
+    Intent: Find the number of cores and the amount of memory (in MB) on this machine
+    Output:
+        ncpu: number of cores available to this process
+        memmb: physical memory in MB (None if it cannot be found)
+    Referenced By: get_total_qm_resources
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        ncpu = len(os.sched_getaffinity(0))
+    else:
+        ncpu = os.cpu_count() or 1
+    try:
+        memmb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024*1024)
+    except (ValueError, OSError, AttributeError):
+        memmb = None
+    return ncpu, memmb
+
+def get_total_qm_resources(session):
+    """
+    Intent: Total cores and memory (in MB) that QM jobs may share: 'numproc' and 'maxmem',
+    limited to what this machine actually has
+    Referenced By: plan_qm_resources, gen_torsion
+    """
+    ncpu, memmb = get_machine_resources()
+    totproc = min(int(session.numproc), ncpu)
+    totmem = mem_str_to_mb(session.maxmem)
+    if memmb is not None:
+        totmem = min(totmem, memmb)
+    return totproc, totmem
+
+def plan_qm_resources(session, weights):
+    """
+    Intent: Split the QM cores and memory between jobs that run at the same time
+    Input:
+        weights: list with the relative size of each job (e.g. [2.0, 1.0] gives the first
+                 job two thirds of the cores and memory)
+    Output:
+        plan: list of (nproc, mem) tuples, one per job, where mem is a Gaussian memory string
+    Referenced By: gen_torsion, run_gaussian
+    Description:
+    1. Give each job its share of the cores, at least one
+    2. Hand out cores lost to rounding to the largest jobs first
+    3. Give each job its share of the memory
+    """
+    totproc, totmem = get_total_qm_resources(session)
+    totweight = float(sum(weights))
+    nproclist = [max(1, int(totproc * w / totweight)) for w in weights]
+    bysize = sorted(range(len(weights)), key=lambda i: -weights[i])
+    spare = totproc - sum(nproclist)
+    while spare > 0:
+        for i in bysize:
+            if spare <= 0:
+                break
+            nproclist[i] += 1
+            spare -= 1
+    memlist = ['%dMB' % max(1, int(totmem * w / totweight)) for w in weights]
+    return list(zip(nproclist, memlist))
+
+def write_com_header(session, comfname,chkfname,jobnproc=None,jobmem=None):
+    """
+    Intent: Add header to *.com file
+    Input:
+        comfname: com file name
+        chkfname: chk file name
+        jobnproc: number of processors for this job (default: 'numproc')
+        jobmem: max memory size for this job (default: 'maxmem')
+    Referenced By: gen_optcomfile, gen_comfile, gen_torcomfile
+    """
+    if jobnproc is None:
+        jobnproc = session.numproc
+    if jobmem is None:
+        jobmem = session.maxmem
+    tmpfh = open(session.path(comfname), "w")
     assert tmpfh, "Cannot create file: " + comfname
 
-    tmpfh.write('%RWF=' + scrtmpdir + '/,' + maxdisk + '\n')
+    tmpfh.write('%RWF=' + session.scrtmpdir + '/,' + session.maxdisk + '\n')
 #   tmpfh.write('%Int=' + scrtmpdir + '/,' + maxdisk + '\n')
 #   tmpfh.write('%D2E=' + scrtmpdir + '/,' + maxdisk + '\n')
     tmpfh.write("%Nosave\n")
     tmpfh.write("%Chk=" + os.path.splitext(comfname)[0] + ".chk\n")
-    tmpfh.write("%Mem=" + maxmem + "\n")
-    tmpfh.write("%Nproc=" + str(numproc) + "\n")
+    tmpfh.write("%Mem=" + jobmem + "\n")
+    tmpfh.write("%Nproc=" + str(jobnproc) + "\n")
     tmpfh.close()
 
-def gen_optcomfile (comfname,numproc,maxmem,chkname,mol):
+def gen_optcomfile (session, comfname,numproc,maxmem,chkname,mol):
     """
     Intent: Create *.com file for qm opt
     Input:
@@ -1062,18 +1432,18 @@ def gen_optcomfile (comfname,numproc,maxmem,chkname,mol):
     Description: -
     """
     restraintlist = []
-    write_com_header(comfname,chkname)
-    tmpfh = open(comfname, "a")
+    write_com_header(session, comfname,chkname,numproc,maxmem)
+    tmpfh = open(session.path(comfname), "a")
     optimizeoptlist = ["maxcycle=400"]
     if restraintlist:
         optimizeoptlist.insert(0,"modred")
     optstr=gen_opt_str(optimizeoptlist)
     if ('I ' in mol.GetSpacedFormula()):
-        tmpfh.write("%s HF/Gen freq Guess=INDO MaxDisk=%s\n" % (optstr,maxdisk))
+        tmpfh.write("%s HF/Gen freq Guess=INDO MaxDisk=%s\n" % (optstr,session.maxdisk))
     else:
-        tmpfh.write("%s CAM-B3LYP/%s freq Guess=INDO MaxDisk=%s\n" % (optstr,optbasisset,maxdisk))
+        tmpfh.write("%s CAM-B3LYP/%s freq Guess=INDO MaxDisk=%s\n" % (optstr,session.optbasisset,session.maxdisk))
 
-    commentstr = molecprefix + " Gaussian SP Calculation on " + gethostname()
+    commentstr = session.molecprefix + " Gaussian SP Calculation on " + gethostname()
     tmpfh.write('\n%s\n\n' % commentstr)
     # TODO: GetTotalCharge
     tmpfh.write('%d %d\n' % (-2, 1))
@@ -1086,13 +1456,13 @@ def gen_optcomfile (comfname,numproc,maxmem,chkname,mol):
     tmpfh.close()
     #NOTE: Restraints need to be specified before
     #       extended basis sets for Gaussian 03/09.
-    append_restraint(restraintlist,comfname)
-    tmpfh = open(comfname, "a")
+    append_restraint(restraintlist,session.path(comfname))
+    tmpfh = open(session.path(comfname), "a")
     tmpfh.write("\n")
     tmpfh.close()
-    append_basisset(comfname, mol.GetSpacedFormula(), optbasisset)
+    append_basisset(session.path(comfname), mol.GetSpacedFormula(), session.optbasisset)
 
-def gen_comfile (comfname,numproc,maxmem,chkname,tailfname,mol):
+def gen_comfile (session, comfname,numproc,maxmem,chkname,tailfname,mol):
     """
     Intent: Create *.com file for qm dma and sp
     Input:
@@ -1108,19 +1478,19 @@ def gen_comfile (comfname,numproc,maxmem,chkname,tailfname,mol):
     Description: -
     """
     optlogfname = os.path.splitext(comfname)[0] + ".log"
-    title = "\"" + molecprefix + " Gaussian SP Calculation on " + gethostname() + "\""
-    cmdstr = babelexe + " --title " + title + " -i g03 " + gausoptfname + " " + tailfname
-    call_subsystem(cmdstr)
+    title = "\"" + session.molecprefix + " Gaussian SP Calculation on " + gethostname() + "\""
+    cmdstr = babelexe + " --title " + title + " -i g03 " + session.gausoptfname + " " + tailfname
+    call_subsystem(session, cmdstr)
 
-    write_com_header(comfname,chkname)
-    tmpfh = open(comfname, "a")
+    write_com_header(session, comfname,chkname,numproc,maxmem)
+    tmpfh = open(session.path(comfname), "a")
     #NOTE: Need to pass parameter to specify basis set
     if ('dma' in comfname):
-        opstr="#CAM-B3LYP/%s Sp Density=SCF MaxDisk=%s\n" % (dmabasisset, maxdisk)
+        opstr="#CAM-B3LYP/%s Sp Density=SCF MaxDisk=%s\n" % (session.dmabasisset, session.maxdisk)
     elif ('pop' in comfname):
-        opstr="#P HF/%s MaxDisk=%s Pop=SaveMixed\n" % (popbasisset, maxdisk)
+        opstr="#P HF/%s MaxDisk=%s Pop=SaveMixed\n" % (session.popbasisset, session.maxdisk)
     else:
-        opstr="#CAM-B3LYP/%s Sp Density=SCF SCF=Save Guess=Huckel MaxDisk=%s\n" % (espbasisset, maxdisk)
+        opstr="#CAM-B3LYP/%s Sp Density=SCF SCF=Save Guess=Huckel MaxDisk=%s\n" % (session.espbasisset, session.maxdisk)
 
     bset=re.search('(?i)(6-31|aug-cc)\S+',opstr)
     if ('I ' in mol.GetSpacedFormula()):
@@ -1128,16 +1498,16 @@ def gen_comfile (comfname,numproc,maxmem,chkname,tailfname,mol):
     tmpfh.write(opstr)
     tmpfh.close()
     cmdstr = "tail -n +2 " + tailfname + " | head -n 4 >> " + comfname
-    os.system(cmdstr)
+    call_subsystem(session, cmdstr)
     cmdstr = "tail -n +6 " + tailfname + " | sed -e's/ .*//' > tmp1.txt"
-    os.system(cmdstr)
-    cmdstr = "grep -A " + str(mol.NumAtoms()+4) + " 'Standard orientation' " + gausoptfname + " | tail -n " + str(mol.NumAtoms()) + " | sed -e's/^.* 0 //' > tmp2.txt"
-    os.system(cmdstr)
+    call_subsystem(session, cmdstr)
+    cmdstr = "grep -A " + str(mol.NumAtoms()+4) + " 'Standard orientation' " + session.gausoptfname + " | tail -n " + str(mol.NumAtoms()) + " | sed -e's/^.* 0 //' > tmp2.txt"
+    call_subsystem(session, cmdstr)
     cmdstr = "paste tmp1.txt tmp2.txt >> " + comfname
-    os.system(cmdstr)
-    append_basisset(comfname, mol.GetSpacedFormula(), bset.group(0))
+    call_subsystem(session, cmdstr)
+    append_basisset(session.path(comfname), mol.GetSpacedFormula(), bset.group(0))
 
-def gen_torcomfile (comfname,numproc,maxmem,prevstruct,xyzf):
+def gen_torcomfile (session, comfname,numproc,maxmem,prevstruct,xyzf):
     """
     Intent: Create *.com file for qm torsion calculations 
     Input:
@@ -1151,23 +1521,23 @@ def gen_torcomfile (comfname,numproc,maxmem,prevstruct,xyzf):
     Referenced By: tor_opt_sp 
     Description: -
     """
-    write_com_header(comfname,os.path.splitext(comfname)[0] + ".chk")
-    tmpfh = open(comfname, "a")
+    write_com_header(session, comfname,os.path.splitext(comfname)[0] + ".chk",numproc,maxmem)
+    tmpfh = open(session.path(comfname), "a")
 
     optimizeoptlist = ["modred"]
     optimizeoptlist.append("maxcycle=400")
     optstr=gen_opt_str(optimizeoptlist)
 
     if ('-opt-' in comfname):
-        operationstr = "%s HF/%s MaxDisk=%s\n" % (optstr,optbasisset, maxdisk)
-        commentstr = molecprefix + " Rotatable Bond Optimization on " + gethostname()
+        operationstr = "%s HF/%s MaxDisk=%s\n" % (optstr,session.optbasisset, session.maxdisk)
+        commentstr = session.molecprefix + " Rotatable Bond Optimization on " + gethostname()
     else:
-#        operationstr = "#m06L/%s SP SCF=(qc,maxcycle=800) Guess=Indo MaxDisk=%s\n" % (m06lbasisset, maxdisk)
-        operationstr = "#CAM-B3LYP/%s SP SCF=(qc,maxcycle=800) Guess=Indo MaxDisk=%s\n" % (m06lbasisset, maxdisk)
-        commentstr = molecprefix + " Rotatable Bond SP Calculation on " + gethostname()
+#        operationstr = "#m06L/%s SP SCF=(qc,maxcycle=800) Guess=Indo MaxDisk=%s\n" % (session.m06lbasisset, session.maxdisk)
+        operationstr = "#CAM-B3LYP/%s SP SCF=(qc,maxcycle=800) Guess=Indo MaxDisk=%s\n" % (session.m06lbasisset, session.maxdisk)
+        commentstr = session.molecprefix + " Rotatable Bond SP Calculation on " + gethostname()
 
     bset=re.search('6-31\S+',operationstr)
-    if ('I ' in mol.GetSpacedFormula()):
+    if ('I ' in session.mol.GetSpacedFormula()):
         operationstr=re.sub(r'6-31\S+',r'Gen',operationstr)
     tmpfh.write(operationstr)
     tmpfh.write('\n%s\n\n' % commentstr)
@@ -1175,8 +1545,8 @@ def gen_torcomfile (comfname,numproc,maxmem,prevstruct,xyzf):
     tmpfh.write('%d %d\n' % (-2, 1))
     iteratom = openbabel.OBMolAtomIter(prevstruct)
     etab = openbabel.OBElementTable()
-    if os.path.isfile(xyzf):
-        xyzstr = open(xyzf,'r')
+    if os.path.isfile(session.path(xyzf)):
+        xyzstr = open(session.path(xyzf),'r')
         xyzstrl = xyzstr.readlines()
         i = 0
         for atm in iteratom:
@@ -1192,7 +1562,7 @@ def gen_torcomfile (comfname,numproc,maxmem,prevstruct,xyzf):
         tmpfh.write('\n')
         tmpfh.close()
 
-def run_gaussian(mol):
+def run_gaussian(session, mol):
     """
     Intent: QM calculations are done within this method. 
         The calculations are skipped if log files exist, 
@@ -1221,92 +1591,149 @@ def run_gaussian(mol):
        The density matrix info is in *-dma.fchk
     5. Gaussian is run using the 'Density=MP2 SCF=Save Guess=Huckel' keywords to
        find information that will be used to find the electrostatic potential grid
-    """
-    global molecprefix
-    global numproc
-    global maxmem
-    global gausoptfname
-    global comoptfname
-    global chkoptfname
-    global fckoptfname
-    global logoptfname
-    global compopfname
-    global chkpopfname
-    global fckpopfname
-    global logpopfname
-    global comdmafname
-    global chkdmafname
-    global fckdmafname
-    global logdmafname
-    global comespfname
-    global chkespfname
-    global fckespfname
-    global logespfname
-
-    logfh.write("NEED QM Density Matrix: Executing Gaussian Opt and SP\n")
-    comtmp = assign_filenames ( "comtmp" , "-tmp.com")
-    comoptfname = assign_filenames ( "comoptfname" , "-opt.com")
-    chkoptfname = assign_filenames ( "chkoptfname" , "-opt.chk")
-    fckoptfname = assign_filenames ( "fckoptfname" , "-opt.fchk")
-    logoptfname = assign_filenames ( "logoptfname" , "-opt.log")
-    compopfname = assign_filenames ( "compopfname" , "-pop.com")
-    chkpopfname = assign_filenames ( "chkpopfname" , "-pop.chk")
-    fckpopfname = assign_filenames ( "fckpopfname" , "-pop.fchk")
-    logpopfname = assign_filenames ( "logpopfname" , "-pop.log")
-    comdmafname = assign_filenames ( "comdmafname" , "-dma.com")
-    chkdmafname = assign_filenames ( "chkdmafname" , "-dma.chk")
-    fckdmafname = assign_filenames ( "fckdmafname" , "-dma.fchk")
-    logdmafname = assign_filenames ( "logdmafname" , "-dma.log")
-    comespfname = assign_filenames ( "comespfname" , "-esp.com")
-    chkespfname = assign_filenames ( "chkespfname" , "-esp.chk")
-    fckespfname = assign_filenames ( "fckespfname" , "-esp.fchk")
-    logespfname = assign_filenames ( "logespfname" , "-esp.log")
-
-    title = "\"" + molecprefix + " Gaussian Optimization on " + gethostname() + "\""
-    cmdstr = babelexe + " --title " + title + " "+ molstructfname+ " " + comtmp
-    call_subsystem(cmdstr)
-
-    assert os.path.getsize(comtmp) > 0, "Error: " + \
+    6. Steps 4 and 5 (each followed by formchk) do not depend on each other and run
+       at the same time if 'maxqmjobs' allows it
+    """
+
+    session.logfh.write("NEED QM Density Matrix: Executing Gaussian Opt and SP\n")
+    comtmp = assign_filenames (session,  "comtmp" , "-tmp.com")
+    session.comoptfname = assign_filenames (session,  "comoptfname" , "-opt.com")
+    session.chkoptfname = assign_filenames (session,  "chkoptfname" , "-opt.chk")
+    session.fckoptfname = assign_filenames (session,  "fckoptfname" , "-opt.fchk")
+    session.logoptfname = assign_filenames (session,  "logoptfname" , "-opt.log")
+    session.compopfname = assign_filenames (session,  "compopfname" , "-pop.com")
+    session.chkpopfname = assign_filenames (session,  "chkpopfname" , "-pop.chk")
+    session.fckpopfname = assign_filenames (session,  "fckpopfname" , "-pop.fchk")
+    session.logpopfname = assign_filenames (session,  "logpopfname" , "-pop.log")
+    session.comdmafname = assign_filenames (session,  "comdmafname" , "-dma.com")
+    session.chkdmafname = assign_filenames (session,  "chkdmafname" , "-dma.chk")
+    session.fckdmafname = assign_filenames (session,  "fckdmafname" , "-dma.fchk")
+    session.logdmafname = assign_filenames (session,  "logdmafname" , "-dma.log")
+    session.comespfname = assign_filenames (session,  "comespfname" , "-esp.com")
+    session.chkespfname = assign_filenames (session,  "chkespfname" , "-esp.chk")
+    session.fckespfname = assign_filenames (session,  "fckespfname" , "-esp.fchk")
+    session.logespfname = assign_filenames (session,  "logespfname" , "-esp.log")
+
+    title = "\"" + session.molecprefix + " Gaussian Optimization on " + gethostname() + "\""
+    cmdstr = babelexe + " --title " + title + " "+ session.molstructfname+ " " + comtmp
+    call_subsystem(session, cmdstr)
+
+    assert os.path.getsize(session.path(comtmp)) > 0, "Error: " + \
        os.path.basename(babelexe) + " cannot create .com file."
 
-    if not os.path.isdir(scrtmpdir):
-        os.mkdir(scrtmpdir)
-
-    if not is_qm_normal_termination(logoptfname):
-        mystruct = load_structfile(molstructfname)
-        if os.path.isfile(chkoptfname):
-            os.remove(chkoptfname)
-        gen_optcomfile(comoptfname,numproc,maxmem,chkoptfname,mol)
-        cmdstr = 'GAUSS_SCRDIR=' + scrtmpdir + ' ' + gausexe + " " + comoptfname
-        print(cmdstr)
-        call_subsystem(cmdstr,iscritical=True)
-        cmdstr = formchkexe + " " + chkoptfname
-        print(cmdstr)
-        call_subsystem(cmdstr)
-    optmol =  load_structfile(logoptfname)
+    if not os.path.isdir(session.scrtmpdir):
+        os.mkdir(session.scrtmpdir)
+
+    if not is_qm_normal_termination(session, session.logoptfname):
+        mystruct = load_structfile(session.path(session.molstructfname))
+        if os.path.isfile(session.path(session.chkoptfname)):
+            os.remove(session.path(session.chkoptfname))
+        gen_optcomfile(session, session.comoptfname,session.numproc,session.maxmem,session.chkoptfname,mol)
+        call_gaussian(session, session.comoptfname)
+        call_formchk(session, session.chkoptfname)
+    optmol =  load_structfile(session.path(session.logoptfname))
     rebuild_bonds(optmol,mol)
 
-    if not is_qm_normal_termination(logdmafname):
-        if os.path.isfile(chkdmafname):
-            os.remove(chkdmafname)
-        gen_comfile(comdmafname,numproc,maxmem,chkdmafname,comtmp,mol)
-        cmdstr = 'GAUSS_SCRDIR=' + scrtmpdir + ' ' + gausexe + " " + comdmafname
-        call_subsystem(cmdstr,iscritical=True)
-        cmdstr = formchkexe + " " + chkdmafname
-        call_subsystem(cmdstr,iscritical=True)
-
-    if espfit and not is_qm_normal_termination(logespfname):
-        if os.path.isfile(chkespfname):
-            os.remove(chkespfname)
-        gen_comfile(comespfname,numproc,maxmem,chkespfname,comtmp,mol)
-        cmdstr = 'GAUSS_SCRDIR=' + scrtmpdir + ' ' + gausexe + " " + comespfname
-        call_subsystem(cmdstr,iscritical=True)
-        cmdstr = formchkexe + " " + chkespfname
-        call_subsystem(cmdstr)
+    # The DMA and ESP single points only depend on the optimized structure.
+    # Each is followed by its own formchk. Run them as a small job graph so that
+    # they can run at the same time, splitting numproc/maxmem between them.
+    spjobs = []
+    if not is_qm_normal_termination(session, session.logdmafname):
+        spjobs.append(('dma',session.comdmafname,session.chkdmafname,dmajobweight,True))
+    if session.espfit and not is_qm_normal_termination(session, session.logespfname):
+        spjobs.append(('esp',session.comespfname,session.chkespfname,espjobweight,False))
+    njobs = min(session.maxqmjobs, len(spjobs))
+    if njobs > 1:
+        plan = plan_qm_resources(session, [spjob[3] for spjob in spjobs])
+    else:
+        plan = [(session.numproc, session.maxmem)] * len(spjobs)
+
+    jobs = []
+    for (spjob, (jobnproc, jobmem)) in zip(spjobs, plan):
+        (spname, comfname, chkfname, weight, fchkcritical) = spjob
+        if os.path.isfile(session.path(chkfname)):
+            os.remove(session.path(chkfname))
+        # com files are written one at a time; gen_comfile uses fixed temporary files
+        gen_comfile(session, comfname,jobnproc,jobmem,chkfname,comtmp,mol)
+        jobs.append((spname, [], call_gaussian, (session, comfname, True)))
+        jobs.append((spname + '-fchk', [spname], call_formchk, (session, chkfname, fchkcritical)))
+    run_job_graph(jobs, njobs)
 
     return optmol
 
-def gen_canonicallabels(mol):
+def call_gaussian(session, comfname, needfchk=False):
+    """
+    Intent: Run Gaussian on 'comfname' using the Gaussian scratch directory
+    If the QM result cache has a job with the same geometry, route and restraints,
+    its *.log file is copied in place and Gaussian is not run. With 'needfchk' the
+    cached job must also have an *.fchk file, since the checkpoint file of the job
+    has been removed and formchk could not make one.
+    Referenced By: run_gaussian, tor_opt_sp
+    """
+    logfname = os.path.splitext(comfname)[0] + ".log"
+    if session.qmresultcache is not None:
+        cachekey = session.qmresultcache.com_key(session.path(comfname))
+        if session.qmresultcache.restore_log(cachekey, session.path(logfname), needfchk):
+            session.logfh.write("QM cache hit: %s\n" % logfname)
+            return 0
+    cmdstr = session.gausexe + " " + comfname
+    result = call_subsystem(session, cmdstr,iscritical=True,env={'GAUSS_SCRDIR': session.scrtmpdir})
+    if session.qmresultcache is not None and is_qm_normal_termination(session, logfname):
+        session.qmresultcache.store_log(cachekey, session.path(logfname))
+    return result
+
+def call_formchk(session, chkfname, iscritical=False, *prevresults):
+    """
+    Intent: Run formchk on 'chkfname'
+    The *.fchk file is taken from the QM result cache if the matching job has one.
+    The results of the jobs this one waits for in 'run_job_graph' ('prevresults') are not used.
+    Referenced By: run_gaussian
+    """
+    fchkfname = os.path.splitext(chkfname)[0] + ".fchk"
+    # the checkpoint file is named after the com file (see write_com_header)
+    comfname = os.path.splitext(chkfname)[0] + ".com"
+    usecache = session.qmresultcache is not None and os.path.isfile(session.path(comfname))
+    if usecache:
+        cachekey = session.qmresultcache.com_key(session.path(comfname))
+        if session.qmresultcache.restore_fchk(cachekey, session.path(fchkfname)):
+            session.logfh.write("QM cache hit: %s\n" % fchkfname)
+            return 0
+    cmdstr = session.formchkexe + " " + chkfname
+    result = call_subsystem(session, cmdstr,iscritical)
+    if usecache and os.path.isfile(session.path(fchkfname)):
+        session.qmresultcache.store_fchk(cachekey, session.path(fchkfname))
+    return result
+
+def get_canonical_smiles(mol):
+    """
+    Intent: Canonical SMILES of 'mol' with explicit hydrogens, and its atom order
+    Input:
+        mol: OBMol object
+    Output:
+        None if openbabel does not report the atom order, otherwise a tuple of
+        smiles: canonical SMILES string
+        order: atom idx's of 'mol' in the order they appear in 'smiles'
+    Referenced By: gen_canonicallabels
+    Description:
+    The 'O' output option of the SMILES writer stores the output atom order as
+    'SMILES Atom Order' pair data; a copy of 'mol' is written so that 'mol' keeps
+    no stale data.
+    """
+    molcopy = openbabel.OBMol(mol)
+    obConversion = openbabel.OBConversion()
+    obConversion.SetOutFormat("can")
+    obConversion.AddOption("h", openbabel.OBConversion.OUTOPTIONS)
+    obConversion.AddOption("O", openbabel.OBConversion.OUTOPTIONS)
+    fields = obConversion.WriteString(molcopy).split()
+    data = molcopy.GetData("SMILES Atom Order")
+    if not fields or data is None:
+        return None
+    order = [int(idx) for idx in openbabel.toPairData(data).GetValue().split()]
+    if sorted(order) != list(range(1, mol.NumAtoms() + 1)):
+        return None
+    return (fields[0], order)
+
+def gen_canonicallabels(session, mol):
     """
     Intent: Find the symmetry class that each atom belongs to
     Input: 
@@ -1319,17 +1746,36 @@ def gen_canonicallabels(mol):
     2. OBMol.FindLargestFragment is called to fill in the 'frag_atoms' bit vector (the
     vector is filled with a 1 or 0 depending on whether the atom is part of the largest
     fragment or not)
-    3. 'CalculateSymmetry' method is called to find initial symmetry classes
+    3. 'CalculateSymmetry' method is called to find initial symmetry classes, unless
+    they are in the symmetry class cache. The cache is only used when the molecule is
+    one fragment, and it stores the classes from 'CalculateSymmetry' in canonical
+    atom order; the next steps depend on the atom order, so they are always redone.
     4. Terminal atoms of the same element are collapsed to one symmetry class
     5. Possibly renumber the symmetry classes
     """
     # Returns symmetry classes for each atom ID
     frag_atoms = openbabel.OBBitVec()
-    symmclasslist = []
     mol.FindLargestFragment(frag_atoms)
-    CalculateSymmetry(mol, frag_atoms, symmclasslist)
-    for ii in range(len(symmetryclass)):
-        symmetryclass[ii] = symmclasslist[ii][1]
+    canon = None
+    classes = None
+    if session.symmcache is not None and frag_atoms.CountBits() == mol.NumAtoms():
+        canon = get_canonical_smiles(mol)
+    if canon is not None:
+        (smiles, order) = canon
+        canonclasses = session.symmcache.lookup(smiles)
+        if canonclasses is not None and len(canonclasses) == len(order):
+            classes = [0] * mol.NumAtoms()
+            for (idx, cls) in zip(order, canonclasses):
+                classes[idx-1] = cls
+            session.logfh.write("Symmetry classes from cache: %s\n" % smiles)
+    if classes is None:
+        symmclasslist = []
+        CalculateSymmetry(mol, frag_atoms, symmclasslist)
+        classes = [cls for (atomidx, cls) in symmclasslist]
+        if canon is not None:
+            session.symmcache.store(smiles, [classes[idx-1] for idx in order])
+    for ii in range(len(session.symmetryclass)):
+        session.symmetryclass[ii] = classes[ii]
 
     # Collapse terminal atoms of same element to one type
     for a in openbabel.OBMolAtomIter(mol):
@@ -1339,31 +1785,29 @@ def gen_canonicallabels(mol):
                     if ((b is not c) and
                         (c.GetValence() == 1) and
                         (b.GetAtomicNum() == c.GetAtomicNum()) and
-                        (symmetryclass[b.GetIdx()-1] !=
-                            symmetryclass[c.GetIdx()-1])):
-                        symmetryclass[c.GetIdx()-1] = \
-                            symmetryclass[b.GetIdx()-1]
+                        (session.symmetryclass[b.GetIdx()-1] !=
+                            session.symmetryclass[c.GetIdx()-1])):
+                        session.symmetryclass[c.GetIdx()-1] = \
+                            session.symmetryclass[b.GetIdx()-1]
 
     # Renumber symmetry classes
-    allcls=list(set(symmetryclass))
-    allcls.sort()
-    for ii in range(len(symmetryclass)):
-        symmetryclass[ii] = allcls.index(symmetryclass[ii]) + 1
+    allcls, newcls = renumber_classes(session.symmetryclass)
+    session.symmetryclass[:] = newcls.tolist()
 
 
 #scaling of multipole values for certain atom types
-def process_types (mol):
+def process_types (session, mol):
     """
     Intent: Set up scalelist array for scaling certain multipole values 
     """
 
     scalelist = {}
     for atm in openbabel.OBMolAtomIter(mol):
-        if get_class_number(atm.GetIdx()) not in scalelist:
-            scalelist[get_class_number(atm.GetIdx())] = []
-            scalelist[get_class_number(atm.GetIdx())].append(None)
-            scalelist[get_class_number(atm.GetIdx())].append(None)
-            scalelist[get_class_number(atm.GetIdx())].append(None)
+        if get_class_number(session, atm.GetIdx()) not in scalelist:
+            scalelist[get_class_number(session, atm.GetIdx())] = []
+            scalelist[get_class_number(session, atm.GetIdx())].append(None)
+            scalelist[get_class_number(session, atm.GetIdx())].append(None)
+            scalelist[get_class_number(session, atm.GetIdx())].append(None)
             multipole_scale_dict = {}
 #multipole_scale_dict['[OH]'] = [2, 0.6]
 #multipole_scale_dict['[#1]O'] = [2, 0.6]
@@ -1375,7 +1819,7 @@ def process_types (mol):
         openbabel.OBSmartsPattern.Init(sp,sckey)
         sp.Match(mol)
         for ia in sp.GetUMapList():
-            scalelist[get_class_number(ia[0])][scval[0]] = scval[1]
+            scalelist[get_class_number(session, ia[0])][scval[0]] = scval[1]
 
     return scalelist
 
@@ -1390,10 +1834,10 @@ def gen_gdmain(gdmainfname,molecprefix,fname):
     Output: *.gdmain file is created
     Referenced By: run_gdma
     Description:
-        1. create pointer file dma.fchk to *-dma.fchk
+        1. create pointer file dma.fchk to *-dma.fchk, next to 'gdmainfname'
         2. create *.gdmain file and write in all the necessary information for the gdma run
     """
-    fnamesym = "dma.fchk"
+    fnamesym = os.path.join(os.path.dirname(gdmainfname), "dma.fchk")
     try:
         os.symlink(fname,fnamesym)
     except OSError as xxx_todo_changeme:
@@ -1412,7 +1856,7 @@ def gen_gdmain(gdmainfname,molecprefix,fname):
 
     tmpfh.write("Title " + molecprefix + " gdmain\n")
     tmpfh.write("\n")
-    tmpfh.write("File " + fnamesym  + " density SCF\n")
+    tmpfh.write("File " + os.path.basename(fnamesym)  + " density SCF\n")
     tmpfh.write("Angstrom\n")
     tmpfh.write("AU\n")
     tmpfh.write("Multipoles\n")
@@ -1430,7 +1874,7 @@ def gen_gdmain(gdmainfname,molecprefix,fname):
     tmpfh.write("Finish\n")
     tmpfh.close()
 
-def run_gdma():
+def run_gdma(session):
     """
     Intent: Runs GDMA to find multipole information
     The GDMA program carries out distributed multipole analysis of the wavefunctions
@@ -1442,23 +1886,21 @@ def run_gdma():
     1. Generates the gdma input file by calling 'gen_gdmain'
     2. Runs the following command: gdma < *.gdmain > *.gdmaout
     """
-    global molecprefix
-    global fckdmafname
 
-    logfh.write("NEED DMA: Executing GDMA\n")
+    session.logfh.write("NEED DMA: Executing GDMA\n")
 
-    if not os.path.isfile(fckdmafname):
-        fckdmafname = os.path.splitext(fckdmafname)[0]
+    if not os.path.isfile(session.path(session.fckdmafname)):
+        session.fckdmafname = os.path.splitext(session.fckdmafname)[0]
 
-    assert os.path.isfile(fckdmafname), "Error: " + fckdmafname + " does not exist."
-    gdmainfname = assign_filenames ( "gdmainfname" , ".gdmain")
-    gen_gdmain(gdmainfname,molecprefix,fckdmafname)
+    assert os.path.isfile(session.path(session.fckdmafname)), "Error: " + session.fckdmafname + " does not exist."
+    gdmainfname = assign_filenames (session,  "gdmainfname" , ".gdmain")
+    gen_gdmain(session.path(gdmainfname),session.molecprefix,session.fckdmafname)
 
-    cmdstr = gdmaexe + " < " + gdmainfname + " > " + gdmafname
-    call_subsystem(cmdstr)
+    cmdstr = session.gdmaexe + " < " + gdmainfname + " > " + session.gdmafname
+    call_subsystem(session, cmdstr)
 
-    assert os.path.getsize(gdmafname) > 0, "Error: " + \
-       os.path.basename(gdmaexe) + " cannot create .gdmaout file."
+    assert os.path.getsize(session.path(session.gdmafname)) > 0, "Error: " + \
+       os.path.basename(session.gdmaexe) + " cannot create .gdmaout file."
 
 def is_in_polargroup(mol, smarts, bond, f):
     """
@@ -1483,7 +1925,7 @@ def is_in_polargroup(mol, smarts, bond, f):
     return False
 
 # Create file to define local frames for multipole
-def gen_peditinfile (mol):
+def gen_peditinfile (session, mol):
     """
     Intent: Create a file with local frame definitions for each multipole
     These frame definitions are given as input into tinker's poledit
@@ -1520,16 +1962,16 @@ def gen_peditinfile (mol):
     for a in openbabel.OBMolAtomIter(mol):
         # iterate over the atoms that a is bound to
         for b in openbabel.OBAtomAtomIter(a):
-            lf1 = localframe1[a.GetIdx() - 1]
-            lf2 = localframe2[a.GetIdx() - 1]
+            lf1 = session.localframe1[a.GetIdx() - 1]
+            lf2 = session.localframe2[a.GetIdx() - 1]
             # Sort list based on symmetry class, largest first
-            a1 = sorted((lf1, lf2, b.GetIdx()), key=get_symm_class, reverse=True)
+            a1 = sorted((lf1, lf2, b.GetIdx()), key=lambda idx: get_symm_class(session, idx), reverse=True)
             while a1[0] == 0:
                 a1 = rotate_list(a1)
             # Set localframe1 and localframe2 for atom a to be the first two atoms
             # of the above sorted list 'a1'
-            localframe1[a.GetIdx() - 1] = a1[0]
-            localframe2[a.GetIdx() - 1] = a1[1]
+            session.localframe1[a.GetIdx() - 1] = a1[0]
+            session.localframe2[a.GetIdx() - 1] = a1[1]
 
     # if a is bound to two atoms of the same symmetry class that aren't hydrogens
     # use these two atoms to define the local frame
@@ -1537,28 +1979,28 @@ def gen_peditinfile (mol):
         classlist = {}
         for b in openbabel.OBAtomAtomIter(a):
             if b.GetAtomicNum() != 1:
-                clsidx = symmetryclass[b.GetIdx() - 1]
+                clsidx = session.symmetryclass[b.GetIdx() - 1]
                 if clsidx not in classlist:
                     classlist[clsidx] = []
                 classlist[clsidx].append(b.GetIdx())
         for clstype in list(classlist.values()):
             if len(clstype) > 1:
-                localframe1[a.GetIdx() - 1] = clstype[0]
-                localframe2[a.GetIdx() - 1] = clstype[1]
+                session.localframe1[a.GetIdx() - 1] = clstype[0]
+                session.localframe2[a.GetIdx() - 1] = clstype[1]
 
     # Find atoms bonded to only one atom
     iteratom = openbabel.OBMolAtomIter(mol)
     for a in iteratom:
-        lfa1 = localframe1[a.GetIdx() - 1]
-        lfa2 = localframe2[a.GetIdx() - 1]
-        lfb1 = localframe1[lfa1 - 1]
-        lfb2 = localframe2[lfa1 - 1]
+        lfa1 = session.localframe1[a.GetIdx() - 1]
+        lfa2 = session.localframe2[a.GetIdx() - 1]
+        lfb1 = session.localframe1[lfa1 - 1]
+        lfb2 = session.localframe2[lfa1 - 1]
         if a.GetValence() == 1:
             # Set lfa2 to the other atom (the atom that isn't 'a') in the local frame of atom 'b'
             if lfb1 != a.GetIdx():
-                localframe2[a.GetIdx() - 1] = lfb1
+                session.localframe2[a.GetIdx() - 1] = lfb1
             else:
-                localframe2[a.GetIdx() - 1] = lfb2
+                session.localframe2[a.GetIdx() - 1] = lfb2
 
     # Zero out x-component if more than one possible choice
     # for x-axis local frame
@@ -1567,43 +2009,43 @@ def gen_peditinfile (mol):
 
     # lf2write is to write out localframe2 for poledit
     # Since poledit will zero out x-comp if x-axis(i) = 0
-    lf2write = list(localframe2)
+    lf2write = list(session.localframe2)
     for a in openbabel.OBMolAtomIter(mol):
-        lf1 = localframe1[a.GetIdx() - 1]
-        lf2 = localframe2[a.GetIdx() - 1]
+        lf1 = session.localframe1[a.GetIdx() - 1]
+        lf2 = session.localframe2[a.GetIdx() - 1]
 
         # Check LF1 instead if LF2 is not bonded to atom "a"
         # If a is only bound to one other atom
         if a.GetValence() == 1:
-            center = mol.GetAtom(localframe1[a.GetIdx() - 1])
+            center = mol.GetAtom(session.localframe1[a.GetIdx() - 1])
             for b in openbabel.OBAtomAtomIter(center):
                 # lf2 and b are not the same atom, but the same sym class, set lfzerox to true
                 if (lf2 != b.GetIdx() and
-                    (get_symm_class(lf2) == get_symm_class(b.GetIdx()))):
+                    (get_symm_class(session, lf2) == get_symm_class(session, b.GetIdx()))):
                     lfzerox[a.GetIdx() - 1] = True
         else:
             for b in openbabel.OBAtomAtomIter(a):
                 # if lf2 and b are not the same atom, but the same sym class, set lf2write to 0
                 if (lf1 != b.GetIdx() and
                     lf2 != b.GetIdx() and
-                    (get_symm_class(lf2) == get_symm_class(b.GetIdx()))):
+                    (get_symm_class(session, lf2) == get_symm_class(session, b.GetIdx()))):
                     lf2write[a.GetIdx() - 1] = 0
 
     # Define bisectors
     for a in openbabel.OBMolAtomIter(mol):
-        lfa1 = localframe1[a.GetIdx() - 1]
-        lfa2 = localframe2[a.GetIdx() - 1]
+        lfa1 = session.localframe1[a.GetIdx() - 1]
+        lfa2 = session.localframe2[a.GetIdx() - 1]
         if (a.IsConnected(mol.GetAtom(lfa1)) and
             a.IsConnected(mol.GetAtom(lfa2)) and
-            get_symm_class(lfa1) == get_symm_class(lfa2)):
-            localframe2[a.GetIdx() - 1] *= -1
+            get_symm_class(session, lfa1) == get_symm_class(session, lfa2)):
+            session.localframe2[a.GetIdx() - 1] *= -1
             lf2write[a.GetIdx() - 1] *= -1
 
     # write out the local frames
     iteratom = openbabel.OBMolAtomIter(mol)
-    f = open (peditinfile, 'w')
+    f = open (session.path(session.peditinfile), 'w')
     for a in iteratom:
-        f.write(str(a.GetIdx()) + " " + str(localframe1[a.GetIdx() - 1]) +
+        f.write(str(a.GetIdx()) + " " + str(session.localframe1[a.GetIdx() - 1]) +
            " " + str(lf2write[a.GetIdx() - 1]) + "\n")
     f.write("\n")
 
@@ -1671,38 +2113,67 @@ def CalculateSymmetry(pmol, frag_atoms, symmetry_classes):
         frag_atoms: OBBitVec object containing information about the largest fragment in 'pmol' 
         symmetry_classes: the symmetry_classes array which will be filled in
     Output: 
-		nclasses: # of classes
-        symmetry_classes: array is filled in
+        nclasses: # of classes
+        symmetry_classes: array is filled in with [atom, class] for each atom of the fragment
     Referenced By: gen_canonicallabels
     Description:
     1. vectorUnsignedInt object is created, 'vgi'
     2. It is filled in with the call to GetGIVector
-    3. The 'symmetry_classes' array is initially filled in to match with 'vgi'
-    4. These initial invariant classes do not suit our needs perfectly,
+    3. The initial classes of the atoms in the fragment are taken from 'vgi'
+    4. The bonds within the fragment are stored once as an adjacency array (build_adjacency)
+    5. These initial invariant classes do not suit our needs perfectly,
        so the ExtendInvariants method is called to find the more 
        refined classes that we need
     """
     vgi = openbabel.vectorUnsignedInt()
-    natoms = pmol.NumAtoms()
-    nfragatoms = frag_atoms.CountBits()
     pmol.GetGIVector(vgi)
-    iteratom = openbabel.OBMolAtomIter(pmol)
-    for atom in iteratom:
+    fragatoms = []
+    classes = []
+    for atom in openbabel.OBMolAtomIter(pmol):
         idx = atom.GetIdx()
         if(frag_atoms.BitIsOn(idx)):
-            symmetry_classes.append([atom, vgi[idx-1]])
-    nclasses = ExtendInvariants(pmol, symmetry_classes,frag_atoms,nfragatoms,natoms)
+            fragatoms.append(atom)
+            classes.append(vgi[idx-1])
+    nbrstart, nbrlist = build_adjacency(pmol, [atom.GetIdx() for atom in fragatoms])
+    nclasses = ExtendInvariants(classes, nbrstart, nbrlist)
+    for (atom, cls) in zip(fragatoms, classes):
+        symmetry_classes.append([atom, cls])
     return nclasses
 
-def ExtendInvariants(pmol, symmetry_classes,frag_atoms,nfragatoms,natoms):
+def build_adjacency(pmol, fragidx):
+    """
+    Intent: Find the neighbors of the atoms 'fragidx' among themselves, in compressed form
+    Input:
+        pmol: OBMol object
+        fragidx: atom idx's of the atoms to consider
+    Output:
+        nbrstart, nbrlist: the neighbors of atom fragidx[i] are the atoms fragidx[j]
+                           for j in nbrlist[nbrstart[i]:nbrstart[i+1]]
+    Referenced By: CalculateSymmetry
+    Description:
+    The bonds are walked once; bonds to atoms that are not in 'fragidx' are left out.
+    """
+    idx2index = dict((idx, i) for (i, idx) in enumerate(fragidx))
+    nbrs = [[] for idx in fragidx]
+    for b in openbabel.OBMolBondIter(pmol):
+        i = idx2index.get(b.GetBeginAtomIdx())
+        j = idx2index.get(b.GetEndAtomIdx())
+        if i is not None and j is not None:
+            nbrs[i].append(j)
+            nbrs[j].append(i)
+    nbrstart = [0]
+    nbrlist = []
+    for atomnbrs in nbrs:
+        nbrlist.extend(atomnbrs)
+        nbrstart.append(len(nbrlist))
+    return nbrstart, nbrlist
+
+def ExtendInvariants(symmetry_classes, nbrstart, nbrlist):
     """
     Intent: Refine the invariants found by openbabel's GetGIVector
     Input: 
-        pmol: OBMol object
-        symmetry_classes: symmetry classes array
-        frag_atoms: vector containing information about which atoms belong to the largest fragment
-        nfragatoms: # of atoms belonging to the largest fragment
-        natoms: # of atoms belonging to the molecule
+        symmetry_classes: list with the class of each atom of the fragment
+        nbrstart, nbrlist: neighbors of each atom, see build_adjacency
     Output: 
         nclasses1: # of symmetry classes found 
         symmetry_classes: this array is updated
@@ -1711,8 +2182,8 @@ def ExtendInvariants(pmol, symmetry_classes,frag_atoms,nfragatoms,natoms):
     1. Find the # of current classes found by openbabel, nclasses1, 
        and renumber (relabel) the classes to 1, 2, 3, ...
     2. Begin loop
-       a. CreateNewClassVector is called which fills in the 'tmp_classes' array with
-          a new set of classes by considering bonding information
+       a. CreateNewClassVector is called which returns a new set of classes
+          by considering bonding information
        b. The number of classes in tmp_classes is found, 'nclasses2'
        c. If there was no change, nclasses1 == nclasses2, break
        d. If the number of classes changed, set nclasses1 to nclasses2, then continue loop
@@ -1721,14 +2192,12 @@ def ExtendInvariants(pmol, symmetry_classes,frag_atoms,nfragatoms,natoms):
     3. Return # of classes found
     """
     nclasses1 = CountAndRenumberClasses(symmetry_classes)
-    tmp_classes = []
-    if(nclasses1 < nfragatoms):
+    if(nclasses1 < len(symmetry_classes)):
         #stops when number of classes don't change
         for i in range(100):
-            CreateNewClassVector(pmol,symmetry_classes, tmp_classes, frag_atoms, natoms)
+            tmp_classes = CreateNewClassVector(symmetry_classes, nbrstart, nbrlist)
             nclasses2 = CountAndRenumberClasses(tmp_classes)
-            del symmetry_classes[:]
-            symmetry_classes.extend(tmp_classes)
+            symmetry_classes[:] = tmp_classes
             if(nclasses1 == nclasses2):
                 break
             nclasses1 = nclasses2
@@ -1743,78 +2212,61 @@ def CountAndRenumberClasses(symmetry_classes):
         count: # of symmetry classes
         symmetry_classes array is updated
     Referenced By: ExtendInvariants
-    Description: -
+    Description:
+    The classes keep their order: the lowest class becomes 1, the next lowest 2, ...
+    (see renumber_classes)
     """
-    count = 1
-    symmetry_classes = sorted(symmetry_classes, key=lambda sym: sym[1])
-    if(len(symmetry_classes) > 0):
-        idatom = symmetry_classes[0][1]
-        symmetry_classes[0][1] = 1
-        for i in range(1,len(symmetry_classes)):
-            if(symmetry_classes[i][1] != idatom):
-                idatom = symmetry_classes[i][1]
-                count = count + 1
-                symmetry_classes[i][1] = count
-            else:
-                symmetry_classes[i][1] = count
-    return count
+    allcls, newcls = renumber_classes(symmetry_classes)
+    symmetry_classes[:] = newcls.tolist()
+    return len(allcls)
 
-def CreateNewClassVector(pmol,symmetry_classes, tmp_classes, frag_atoms, natoms):
+def renumber_classes(classes):
+    """
+    Intent: Renumber 'classes' to 1, 2, 3, ... keeping their order
+    Input:
+        classes: sequence of integer classes
+    Output:
+        allcls: numpy array of the distinct classes, sorted
+        newcls: numpy array with the new class of each element of 'classes'
+    Referenced By: CountAndRenumberClasses, gen_canonicallabels
+    """
+    allcls, newcls = numpy.unique(numpy.asarray(classes, dtype=numpy.int64), return_inverse=True)
+    return allcls, newcls.reshape(-1) + 1
+
+def CreateNewClassVector(symmetry_classes, nbrstart, nbrlist):
     """
     Intent: Find new symmetry classes if possible
     If two atoms were originally of the same sym class but are bound to atoms of differing
     sym classes, then these two atoms will now belong to two different sym classes
     Input:
-        pmol: OBMol object
         symmetry_classes: previous set of symmetry classes
-        tmp_classes: tmp array of new symmetry classes
-        frag_atoms: atoms in largest fragment
-        natoms: number of atoms
+        nbrstart, nbrlist: neighbors of each atom, see build_adjacency
     Ouptut:
-        tmp_classes is edited
+        tmp_classes: new symmetry classes, numbered 1, 2, 3, ...
     Referenced By: ExtendInvariants
     Description:
-    1. dict idx2index is created which maps atom idx's to an index ranging
-       from 0 to # of symmetry classes - 1
-    2. For each atom a:
-           a. For each bond b that a belongs to:
-               i. Find the idx of the other atom, nbratom, in the bond b
-               ii. Find and append the symmetry class that nbratom belongs to to vtmp
-           b. Using vtmp, create a label for atom a
-              i. This label contains information about the symmetry classes of the atoms
-              that a is bound to
-              ii. This label will be different for two atoms that were originally the same 
-              symmetry class but are bound to atoms of differing symmetry classes
-    """
-    idx2index = dict()
-    index = 0
-    del tmp_classes[:]
-    for s in symmetry_classes:
-        idx2index.update({s[0].GetIdx() : index})
-        index = index + 1
-    for s in symmetry_classes:
-        iterbond = openbabel.OBMolBondIter(pmol)
-        atom = s[0]
-        idatom = s[1]
-        nbridx =  0
-        vtmp = []
-        for b in iterbond:
-            #if atom belongs to bond b
-            if atom.GetIdx() == b.GetEndAtomIdx() or atom.GetIdx() == b.GetBeginAtomIdx():
-                if(atom.GetIdx() == b.GetEndAtomIdx()):
-                    nbridx = b.GetBeginAtomIdx()
-                elif(atom.GetIdx() == b.GetBeginAtomIdx()):
-                    nbridx = b.GetEndAtomIdx()
-                if(frag_atoms.BitIsOn(nbridx)):
-                    vtmp.append(symmetry_classes[idx2index[nbridx]][1])
-        vtmp.sort()
-        m = 100
-        for v in vtmp:
-            idatom = idatom + v * m
-            m = 100 * m
-        tmp_classes.append([atom,idatom])
-
-def find_tor_restraint_idx(mol,b1,b2):
+    1. For each atom a, make a label from its own class and the classes of its neighbors:
+       (# of neighbors, neighbor classes from highest to lowest, class of a)
+       This label will be different for two atoms that were originally the same 
+       symmetry class but are bound to atoms of differing symmetry classes
+    2. Number the distinct labels in sorted order; equal labels are found by hashing
+    The order of the labels is that of the number
+        class of a + (1st neighbor class) * 100 + (2nd neighbor class) * 100^2 + ...
+    (neighbor classes from lowest to highest) that was used as the label before, as long
+    as there are fewer than 100 classes. That number grows without bound with the
+    number of neighbors and mixes up classes from 100 on; the tuple does neither.
+    """
+    labels = []
+    for i in range(len(symmetry_classes)):
+        nbrcls = sorted([symmetry_classes[j] for j in nbrlist[nbrstart[i]:nbrstart[i+1]]],
+                        reverse=True)
+        labels.append((len(nbrcls), tuple(nbrcls), symmetry_classes[i]))
+    label2class = {}
+    for (i, label) in enumerate(sorted(set(labels))):
+        label2class[label] = i + 1
+    return [label2class[label] for label in labels]
+
+def find_tor_restraint_idx(session, mol,b1,b2):
     """
     Intent: Find the atoms 1 and 4 about which torsion angles are restrained
     Given b1, b2, finds the torsion: t1 b1 b2 t4
@@ -1838,14 +2290,14 @@ def find_tor_restraint_idx(mol,b1,b2):
     b1nbridx = [x.GetIdx() for x in iteratomatom]
     del b1nbridx[b1nbridx.index(b2idx)]    # Remove b2 from list
     assert(b1nbridx is not [])
-    maxb1class = max(b1nbridx, key=get_symm_class)
+    maxb1class = max(b1nbridx, key=lambda idx: get_symm_class(session, idx))
     #print b1idx, b1nbridx
 
     iteratomatom = openbabel.OBAtomAtomIter(b2)
     b2nbridx = [x.GetIdx() for x in iteratomatom]
     del b2nbridx[b2nbridx.index(b1idx)]    # Remove b1 from list
     assert(b2nbridx is not [])
-    maxb2class = max(b2nbridx, key=get_symm_class)
+    maxb2class = max(b2nbridx, key=lambda idx: get_symm_class(session, idx))
     #print b2idx, b2nbridx
 
     t1 = mol.GetAtom(maxb1class)
@@ -1854,7 +2306,28 @@ def find_tor_restraint_idx(mol,b1,b2):
 
     return t1,t4
 
-def get_torlist(mol):
+def find_missed_torsions(session, mol):
+    """
+    Intent: Find the torsions that have no parameters in the look up table (valence.py)
+    Input:
+        mol: An openbabel molecule structure
+    Output:
+        missed_torsions: set of (a,b,c,d) atom index tuples, as returned by Valence.get_mt
+    Referenced By: get_torlist
+    Description:
+    Runs the torsion SMARTS search of Valence.torguess once for the whole molecule, with
+    every atom as its own class, so that rotatable bonds can be looked up in the result
+    """
+    v1 = valence.Valence(session.output_format)
+    idxtoclass = []
+    for i in range(mol.NumAtoms()):
+        idxtoclass.append(i+1)
+    v1.setidxtoclass(idxtoclass)
+    # dorot is set as false in valence.py
+    v1.torguess(mol,False,[])
+    return set(tuple(tor) for tor in v1.get_mt())
+
+def get_torlist(session, mol):
     """
     Intent: Find unique rotatable bonds.
     Input:
@@ -1870,13 +2343,15 @@ def get_torlist(mol):
         a. Check 'IsRotor()' (is the bond rotatable?)
         b. Find the atoms 1 and 4 (of the highest possible sym_class) of a possible torsion about atoms t2 and t3 of the rotatable bond (calls find_tor_restraint_idx)
         c. Check if this torsion is in user provided toromitlist
-        d. Check if this torsion is found in the look up table
+        d. Check if this torsion is found in the look up table (the torsions that are not
+           are found once for the whole molecule by find_missed_torsions)
         e. If it neither c nor d are true, then append this torsion to 'rotbndlist' for future torsion scanning
         f. Find other possible torsions around the bond t2-t3 and repeat steps c through e
     """
 
     torlist = []
     rotbndlist = {}
+    missed_torsions = find_missed_torsions(session, mol)
 
     iterbond = openbabel.OBMolBondIter(mol)
     for bond in iterbond:
@@ -1885,22 +2360,14 @@ def get_torlist(mol):
             skiptorsion = False
             t2 = bond.GetBeginAtom()
             t3 = bond.GetEndAtom()
-            t1,t4 = find_tor_restraint_idx(mol,t2,t3)
+            t1,t4 = find_tor_restraint_idx(session, mol,t2,t3)
             # is the torsion in toromitlist
-            if(omittorsion2 and sorttorsion([t1.GetIdx(),t2.GetIdx(),t3.GetIdx(),t4.GetIdx()]) in toromit_list):
+            if(session.omittorsion2 and sorttorsion([t1.GetIdx(),t2.GetIdx(),t3.GetIdx(),t4.GetIdx()]) in session.toromit_list):
                 skiptorsion = True
 
             #Check to see if the torsion was found in the look up table or not
             #This decides whether it needs to be scanned for or not
-            v1 = valence.Valence(output_format)
-            idxtoclass = []
-            for i in range(mol.NumAtoms()):
-                idxtoclass.append(i+1)
-            v1.setidxtoclass(idxtoclass)
-            # dorot is set as false in valence.py
-            v1.torguess(mol,False,[])
-            missed_torsions = v1.get_mt()
-            if(not sorttorsion([t1.GetIdx(),t2.GetIdx(),t3.GetIdx(),t4.GetIdx()]) in missed_torsions):
+            if(not tuple(sorttorsion([t1.GetIdx(),t2.GetIdx(),t3.GetIdx(),t4.GetIdx()])) in missed_torsions):
                 skiptorsion = True
 
             rotbndkey = '%d %d' % (t2.GetIdx(), t3.GetIdx())
@@ -1910,11 +2377,11 @@ def get_torlist(mol):
                 tor = mol.GetTorsion(t1,t2,t3,t4)
                 torlist.append([t1,t2,t3,t4,tor % 360])
                 # store torsion in rotbndlist
-                rotbndlist[rotbndkey].append(get_uniq_rotbnd(
+                rotbndlist[rotbndkey].append(get_uniq_rotbnd(session, 
                         t1.GetIdx(),t2.GetIdx(),
                         t3.GetIdx(),t4.GetIdx()))
                 # write out rotatable bond to log
-                logfh.write('Rotatable bond found about %s\n' %
+                session.logfh.write('Rotatable bond found about %s\n' %
                 str(rotbndlist[rotbndkey][0]))
             else:
                 continue
@@ -1933,7 +2400,7 @@ def get_torlist(mol):
                              iaa2.GetIdx() != t2.GetIdx()) \
                         and not (iaa.GetIdx() == t1.GetIdx() and \
                              iaa2.GetIdx() == t4.GetIdx())):
-                        rotbndlist[rotbndkey].append(get_uniq_rotbnd(
+                        rotbndlist[rotbndkey].append(get_uniq_rotbnd(session, 
                             iaa.GetIdx(),t2.GetIdx(),
                             t3.GetIdx(),iaa2.GetIdx()))
     return (torlist ,rotbndlist)
@@ -1946,18 +2413,50 @@ def get_torlist_opt_angle(optmol, torlist):
         tmplist.append([a,b,c,d,e % 360])
     return tmplist
 
-def gen_tinker5_to_4_convert_input(mol, amoeba_conv_spec_fname):
-    outfh = open(amoeba_conv_spec_fname,'w')
+def dedup_torlist(session, torlist):
+    """
+    Intent: Keep one torsion of each group of torsions that are equivalent by symmetry
+    Input:
+        torlist: list of [a,b,c,d,angle] with the dihedral angles of the optimized structure
+    Output:
+        scantorlist: the torsions in torlist that need a torsion scan
+    Referenced By: main
+    Description:
+    Two torsions are equivalent if they have the same class key (see get_class_key) and
+    their optimized dihedral angles differ by at most 'torduptol' degrees. Their QM and MM
+    profiles vs. phase angle are then the same, and get_qmmm_rot_bond_energy would only
+    average them, so the first one stands for the group. A mirror image rotor (angle
+    -angle) is not merged, since its profile runs the other way.
+    If 'tordedup' is False, all of torlist is returned.
+    """
+    if not session.tordedup:
+        return list(torlist)
+    scantorlist = []
+    for tor in torlist:
+        a,b,c,d = tor[0:4]
+        clskey = get_class_key(session, a,b,c,d)
+        for scantor in scantorlist:
+            if get_class_key(session, *scantor[0:4]) == clskey and \
+               abs((tor[4] - scantor[4] + 180) % 360 - 180) <= torduptol:
+                session.logfh.write('Torsion %d-%d-%d-%d is equivalent to %d-%d-%d-%d, not scanned\n' %
+                    (a,b,c,d,scantor[0],scantor[1],scantor[2],scantor[3]))
+                break
+        else:
+            scantorlist.append(tor)
+    return scantorlist
+
+def gen_tinker5_to_4_convert_input(session, mol, amoeba_conv_spec_fname):
+    outfh = open(session.path(amoeba_conv_spec_fname),'w')
     class_numH_dict = {}
     for atm in openbabel.OBMolAtomIter(mol):
         num_hydrogen = atm.GetValence() - atm.GetHvyValence()
         if not atm.IsHydrogen() and atm.GetValence() > 1:
-            class_numH_dict[get_class_number(atm.GetIdx())] = num_hydrogen
+            class_numH_dict[get_class_number(session, atm.GetIdx())] = num_hydrogen
 
     for (cls, nh) in class_numH_dict.items():
         outfh.write( str(cls) + " " + str(nh) + "\n")
 
-def tor_opt_sp(molecprefix,a,b,c,d,optmol,consttorlist,phaseangle,prevstrctfname):
+def tor_opt_sp(session, molecprefix,a,b,c,d,optmol,consttorlist,phaseangle,prevstrctfname,jobnproc=None,jobmem=None):
     """
     Intent: Restrain the torsion to the dihedral angle given (using tinker Minimize tool). 
     Use Gaussian SP calculation to find the new energy. If wanted, Gaussian optimization is done
@@ -1974,6 +2473,8 @@ def tor_opt_sp(molecprefix,a,b,c,d,optmol,consttorlist,phaseangle,prevstrctfname
         prevstrctfname: file containing the current coordinates of the molecule
                         i.e. the coordinates of the molecule fixed at the previous torsion value
                         This is done so that the restraining is done only 30 degrees at a time
+        jobnproc: number of processors for the Gaussian jobs (default: 'numproc')
+        jobmem: max memory size for the Gaussian jobs (default: 'maxmem')
     Output:
         prevstrctfname: file name containing the latest coordinates (post torsion restraint)
         many *.log, *.com, and *.chk files are generated for and by Gaussian
@@ -2001,41 +2502,41 @@ def tor_opt_sp(molecprefix,a,b,c,d,optmol,consttorlist,phaseangle,prevstrctfname
     toroptcomfname = ""
     strctfname = ""
     # come here if you would like to run Gaussian Optimization post restraint but before SP
-    if do_tor_qm_opt:
+    if session.do_tor_qm_opt:
         # make the opt com file
         toroptcomfname = '%s-opt-%d-%d-%d-%d-%03d.com' % (molecprefix,a,b,c,d,round((torang+phaseangle)%360))
         strctfname = os.path.splitext(toroptcomfname)[0] + '.log'
-    if do_tor_qm_opt and not is_qm_normal_termination(strctfname):
+    if session.do_tor_qm_opt and not is_qm_normal_termination(session, strctfname):
         # make the opt chk
         toroptchkfname = os.path.splitext(toroptcomfname)[0] + '.chk'
-        if os.path.isfile(toroptchkfname):
-            os.remove(toroptchkfname)
+        if os.path.isfile(session.path(toroptchkfname)):
+            os.remove(session.path(toroptchkfname))
         # load prevstruct
-        prevstruct = load_structfile(prevstrctfname)
+        prevstruct = load_structfile(session.path(prevstrctfname))
         
         # create xyz and key and write restraint then minimize, getting .xyz_2
         torxyzfname = '%s-%d-%d-%d-%d-%03d-t.xyz' % (molecprefix,a,b,c,d,round((torang+phaseangle)%360))
         tmpkeyfname = 'tmp-%d-%d-%d-%d-%03d-t.key' % (a,b,c,d,round((torang+phaseangle)%360))
-        save_structfile(prevstruct,torxyzfname)
-        shutil.copy('../'+key4fname, tmpkeyfname)
-        tmpkeyfh = open(tmpkeyfname,'a')
+        save_structfile(session, prevstruct,torxyzfname)
+        shutil.copy(session.path('../'+session.key4fname), session.path(tmpkeyfname))
+        tmpkeyfh = open(session.path(tmpkeyfname),'a')
         tmpkeyfh.write('restrain-torsion %d %d %d %d 10.0 %6.2f %6.2f\n' % (a,b,c,d,round((torang+phaseangle)%360),round((torang+phaseangle)%360)))
         tmpkeyfh.close()
-        mincmdstr = minimizeexe+' -k '+tmpkeyfname+' '+torxyzfname+' 0.01'
-        call_subsystem(mincmdstr)
+        mincmdstr = session.minimizeexe+' -k '+tmpkeyfname+' '+torxyzfname+' 0.01'
+        call_subsystem(session, mincmdstr)
 
         # generate the com file using *.xyz_2 which has the restraint
-        gen_torcomfile(toroptcomfname,numproc,maxmem,prevstruct,torxyzfname+'_2')
+        gen_torcomfile(session, toroptcomfname,jobnproc,jobmem,prevstruct,torxyzfname+'_2')
 
         # remove unnecessary files
         rmcmdstr = 'rm '+tmpkeyfname+'; rm '+torxyzfname+'*'
-        call_subsystem(rmcmdstr)
+        call_subsystem(session, rmcmdstr)
 
         # Append restraints to *opt*.com file
-        tmpfh = open(toroptcomfname, "a")
+        tmpfh = open(session.path(toroptcomfname), "a")
         
         # Fix all torsions around the rotatable bond b-c 
-        for resttors in rotbndlist[' '.join([str(b),str(c)])]:
+        for resttors in session.rotbndlist[' '.join([str(b),str(c)])]:
             rta,rtb,rtc,rtd = resttors
             rtang = optmol.GetTorsion(rta,rtb,rtc,rtd)
             if (optmol.GetAtom(rta).GetAtomicNum() != 1) and \
@@ -2045,7 +2546,7 @@ def tor_opt_sp(molecprefix,a,b,c,d,optmol,consttorlist,phaseangle,prevstrctfname
         # Leave all torsions around other rotatable bonds fixed
         for constangle in consttorlist:
             csa,csb,csc,csd,csangle = constangle
-            for resttors in rotbndlist[' '.join([str(csb),str(csc)])]:
+            for resttors in session.rotbndlist[' '.join([str(csb),str(csc)])]:
                 rta,rtb,rtc,rtd = resttors
                 rtang = optmol.GetTorsion(rta,rtb,rtc,rtd)
                 if (optmol.GetAtom(rta).GetAtomicNum() != 1) and \
@@ -2055,16 +2556,15 @@ def tor_opt_sp(molecprefix,a,b,c,d,optmol,consttorlist,phaseangle,prevstrctfname
 
         # Append restraint values for specific functional groups
         restraintlist = gen_function_specific_restraints(prevstruct)
-        append_restraint(restraintlist,toroptcomfname)
+        append_restraint(restraintlist,session.path(toroptcomfname))
 
-        tmpfh = open(toroptcomfname, "a")
+        tmpfh = open(session.path(toroptcomfname), "a")
         tmpfh.write("\n")
         tmpfh.close()
-        append_basisset(toroptcomfname,prevstruct.GetSpacedFormula(),optbasisset)
-        cmdstr = 'GAUSS_SCRDIR='+scrtmpdir+' '+gausexe+' '+toroptcomfname
-        call_subsystem(cmdstr,iscritical=True)
+        append_basisset(session.path(toroptcomfname),prevstruct.GetSpacedFormula(),session.optbasisset)
+        call_gaussian(session, toroptcomfname)
 
-    if do_tor_qm_opt:
+    if session.do_tor_qm_opt:
         # prevstrct becomes the opt log found above
         prevstrctfname = strctfname
 
@@ -2073,47 +2573,46 @@ def tor_opt_sp(molecprefix,a,b,c,d,optmol,consttorlist,phaseangle,prevstrctfname
     torspcomfname = '%s-m06lsp-%d-%d-%d-%d-%03d.com' % (molecprefix,a,b,c,d,round((torang+phaseangle)%360))
     torsplogfname = os.path.splitext(torspcomfname)[0] + '.log'
 
-    if not is_qm_normal_termination(torsplogfname):
+    if not is_qm_normal_termination(session, torsplogfname):
         torspchkfname = os.path.splitext(torspcomfname)[0] + '.chk'
-        if os.path.isfile(torspchkfname):
-            os.remove(torspchkfname)
+        if os.path.isfile(session.path(torspchkfname)):
+            os.remove(session.path(torspchkfname))
         # load previous *.log file
-        prevstruct = load_structfile(prevstrctfname)
+        prevstruct = load_structfile(session.path(prevstrctfname))
 
-        if not do_tor_qm_opt:
+        if not session.do_tor_qm_opt:
             # create *.xyz and *.key for tinker minimize
             torxyzfname = '%s-%d-%d-%d-%d-%03d-t.xyz' % (molecprefix,a,b,c,d,round((torang+phaseangle)%360))
             tmpkeyfname = 'tmp-%d-%d-%d-%d-%03d-t.key' % (a,b,c,d,round((torang+phaseangle)%360))
-            save_structfile(prevstruct,torxyzfname)
-            shutil.copy('../'+key4fname, tmpkeyfname)
+            save_structfile(session, prevstruct,torxyzfname)
+            shutil.copy(session.path('../'+session.key4fname), session.path(tmpkeyfname))
 
             # add restraint key word
-            tmpkeyfh = open(tmpkeyfname,'a')
+            tmpkeyfh = open(session.path(tmpkeyfname),'a')
             tmpkeyfh.write('restrain-torsion %d %d %d %d 10.0 %6.2f %6.2f\n' % (a,b,c,d,round((torang+phaseangle)%360),round((torang+phaseangle)%360)))
             tmpkeyfh.close()
 
             # minimize the structure to the restraint
-            mincmdstr = minimizeexe+' -k '+tmpkeyfname+' '+torxyzfname+' 0.01'
-            call_subsystem(mincmdstr)
+            mincmdstr = session.minimizeexe+' -k '+tmpkeyfname+' '+torxyzfname+' 0.01'
+            call_subsystem(session, mincmdstr)
 
             # generate the *.com file using the minimized *.xyz, *.xyz_2
-            gen_torcomfile(torspcomfname,numproc,maxmem,prevstruct,torxyzfname+'_2')
+            gen_torcomfile(session, torspcomfname,jobnproc,jobmem,prevstruct,torxyzfname+'_2')
         else:
-            gen_torcomfile(torspcomfname,numproc,maxmem,prevstruct,"non")
+            gen_torcomfile(session, torspcomfname,jobnproc,jobmem,prevstruct,"non")
 
         # append the proper basis set to the *.com file
-        append_basisset(torspcomfname,prevstruct.GetSpacedFormula(),m06lbasisset)
+        append_basisset(session.path(torspcomfname),prevstruct.GetSpacedFormula(),session.m06lbasisset)
 
         # run Gaussian SP on *.com file
-        cmdstr = 'GAUSS_SCRDIR='+scrtmpdir+' '+gausexe+' '+torspcomfname
-        call_subsystem(cmdstr,iscritical=True)
+        call_gaussian(session, torspcomfname)
 
         # prevstrctfname is set to the new log file created (if do_tor_qm_opt is false)
-        if not do_tor_qm_opt:
+        if not session.do_tor_qm_opt:
             prevstrctfname = torsplogfname
     return prevstrctfname
 
-def gen_torsion(mol):
+def gen_torsion(session, mol):
     """
     Intent: For each rotatable bond, rotate the torsion about that bond about 
     30 degree intervals. At each interval use Gaussian SP to find the energy of the molecule at
@@ -2125,43 +2624,205 @@ def gen_torsion(mol):
     Referenced By: main
     Description:
     1. Create and change to directory 'qm-torsion'
-    2. For each torsion in torlist (essentially, for each rotatable bond)
-        a. Rotate the torsion value by interval of 30 from 30 to 180, then -30 to -210
-        b. Find energy using Gaussian SP
-    """
-    if not os.path.isdir('qm-torsion'):
-        os.mkdir('qm-torsion')
-    os.chdir('qm-torsion')
-
-    for tor in torlist:
+    2. Split the QM cores and memory between the 'maxqmjobs' jobs that run at the same time
+    3. Build the list of (torsion, phase angle) jobs with 'gen_torsion_jobs', on a
+       'torscanstep' grid (or a 'torscancoarsestep' grid for an adaptive scan)
+    4. Run the jobs, at most 'maxqmjobs' at a time, with 'run_job_graph'
+    5. Adaptive scan: add the points asked for by 'refine_torsion_jobs' until there are none
+    The phase angles scanned for each torsion are stored in 'torphasedict'
+    """
+    if not os.path.isdir(session.path('qm-torsion')):
+        os.mkdir(session.path('qm-torsion'))
+    session.chdir('qm-torsion')
+
+    assert 180 % session.torscanstep == 0, \
+        "ERROR: Torsion scan step %d does not divide 180" % session.torscanstep
+    phaselist = list(range(0,360,session.torscanstep))
+    if session.torscanadaptive:
+        assert session.torscancoarsestep % session.torscanstep == 0 and 180 % session.torscancoarsestep == 0, \
+            "ERROR: Coarse torsion scan step %d is not a multiple of %d that divides 180" % \
+            (session.torscancoarsestep, session.torscanstep)
+        phaselist = list(range(0,360,session.torscancoarsestep))
+    for tor in session.scantorlist:
+        session.torphasedict[tuple(tor[0:4])] = list(phaselist)
+
+    njobs = max(1, min(session.maxqmjobs, get_total_qm_resources(session)[0]))
+    jobnproc, jobmem = min(plan_qm_resources(session, [1.0] * njobs))
+    session.logfh.write("Torsion scan: %d QM jobs at a time, %d processors and %s memory each\n" % (njobs, jobnproc, jobmem))
+    results = run_job_graph(gen_torsion_jobs(session, mol, jobnproc, jobmem, phaselist), njobs)
+
+    while session.torscanadaptive:
+        jobs = refine_torsion_jobs(session, mol, results, jobnproc, jobmem)
+        if not jobs:
+            break
+        results.update(run_job_graph(jobs, njobs))
+
+    session.chdir('..')
+
+def gen_torsion_jobs(session, mol, jobnproc=None, jobmem=None, phaselist=None):
+    """
+    Intent: Build the full set of (torsion, phase angle) QM jobs for the torsion scan
+    Input:
+        mol: OBMol object
+        jobnproc: number of processors for each Gaussian job
+        jobmem: max memory size for each Gaussian job
+        phaselist: phase angles in [0,360) to scan (default 0-360 in 'torscanstep' steps)
+    Output:
+        jobs: list of jobs for 'run_job_graph'. Each job calls 'tor_opt_sp' for one phase angle
+    Referenced By: gen_torsion
+    Description:
+    For each torsion in scantorlist (essentially, for each rotatable bond)
+    1. Copy *-opt.log to the starting structure file of the scan
+    2. Chain the phase angles below 180 (0, 30, ..., 150 clockwise) so that each angle
+       starts from the structure of the previous one
+    3. Chain the other phase angles (-30, ..., -180 counterclockwise) the same way,
+       starting again from the *-opt.log structure
+    The two chains of a rotatable bond, and the chains of different bonds, do not depend
+    on each other and may run at the same time.
+    """
+    if phaselist is None:
+        phaselist = list(range(0,360,session.torscanstep))
+    clockwise = sorted([phase for phase in phaselist if phase < 180])
+    counterclockwise = sorted([phase - 360 for phase in phaselist if phase >= 180], reverse=True)
+    jobs = []
+    torjob = functools.partial(tor_opt_sp, session, jobnproc=jobnproc, jobmem=jobmem)
+    for tor in session.scantorlist:
         a,b,c,d = tor[0:4]
         torang = mol.GetTorsion(a,b,c,d)
 
         # create a list of all the other rotatable bonds besides this one
-        consttorlist = list(torlist)
+        consttorlist = list(session.torlist)
         consttorlist.remove(tor)
 
-        prevstrctfname = '%s-opt-%d-%d-%d-%d-%03d.log' % (molecprefix,a,b,c,d,round(torang % 360))
+        minstrctfname = '%s-opt-%d-%d-%d-%d-%03d.log' % (session.molecprefix,a,b,c,d,round(torang % 360))
 
-        minstrctfname = prevstrctfname
-        
-        # copy *-opt.log found early by Gaussian to 'prevstrctfname'
-        cmd = 'cp ../%s %s' % (logoptfname,prevstrctfname)
-        call_subsystem(cmd)
+        # copy *-opt.log found early by Gaussian to 'minstrctfname'
+        cmd = 'cp ../%s %s' % (session.logoptfname,minstrctfname)
+        call_subsystem(session, cmd)
 
-        # run Gaussian SP on logoptfname
-        prevstrctfname = tor_opt_sp(molecprefix,a,b,c,d,mol,consttorlist,0,prevstrctfname)
-        
         # Rotate torsion clockwise, running Gaussian SP at each rotation
-        for phaseangle in range(30,180,30):
-            prevstrctfname = tor_opt_sp(molecprefix,a,b,c,d,mol,consttorlist,phaseangle,prevstrctfname)
-
         # Rotate torsion counterclockwise, running Gaussian SP at each rotation
-        prevstrctfname = minstrctfname
-        for phaseangle in range(-30,-210,-30):
-            prevstrctfname = tor_opt_sp(molecprefix,a,b,c,d,mol,consttorlist,phaseangle,prevstrctfname)
+        for chain in (clockwise, counterclockwise):
+            prevjobkey = None
+            for phaseangle in chain:
+                jobkey = (a,b,c,d,phaseangle)
+                args = (session.molecprefix,a,b,c,d,mol,consttorlist,phaseangle)
+                if prevjobkey is None:
+                    jobs.append((jobkey, [], torjob, args + (minstrctfname,)))
+                else:
+                    jobs.append((jobkey, [prevjobkey], torjob, args))
+                prevjobkey = jobkey
+    return jobs
 
-    os.chdir('..')
+def refine_torsion_jobs(session, mol, results, jobnproc=None, jobmem=None):
+    """
+    Intent: Find the extra QM jobs an adaptive torsion scan needs
+    Input:
+        mol: OBMol object
+        results: results of the scan jobs so far (job key -> structure file), from 'run_job_graph'
+        jobnproc: number of processors for each Gaussian job
+        jobmem: max memory size for each Gaussian job
+    Output:
+        jobs: list of jobs for 'run_job_graph'; empty if the scan is complete
+    Referenced By: gen_torsion
+    Description:
+    1. For each torsion in scantorlist, ask 'refine_tor_phases' for new phase angles
+    2. Give all torsions with the same class key the same phase angles, so their
+       profiles can still be averaged (see get_qmmm_rot_bond_energy)
+    3. Each new phase angle starts from the structure of its scanned neighbor closest to
+       the optimized structure; the new jobs do not depend on each other
+    4. Add the new phase angles to 'torphasedict'
+    """
+    newphasedict = {}
+    for tor in session.scantorlist:
+        a,b,c,d = tor[0:4]
+        clskey = get_class_key(session, a,b,c,d)
+        torang = mol.GetTorsion(a,b,c,d)
+        newphases = refine_tor_phases(session, a,b,c,d,torang,session.torphasedict[tuple(tor[0:4])])
+        newphasedict.setdefault(clskey, set()).update(newphases)
+
+    # structure file of each finished job, by phase angle in [0,360)
+    strctfnamedict = {}
+    for (jobkey, strctfname) in results.items():
+        strctfnamedict[(jobkey[0:4], jobkey[4] % 360)] = strctfname
+
+    jobs = []
+    torjob = functools.partial(tor_opt_sp, session, jobnproc=jobnproc, jobmem=jobmem)
+    for tor in session.scantorlist:
+        a,b,c,d = tor[0:4]
+        clskey = get_class_key(session, a,b,c,d)
+        consttorlist = list(session.torlist)
+        consttorlist.remove(tor)
+        phases = session.torphasedict[tuple(tor[0:4])]
+        for phaseangle in sorted(newphasedict[clskey] - set(phases)):
+            # scanned phase angle nearest to the optimized structure (phase 0) among the
+            # two that enclose 'phaseangle'
+            lower = max([p for p in phases if p < phaseangle] or [max(phases) - 360])
+            upper = min([p for p in phases if p > phaseangle] or [min(phases) + 360])
+            startphase = min(lower % 360, upper % 360, key=lambda p: min(p, 360 - p))
+            args = (session.molecprefix,a,b,c,d,mol,consttorlist,phaseangle,
+                    strctfnamedict[((a,b,c,d), startphase)])
+            jobs.append(((a,b,c,d,phaseangle), [], torjob, args))
+        session.torphasedict[tuple(tor[0:4])] = sorted(set(phases) | newphasedict[clskey])
+    if jobs:
+        session.logfh.write("Adaptive torsion scan: %d more QM jobs\n" % len(jobs))
+    return jobs
+
+def refine_tor_phases(session, a,b,c,d,torang,phases):
+    """
+    Intent: Pick the phase angles to add to the scan of torsion a-b-c-d
+    Input:
+        a, b, c, d: atoms in the torsion of interest
+        torang: dihedral angle of the optimized structure
+        phases: phase angles in [0,360) scanned so far
+    Output:
+        newphases: set of phase angles to add; each is the middle of an interval of the
+                   current grid, and a multiple of 'torscanstep'
+    Referenced By: refine_torsion_jobs
+    Description:
+    1. Read the QM energies of the scanned phase angles (compute_qm_tor_energy)
+    2. Fit a constant plus cos(n*phase) terms for n in nfoldlist (the form of tor_func_term;
+       phase 0 is the optimized structure) to the profile
+    3. Split the intervals next to a point that deviates from the fit by more than
+       'torrefinetol' kcal/mol
+    4. Split the intervals next to a point where the curvature of the profile is more than
+       'torrefinecurv' kcal/mol/rad^2
+    Points whose energy could not be found are left out.
+    """
+    phases = sorted(phases)
+    energies = []
+    for phaseangle in phases:
+        energy_list,angle_list = compute_qm_tor_energy(session, a,b,c,d,torang,[phaseangle])
+        energies.append(energy_list[0])
+    points = [(p, e) for (p, e) in zip(phases, energies) if e is not None]
+    newphases = set()
+    if len(points) < 3:
+        return newphases
+    x = numpy.radians([p for (p, e) in points])
+    y = numpy.array([e for (p, e) in points])
+    y -= min(y)
+
+    flagged = set()
+    A = numpy.array([[1.0] + [cos(nfold*xx) for nfold in nfoldlist] for xx in x])
+    if len(points) > A.shape[1]:
+        coef = numpy.linalg.lstsq(A, y, rcond=None)[0]
+        flagged.update(numpy.nonzero(numpy.abs(numpy.dot(A, coef) - y) > session.torrefinetol)[0])
+    npoints = len(points)
+    for i in range(npoints):
+        h1 = (x[i] - x[i-1]) % (2*pi)
+        h2 = (x[(i+1) % npoints] - x[i]) % (2*pi)
+        curv = 2*((y[(i+1) % npoints] - y[i])/h2 - (y[i] - y[i-1])/h1)/(h1 + h2)
+        if abs(curv) > session.torrefinecurv:
+            flagged.add(i)
+
+    # split the intervals on both sides of each flagged point
+    for i in flagged:
+        for (p1, p2) in ((points[i-1][0], points[i][0]), (points[i][0], points[(i+1) % npoints][0])):
+            width = (p2 - p1) % 360
+            midpoint = (p1 + (width // (2*session.torscanstep)) * session.torscanstep) % 360
+            if width >= 2*session.torscanstep and midpoint not in phases:
+                newphases.add(midpoint)
+    return newphases
 
 def opbset (smarts, opbval, opbhash, mol):
     """
@@ -2183,7 +2844,7 @@ def opbset (smarts, opbval, opbhash, mol):
                 if opbkey not in opbhash:
                     opbhash[opbkey] = [defopbendval, False]
 
-def gen_valinfile (mol):
+def gen_valinfile (session, mol):
     """
     Intent: Find aromatic carbon and bonded hydrogens to correct polarizability
     Find out-of-plane bend values using a look up table
@@ -2198,7 +2859,7 @@ def gen_valinfile (mol):
     Description: -
     """
     #Find aromatic carbon and bonded hydrogens to correct polarizability
-    f = open (valinfile, 'w')
+    f = open (session.path(session.valinfile), 'w')
     iteratom = openbabel.OBMolAtomIter(mol)
     for a in iteratom:
         if (a.GetAtomicNum() == 6 and a.IsAromatic()):
@@ -2292,7 +2953,7 @@ def gen_valinfile (mol):
     f.write("\n")
 
     rotbndprmlist = []
-    for rotbnd in list(rotbndlist.values()):
+    for rotbnd in list(session.rotbndlist.values()):
         for rotbndprm in rotbnd:
             rotlist=list(rotbndprm)
             rotbndprmlist.append(rotlist)
@@ -2301,15 +2962,15 @@ def gen_valinfile (mol):
     f.close()
     return list(opbhash.items()),rotbndprmlist
 
-def gen_superposeinfile():
+def gen_superposeinfile(session):
     """
     Intent: Initialize superpose input file (for tinker's superpose) 
     """
-    f = open(superposeinfile, 'w')
+    f = open(session.path(session.superposeinfile), 'w')
     f.write('\n\n\n\n\n')
 
 # Create file to specify groups of atoms based on molecular symmetry
-def gen_avgmpole_groups_file():
+def gen_avgmpole_groups_file(session):
     """
     Intent: Print out *-groups.txt which is a map from symm class to idx
     Also, symm class labels are altered from 1, 2, 3, ... to 401, 402, ...
@@ -2320,13 +2981,13 @@ def gen_avgmpole_groups_file():
     Referenced By: main
     Description: -
     """
-    symgroups = [None] * max(symmetryclass)
+    symgroups = [None] * max(session.symmetryclass)
     for i in range(0,len(symgroups)):
         symgroups[i] = []
-        symgroups[i].append(prmstartidx + (max(symmetryclass) - i - 1))
-    for symclsidx in range(0,len(symmetryclass)):
-        symgroups[symmetryclass[symclsidx]-1].append(symclsidx+1)
-    f = open(grpfname,"w")
+        symgroups[i].append(session.prmstartidx + (max(session.symmetryclass) - i - 1))
+    for symclsidx in range(0,len(session.symmetryclass)):
+        symgroups[session.symmetryclass[symclsidx]-1].append(symclsidx+1)
+    f = open(session.path(session.grpfname),"w")
     symgroups.sort()
     for ii in symgroups:
         #print ii
@@ -2335,7 +2996,7 @@ def gen_avgmpole_groups_file():
         f.write("\n")
     f.close()
 
-def gen_esp_grid():
+def gen_esp_grid(session):
     """
     Intent: Find the QM Electrostatic Potential Grid which can be used for multipole fitting
     Input:
@@ -2354,27 +3015,27 @@ def gen_esp_grid():
        Outputs *.cube_2
     """
     # Create a *.grid file which is an input file for Gaussian CUBEGEN
-    if not os.path.isfile(espgrdfname):
-        gengridcmd = potentialexe + " 1 " + xyzfname
-        call_subsystem(gengridcmd)
+    if not os.path.isfile(session.path(session.espgrdfname)):
+        gengridcmd = session.potentialexe + " 1 " + session.xyzfname
+        call_subsystem(session, gengridcmd)
     #    shutil.move(xyzoutfile,espgrdfname)
     # Run CUBEGEN
-    if not os.path.isfile(qmespfname):
-        fckfname = fckespfname
-        if not espfit:
-            fckfname = fckdmafname
+    if not os.path.isfile(session.path(session.qmespfname)):
+        fckfname = session.fckespfname
+        if not session.espfit:
+            fckfname = session.fckdmafname
 
-        if not os.path.isfile(fckfname):
+        if not os.path.isfile(session.path(fckfname)):
             fckfname = os.path.splitext(fckfname)[0]
 
-        assert os.path.isfile(fckfname), "Error: " + fckfname + " does not exist."
-        gencubecmd = cubegenexe + " 0 potential=SCF " + fckfname + " " + \
-                     qmespfname + " -5 h < " + espgrdfname
-        call_subsystem(gencubecmd,iscritical=True)
+        assert os.path.isfile(session.path(fckfname)), "Error: " + fckfname + " does not exist."
+        gencubecmd = session.cubegenexe + " 0 potential=SCF " + fckfname + " " + \
+                     session.qmespfname + " -5 h < " + session.espgrdfname
+        call_subsystem(session, gencubecmd,iscritical=True)
     # Run potential
-    if not os.path.isfile(qmesp2fname):
-        genqmpotcmd = potentialexe + " 2 " + qmespfname
-        call_subsystem(genqmpotcmd,iscritical=True)
+    if not os.path.isfile(session.path(session.qmesp2fname)):
+        genqmpotcmd = session.potentialexe + " 2 " + session.qmespfname
+        call_subsystem(session, genqmpotcmd,iscritical=True)
 
 def insert_torprmdict_angle(angle, angledict):
     """
@@ -2457,7 +3118,49 @@ def fitfunc (parms, x, torprmdict, debug = False):
     tor_energy += offset
     return tor_energy
 
-def compute_qm_tor_energy(a,b,c,d,startangle,phase_list = None):
+def tor_term_basis(x, torprmdict):
+    """
+    Intent: Energy profile of each torsion term about one rotatable bond, for a unit parameter
+    Input:
+        x: angle list in radians
+        torprmdict: contains information about the torsions (like phasedict)
+    Output:
+        basis: maps (class key, nfold) to the energy profile of that term over 'x'
+    Referenced By: fit_rot_bond_tors
+    Description: Sums 'tor_func_term' with a parameter of 1.0 over the dihedral angles in phasedict
+    """
+    basis = {}
+    for (clskey, torprm) in torprmdict.items():
+        for nfold in nfoldlist:
+            term = numpy.zeros(len(x))
+            for clsangle, clscnt in list(torprm['phasedict'].items()):
+                term += tor_func_term(
+                    1.0, x, nfold, clscnt, rads(clsangle),
+                    rads(foldoffsetlist[nfold-1]))
+            basis[(clskey, nfold)] = term
+    return basis
+
+def tor_design_matrix(npoints, basis, torprmdict, prmidx):
+    """
+    Intent: Design matrix A of the torsion fit, such that fitfunc(p, x, torprmdict) == A.p
+    Input:
+        npoints: number of angles in the fit
+        basis: energy profile of each term, from 'tor_term_basis'
+        torprmdict: contains the parameter index of each term (prmdict)
+        prmidx: number of parameters, including the offset
+    Output:
+        A: npoints x prmidx array; the last column is the offset
+    Referenced By: fit_rot_bond_tors
+    Description: Terms that share a parameter index (see insert_torprmdict) add up in one column
+    """
+    A = numpy.zeros((npoints, prmidx))
+    A[:,-1] = 1.0
+    for (clskey, torprm) in torprmdict.items():
+        for nfold in torprm['prmdict']:
+            A[:,torprm['prmdict'][nfold]] += basis[(clskey, nfold)]
+    return A
+
+def compute_qm_tor_energy(session, a,b,c,d,startangle,phase_list = None):
     """
     Intent: Store the QM Energies (vs. Dihedral Angle) found in 'gen_torsion' in a list
     Input:
@@ -2482,9 +3185,9 @@ def compute_qm_tor_energy(a,b,c,d,startangle,phase_list = None):
     energy_dict = {}
     for phaseangle in phase_list:
         angle = (startangle + phaseangle) % 360
-        minstrctfname = '%s-m06lsp-%d-%d-%d-%d-%03d.log' % (molecprefix,a,b,c,d,round(angle))
-        tmpstrct = load_structfile(minstrctfname)
-        tmpfh = open(minstrctfname, 'r')
+        minstrctfname = '%s-m06lsp-%d-%d-%d-%d-%03d.log' % (session.molecprefix,a,b,c,d,round(angle))
+        tmpstrct = load_structfile(session.path(minstrctfname))
+        tmpfh = open(session.path(minstrctfname), 'r')
         tor_energy = None
         for line in tmpfh:
 #            m = re.search(r'E\(RM06L\) =\s+(\-*\d+\.\d+)',line)
@@ -2502,7 +3205,7 @@ def compute_qm_tor_energy(a,b,c,d,startangle,phase_list = None):
     rows = list(zip(*rows))
     return list(rows[1]),list(rows[0])
 
-def compute_mm_tor_energy(a,b,c,d,startangle,phase_list = None,keyfile = None):
+def compute_mm_tor_energy(session, a,b,c,d,startangle,phase_list = None,keyfile = None):
     """
     Intent: Use tinker analyze to find the Pre-fit MM Energy vs. Dihedral Angle profile
     Input:
@@ -2521,30 +3224,40 @@ def compute_mm_tor_energy(a,b,c,d,startangle,phase_list = None,keyfile = None):
     Description:
     1. For each phase offset
         a. Restrain the dihedral angle at (startangle + phaseangle)
-        b. Run tinker analyze (for this new restraint)
-        c. Read in and store the energy
+        b. Set up tinker analyze (for this new restraint)
+    2. Run all tinker analyze jobs, one per core given to poltype
+    3. Read in and store the energies
+    With 'mmbatchanalyze' set, steps 1b-3 are replaced by one tinker analyze run on
+    all conformers (see batch_analyze_tor_energy).
     """
     if phase_list is None:
         phase_list = list(range(0,360,30))
     energy_list = []
     torse_list = []
     angle_list = []
+    alzcmdstrs = []
+    toralzfnames = []
+    torxyzfnames = []
 
     for phaseangle in phase_list:
         angle = (startangle + phaseangle) % 360
-        minstrctfname = '%s-m06lsp-%d-%d-%d-%d-%03d.log' % (molecprefix,a,b,c,d,round(angle))
-        tmpstrct = load_structfile(minstrctfname)
-        torxyzfname = '%s-%d-%d-%d-%d-%03d.xyz' % (molecprefix,a,b,c,d,round(angle))
-        tmpkeyfname = 'tmp-%d-%d-%d-%d-%03d_%d.key' % (a,b,c,d,round(angle),mm_tor_count)
-        result = save_structfile(tmpstrct, torxyzfname)
+        minstrctfname = '%s-m06lsp-%d-%d-%d-%d-%03d.log' % (session.molecprefix,a,b,c,d,round(angle))
+        tmpstrct = load_structfile(session.path(minstrctfname))
+        torxyzfname = '%s-%d-%d-%d-%d-%03d.xyz' % (session.molecprefix,a,b,c,d,round(angle))
+        tmpkeyfname = 'tmp-%d-%d-%d-%d-%03d_%d.key' % (a,b,c,d,round(angle),session.mm_tor_count)
+        result = save_structfile(session, tmpstrct, torxyzfname)
+        torxyzfnames.append(torxyzfname)
+        angle_list.append(angle)
+        if session.mmbatchanalyze:
+            continue
         toralzfname = os.path.splitext(torxyzfname)[0] + '.alz'
         if keyfile:
-            shutil.copy(keyfile, tmpkeyfname)
-            tmpkeyfh = open(tmpkeyfname,'a')
+            shutil.copy(session.path(keyfile), session.path(tmpkeyfname))
+            tmpkeyfh = open(session.path(tmpkeyfname),'a')
             # fix the current dihedral at the angle found above (init + phase_offset)
             tmpkeyfh.write('restrain-torsion %d %d %d %d 10.0 %6.2f %6.2f\n' % (a,b,c,d,angle,angle))
             # fix the other rotatable bonds where they are currently at
-            for res in torlist:
+            for res in session.torlist:
                 resa,resb,resc,resd = res[0:4]
                 if (a,b,c,d) != (resa,resb,resc,resd):
                     tmpkeyfh.write('restrain-torsion %d %d %d %d 10.0\n' % (resa,resb,resc,resd))
@@ -2552,27 +3265,23 @@ def compute_mm_tor_energy(a,b,c,d,startangle,phase_list = None,keyfile = None):
 
         if not keyfile:
             #mincmdstr=minimizeexe+' '+torxyzfname+' 0.01'
-            alzcmdstr=analyzeexe+' '+torxyzfname+' ed > %s' % toralzfname
+            alzcmdstr=session.analyzeexe+' '+torxyzfname+' ed > %s' % toralzfname
         else:
             #mincmdstr=minimizeexe+' -k '+tmpkeyfname+' '+torxyzfname+' 0.01'
-            alzcmdstr=analyzeexe+' -k '+tmpkeyfname+' '+torxyzfname+' ed > %s' % toralzfname
-        #call_subsystem(mincmdstr)
-        call_subsystem(alzcmdstr)
+            alzcmdstr=session.analyzeexe+' -k '+tmpkeyfname+' '+torxyzfname+' ed > %s' % toralzfname
+        alzcmdstrs.append(alzcmdstr)
+        toralzfnames.append(toralzfname)
 
-        tmpfh = open(toralzfname, 'r')
-        tot_energy = None
-        tor_energy = None
-        for line in tmpfh:
-            m = re.search(r'Potential Energy :\s+(\-*\d+\.\d+)',line)
-            if not m is None:
-                tot_energy = float(m.group(1))
-            m = re.search(r'Torsional Angle\s+(\-*\d+\.\d+)',line)
-            if not m is None:
-                tor_energy = float(m.group(1))
-        tmpfh.close()
-        energy_list.append(tot_energy)
-        torse_list.append(tor_energy)
-        angle_list.append(angle)
+    if session.mmbatchanalyze:
+        energy_list,torse_list = batch_analyze_tor_energy(session, a,b,c,d,torxyzfnames,keyfile)
+    else:
+        call_subsystems(session, alzcmdstrs, get_total_qm_resources(session)[0])
+        for toralzfname in toralzfnames:
+            tmpfh = open(session.path(toralzfname), 'r')
+            tot_energy,tor_energy = read_analyze_energies(tmpfh)
+            tmpfh.close()
+            energy_list.append(tot_energy)
+            torse_list.append(tor_energy)
     if None in energy_list:
         errstr = ['Cannot analyze XYZ file for torsion %d-%d-%d-%d'%(a,b,c,d), energy_list,angle_list]
 
@@ -2581,6 +3290,249 @@ def compute_mm_tor_energy(a,b,c,d,startangle,phase_list = None,keyfile = None):
     rows = list(zip(*rows))
     return list(rows[1]),list(rows[0]),list(rows[2])
 
+def batch_analyze_tor_energy(session, a,b,c,d,torxyzfnames,keyfile = None):
+    """
+    Intent: Find the MM energies of all conformers of a torsion scan with one tinker analyze run
+    Input:
+        a, b, c, d: atoms in the torsion of interest
+        torxyzfnames: tinker xyz files of the conformers
+        keyfile: keyfile for tinker analyze
+    Output:
+        energy_list: total potential energy of each conformer
+        torse_list: torsional energy of each conformer
+    Referenced By: compute_mm_tor_energy
+    Description:
+    1. Write all conformers into one archive (*.arc) file
+    2. Run tinker analyze once on the archive
+    3. Split the output at the 'Analysis for Archive Structure' lines (there is none
+       before the first structure) and read the energies of each structure
+    Unlike compute_mm_tor_energy, no torsion restraints are added to the key file: they
+    would be set up from the first structure only. Since analyze does not move the atoms
+    and each QM structure sits at its restrained angles, they add nothing to the energy.
+    """
+    torarcfname = '%s-%d-%d-%d-%d.arc' % (session.molecprefix,a,b,c,d)
+    toralzfname = os.path.splitext(torarcfname)[0] + '.alz'
+    arcfh = open(session.path(torarcfname),'w')
+    for torxyzfname in torxyzfnames:
+        xyzfh = open(session.path(torxyzfname),'r')
+        arcfh.write(xyzfh.read())
+        xyzfh.close()
+    arcfh.close()
+
+    if not keyfile:
+        alzcmdstr=session.analyzeexe+' '+torarcfname+' ed > %s' % toralzfname
+    else:
+        alzcmdstr=session.analyzeexe+' -k '+keyfile+' '+torarcfname+' ed > %s' % toralzfname
+    call_subsystem(session, alzcmdstr)
+
+    framelines = [[] for torxyzfname in torxyzfnames]
+    frameidx = 0
+    tmpfh = open(session.path(toralzfname), 'r')
+    for line in tmpfh:
+        m = re.search(r'Analysis for Archive Structure :\s+(\d+)',line)
+        if not m is None:
+            frameidx = int(m.group(1)) - 1
+        elif frameidx < len(framelines):
+            framelines[frameidx].append(line)
+    tmpfh.close()
+
+    energy_list = []
+    torse_list = []
+    for lines in framelines:
+        tot_energy,tor_energy = read_analyze_energies(lines)
+        energy_list.append(tot_energy)
+        torse_list.append(tor_energy)
+    return energy_list,torse_list
+
+def read_analyze_energies(lines):
+    """
+    Intent: Read the total potential energy and the torsional energy from tinker analyze output
+    Input:
+        lines: lines of 'analyze ... ed' output for one structure
+    Output:
+        tot_energy: total potential energy (None if not found)
+        tor_energy: torsional energy (None if not found)
+    Referenced By: compute_mm_tor_energy, batch_analyze_tor_energy
+    """
+    tot_energy = None
+    tor_energy = None
+    for line in lines:
+        m = re.search(r'Potential Energy :\s+(\-*\d+\.\d+)',line)
+        if not m is None:
+            tot_energy = float(m.group(1))
+        m = re.search(r'Torsional Angle\s+(\-*\d+\.\d+)',line)
+        if not m is None:
+            tor_energy = float(m.group(1))
+    return tot_energy,tor_energy
+
+def read_key_torsions(session, keyfname):
+    """
+    Intent: Read the torsion parameters in a tinker key file
+    Input:
+        keyfname: key file name
+    Output:
+        torprms: dict mapping the class key (ordered as in 'get_class_key') to a
+                 list of (amplitude, phase in degrees, nfold) terms
+        torsionunit: 'torsionunit' from the key file or else from 'paramhead'
+    Referenced By: postfit_mm_tor_energy
+    Description:
+    If the key file turns the torsion term off ('torsionterm none'), no parameters are
+    returned, as tinker would then not use them either.
+    """
+    torprms = {}
+    torsionunit = None
+    torsionterm = True
+    keyf = tinkerkey.KeyFile.read(session.path(keyfname))
+    for term in keyf.terms:
+        linarr = term.fields
+        keyword = term.keyword
+        if keyword == 'torsionunit':
+            torsionunit = float(linarr[1])
+        elif keyword == 'torsionterm':
+            torsionterm = len(linarr) == 1 or linarr[1].lower() != 'none'
+        elif keyword == 'torsion':
+            cla,clb,clc,cld = [int(x) for x in linarr[1:5]]
+            if ((clb > clc) or (clb == clc and cla > cld)):
+                cla,clb,clc,cld = cld,clc,clb,cla
+            clskey = '%d %d %d %d' % (cla,clb,clc,cld)
+            torprms[clskey] = [(float(linarr[i]),float(linarr[i+1]),int(linarr[i+2]))
+                               for i in range(5,len(linarr)-2,3)]
+    if torsionunit is None:
+        torsionunit = get_prm_torsionunit(session.paramhead)
+    if not torsionterm:
+        torprms = {}
+    return torprms,torsionunit
+
+def get_prm_torsionunit(prmfname):
+    """
+    Intent: Return the 'torsionunit' of the parameter file 'prmfname' (1.0 if it has none)
+    Referenced By: read_key_torsions, prewarm_batch
+    Description:
+    The file is read once per process; the result is kept in 'prmtorsionunits'
+    """
+    if prmfname not in prmtorsionunits:
+        torsionunit = 1.0
+        if os.path.isfile(prmfname):
+            prmfh = open(prmfname, 'r')
+            for line in prmfh:
+                linarr = line.split()
+                if len(linarr) > 1 and linarr[0].lower() == 'torsionunit':
+                    torsionunit = float(linarr[1])
+            prmfh.close()
+        prmtorsionunits[prmfname] = torsionunit
+    return prmtorsionunits[prmfname]
+
+def read_tinker_xyz(xyzfname):
+    """
+    Intent: Read the coordinates, atom types and bonds of a tinker xyz file
+    Output:
+        coords: numpy array (natoms x 3)
+        types: list of atom types
+        neighbors: list of lists of (0-based) bonded atom indices
+    Referenced By: postfit_mm_tor_energy
+    """
+    xyzfh = open(xyzfname, 'r')
+    natoms = int(xyzfh.readline().split()[0])
+    coords = numpy.zeros((natoms,3))
+    types = []
+    neighbors = []
+    for i in range(natoms):
+        linarr = xyzfh.readline().split()
+        coords[i] = [float(x) for x in linarr[2:5]]
+        types.append(int(linarr[5]))
+        neighbors.append([int(x) - 1 for x in linarr[6:]])
+    xyzfh.close()
+    return coords,types,neighbors
+
+def tor_energy_profile(coordslist, types, neighbors, torprms, torsionunit):
+    """
+    Intent: Evaluate the tinker torsion energy of each conformer with numpy
+    Input:
+        coordslist: numpy array (nconformers x natoms x 3)
+        types: atom types (equal to the atom classes for poltype molecules)
+        neighbors: bonded atom indices of each atom
+        torprms, torsionunit: torsion parameters, as returned by 'read_key_torsions'
+    Output:
+        numpy array with the total torsion energy of each conformer
+    Referenced By: postfit_mm_tor_energy
+    Description:
+    1. List the torsions a-b-c-d of the molecule as tinker does, and their terms in 'torprms'
+    2. Find all dihedral angles of all conformers at once
+    3. Sum torsionunit*amp*(1+cos(nfold*phi-phase)) (see tor_func_term) over all terms
+    """
+    torsions = []
+    amps = []
+    phases = []
+    nfolds = []
+    for b in range(len(types)):
+        for c in neighbors[b]:
+            if c <= b:
+                continue
+            for a in neighbors[b]:
+                for d in neighbors[c]:
+                    if a == c or d == b or a == d:
+                        continue
+                    cla,clb,clc,cld = types[a],types[b],types[c],types[d]
+                    if ((clb > clc) or (clb == clc and cla > cld)):
+                        cla,clb,clc,cld = cld,clc,clb,cla
+                    clskey = '%d %d %d %d' % (cla,clb,clc,cld)
+                    for (amp, phase, nfold) in torprms.get(clskey, []):
+                        torsions.append((a,b,c,d))
+                        amps.append(amp)
+                        phases.append(radians(phase))
+                        nfolds.append(nfold)
+    if not torsions:
+        return numpy.zeros(len(coordslist))
+    torsions = numpy.array(torsions)
+    xa,xb,xc,xd = [coordslist[:,torsions[:,i]] for i in range(4)]
+    b1 = xb - xa
+    b2 = xc - xb
+    b3 = xd - xc
+    n1 = numpy.cross(b1, b2)
+    n2 = numpy.cross(b2, b3)
+    sinphi = numpy.sum(numpy.cross(n1, n2) * b2, axis=-1) / numpy.linalg.norm(b2, axis=-1)
+    cosphi = numpy.sum(n1 * n2, axis=-1)
+    phi = numpy.arctan2(sinphi, cosphi)
+    terms = numpy.array(amps) * (1.0 + numpy.cos(numpy.array(nfolds) * phi - numpy.array(phases)))
+    return torsionunit * numpy.sum(terms, axis=-1)
+
+def postfit_mm_tor_energy(session, a,b,c,d,mang_list,mm_energy_list,tor_e_list,oldkeyfname,newkeyfname):
+    """
+    Intent: Find the post-fit MM Energy vs. Dihedral Angle profile without running tinker
+    Input:
+        a, b, c, d: atoms in the torsion of interest
+        mang_list: dihedral angles of the conformers (as returned by compute_mm_tor_energy)
+        mm_energy_list: pre-fit MM energies found with 'oldkeyfname'
+        tor_e_list: pre-fit torsional energies found with 'oldkeyfname'
+        oldkeyfname: key file with the old torsion parameters
+        newkeyfname: key file with the new torsion parameters
+    Output:
+        mm2_energy_list: post-fit MM energies
+        tor_e_list2: post-fit torsional energies
+    Referenced By: eval_rot_bond_parms
+    Description:
+    The two key files only differ in their torsion parameters (see write_key_file), so the
+    post-fit energy of each conformer is its pre-fit energy plus the change in torsion
+    energy. That change is found with 'tor_energy_profile' on the conformers written by
+    compute_mm_tor_energy. Energies that could not be found (None) stay None.
+    """
+    oldprms,torsionunit = read_key_torsions(session, oldkeyfname)
+    newprms,newtorsionunit = read_key_torsions(session, newkeyfname)
+    coordslist = []
+    for angle in mang_list:
+        torxyzfname = '%s-%d-%d-%d-%d-%03d.xyz' % (session.molecprefix,a,b,c,d,round(angle))
+        coords,types,neighbors = read_tinker_xyz(session.path(torxyzfname))
+        coordslist.append(coords)
+    coordslist = numpy.array(coordslist)
+    deltas = tor_energy_profile(coordslist,types,neighbors,newprms,newtorsionunit) - \
+             tor_energy_profile(coordslist,types,neighbors,oldprms,torsionunit)
+    mm2_energy_list = []
+    tor_e_list2 = []
+    for (mm_energy, tor_energy, delta) in zip(mm_energy_list, tor_e_list, deltas):
+        mm2_energy_list.append(None if mm_energy is None else mm_energy + float(delta))
+        tor_e_list2.append(None if tor_energy is None else tor_energy + float(delta))
+    return mm2_energy_list,tor_e_list2
+
 #def find_mme_error(mme_list,current_ang_list,cumul_ang_list):
 #    dup_list = []
 #    del_list = []
@@ -2685,15 +3637,17 @@ def prune_mme_error(del_ang_list,*arr_list):
                 del a_list[del_idx]
     return 0
 
-def get_qmmm_rot_bond_energy(mol,anglist,tmpkey1basename):
+def get_qmmm_rot_bond_energy(session, mol,anglist,tmpkey1basename,tor_engy_dict = None):
     """
-    Intent: Form dicts for each torsion in torlist, mapping the torsion class key ('clskey') to 
+    Intent: Form dicts for each torsion in scantorlist, mapping the torsion class key ('clskey') to 
     an energy profile (dihedral angle vs. energy). 'cls_mm_engy_dict' maps 'clskey' to pre-fit MM 
     calculated energy profiles, 'cls_qm_engy_dict' maps 'clskey' to QM calculated energy profiles
     Input:
         mol: OBMol Structure
-        anglist: phase list. default: 0 - 360 in increments of 30
+        anglist: phase list, for torsions not in 'torphasedict'. default: 0 - 360 in increments of 30
         tmpkey1basename: key file name for tinker
+        tor_engy_dict: if given, filled with the (not averaged) profiles of each torsion in
+                       torlist: (a,b,c,d) -> (angles, qm energies, mm energies)
     Output:
         cls_mm_engy_dict: given a class key, this will provide a list of mm energies (vs. angles)
         cls_qm_engy_dict: given a class key, this will provide a list of qm energies (vs. angles)
@@ -2714,18 +3668,19 @@ def get_qmmm_rot_bond_energy(mol,anglist,tmpkey1basename):
     cls_qm_engy_dict = {}
     cls_angle_dict = {}
     clscount_dict = {}
-    for tor in torlist:
+    for tor in session.scantorlist:
         a,b,c,d = tor[0:4]
         torang = mol.GetTorsion(a,b,c,d)
+        phaselist = session.torphasedict.get(tuple(tor[0:4]), anglist)
 
         # create clskey
-        clskey = get_class_key(a,b,c,d)
+        clskey = get_class_key(session, a,b,c,d)
         # initialize dict-values (in this case lists)
         if clskey not in clscount_dict:
             clscount_dict[clskey] = 0
-            cls_mm_engy_dict[clskey] = [0]*len(anglist)
-            cls_qm_engy_dict[clskey] = [0]*len(anglist)
-            cls_angle_dict[clskey] = [0]*len(anglist)
+            cls_mm_engy_dict[clskey] = [0]*len(phaselist)
+            cls_qm_engy_dict[clskey] = [0]*len(phaselist)
+            cls_angle_dict[clskey] = [0]*len(phaselist)
 
         clscount_dict[clskey] += 1
         mme_list = []  # MM Energy before fitting to QM torsion energy
@@ -2733,9 +3688,9 @@ def get_qmmm_rot_bond_energy(mol,anglist,tmpkey1basename):
         initangle = mol.GetTorsion(a,b,c,d)
 
         # find qm, then mm energies of the various torsion values found for 'tor'
-        qme_list,qang_list = compute_qm_tor_energy(a,b,c,d,initangle,anglist)
-        mme_list,mang_list,tor_e_list = compute_mm_tor_energy(
-            a,b,c,d,initangle,anglist,tmpkey1basename)
+        qme_list,qang_list = compute_qm_tor_energy(session, a,b,c,d,initangle,phaselist)
+        mme_list,mang_list,tor_e_list = compute_mm_tor_energy(session, 
+            a,b,c,d,initangle,phaselist,tmpkey1basename)
 
         # delete members of the list where the energy was not able to be found 
         del_ang_list = find_del_list(mme_list,mang_list)
@@ -2750,6 +3705,8 @@ def get_qmmm_rot_bond_energy(mol,anglist,tmpkey1basename):
         cls_mm_engy_dict[clskey] = [ runsum+eng for runsum,
             eng in zip (cls_mm_engy_dict[clskey], mme_list)]
         cls_angle_dict[clskey] = mang_list
+        if tor_engy_dict is not None:
+            tor_engy_dict[tuple(tor[0:4])] = (list(mang_list),list(qme_list),list(mme_list))
 
     # if multiple class keys, take the average
     for clskey in clscount_dict:
@@ -2799,7 +3756,7 @@ def check_cooperative_tor_terms(clskey, nfold, angle, xvals, torprmdict):
                     return ck
     return None
 
-def insert_torphasedict (mol, toraboutbnd, torprmdict, initangle,
+def insert_torphasedict (session, mol, toraboutbnd, torprmdict, initangle,
     write_prm_dict, keyfilter = None):
     """
     Intent: Adds torsion to be fitted to torprmdict.
@@ -2827,7 +3784,7 @@ def insert_torphasedict (mol, toraboutbnd, torprmdict, initangle,
     obad = mol.GetAtom(d2)
     # create a key
     # because it is using symmetry classes instead of atom id's, tpdkey can repeat
-    tpdkey = get_class_key(a2, b2, c2, d2)
+    tpdkey = get_class_key(session, a2, b2, c2, d2)
 
     # if the key passes the keyfilter or if the keyfilter does exist
     # and, the end atoms are not hydrogens
@@ -2930,9 +3887,9 @@ def is_torprmdict_all_empty (torprmdict):
             return False
     return result
 
-def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
+def fit_rot_bond_tors(session, mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
     """
-    Intent: Uses scipy's optimize.leastsq function to find estimates for the torsion 
+    Intent: Uses a linear least squares fit to find estimates for the torsion 
     parameters based on energy values found at various angles using qm and mm
     Each rotatable bond is fit for one at a time
     Input:
@@ -2948,7 +3905,7 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
     Referenced By: process_rot_bond_tors
     Description:
     1. Initialize 'fitfunc_dict' and 'write_prm_dict'
-    2. For each tor in torlist (essentially, for each rotatable bond) 
+    2. For each tor in scantorlist (essentially, for each rotatable bond) 
     (the fit is done for each rotatable bond one at a time):
         a. Initialize 'torprmdict'
             i. For each torsion about the current rotatable bond, 'torprmdict' maps the torsion
@@ -2978,14 +3935,15 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
         i. 'nfolds' list (of lists) is found. Should at least initially be [[1,2,3],[1,2,3],...]
             nfolds are the number of force constants per torsion in question
         j. 'max_amp', max - min of tor_energy_list, is found 
-        k. 'pzero' is initialized
-        l. Remove parameters while # of parameters > # of data points
+        k. Remove parameters while # of parameters > # of data points
            This can happen if two torsions are very similar so their parameters can be combined
            into one set
-        m. now run optimize.leastsq. Keep rerunning it until the parameters no longer have to be 
-           'sanitized', meaning that none of the parameter estimates found by leastsq
-           are greater than max_amp
-        n. If all of the parameter estimates ended up being deleted, leastsq is rerun, 
+        l. Find the energy profile of each torsion term once ('tor_term_basis')
+        m. The model is linear in the parameters: build the design matrix from the current
+           parameter indices ('tor_design_matrix') and solve it with numpy.linalg.lstsq.
+           Keep resolving until the parameters no longer have to be 'sanitized', meaning
+           that none of the parameter estimates are greater than max_amp
+        n. If all of the parameter estimates ended up being deleted, the fit is rerun, 
            this time fitting for only the main torsion
         o. fill in 'torprmdict' with parameter estimates found by leastsq
         p. write out a plot of the fit
@@ -2994,7 +3952,7 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
     fitfunc_dict = {}
     write_prm_dict = {}
     # For each rotatable bond 
-    for tor in torlist:
+    for tor in session.scantorlist:
         torprmdict = {}
         # get the atoms in the main torsion about this rotatable bond
         a,b,c,d = tor[0:4]
@@ -3002,7 +3960,7 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
         torang = mol.GetTorsion(a,b,c,d)
 
         # class key; ie symmetry classes key
-        clskey = get_class_key(a,b,c,d)
+        clskey = get_class_key(session, a,b,c,d)
         
         # new list, post fitting
         mm_energy_list2 = [] # MM Energy after fitting
@@ -3011,10 +3969,10 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
         initangle = mol.GetTorsion(a,b,c,d)
 
         # Identify all torsion parameters involved with current rotatable bond.
-        for toraboutbnd in rotbndlist[rotbndkey]:
+        for toraboutbnd in session.rotbndlist[rotbndkey]:
             # toraboutbnd: some torsion about the current rotatable bond (rotbndkey)
             # However, initangle is the current angle for 'tor' not for 'toraboutbnd'
-            insert_torphasedict(
+            insert_torphasedict(session, 
                 mol, toraboutbnd, torprmdict, initangle, write_prm_dict)
 
         dispvar('TPDa', torprmdict)
@@ -3034,10 +3992,10 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
         #  atoms restrained during restrained rotation.
         # tor_energy_list is set as qm - mm
         tor_energy_list = [qme - mme for qme,mme in zip(qm_energy_list,mm_energy_list)]
-        Tx = numpy.arange ( 0.0, 360.0, 30)
-        txtfname = "%s-fit-%d-%d-%d-%d.txt" % (molecprefix, a, b, c, d)
+        Tx = numpy.array(angle_list)
+        txtfname = "%s-fit-%d-%d-%d-%d.txt" % (session.molecprefix, a, b, c, d)
         # create initial fit file, initially it seems to be 2d instead of 3d
-        write_arr_to_file(txtfname,[Tx,tor_energy_list])
+        write_arr_to_file(session.path(txtfname),[Tx,tor_energy_list])
 
         #pzero = []
         #pzero = [len(torprm['prmdict']) for torprm in torprmdict.values()]
@@ -3046,7 +4004,6 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
 
         # max amplitude of function
         max_amp = max(tor_energy_list) - min(tor_energy_list)
-        pzero = [ max_amp ] * prmidx
 
         # Remove parameters while # of parameters > # data points
         while prmidx > len(mm_energy_list):
@@ -3055,9 +4012,11 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
             for nfold in torprmdict[least_conn_tor]['prmdict']:
                 dellist.append((least_conn_tor,nfold))
             prmidx = del_tor_from_fit(dellist,torprmdict)
-        pzero = [ max_amp ] * prmidx
 
-        # run leastsq until all the parameter estimates are reasonable
+        # energy profile of each torsion term, found once for this rotatable bond
+        basis = tor_term_basis(rads(numpy.array(angle_list)), torprmdict)
+
+        # fit until all the parameter estimates are reasonable
         parm_sanitized = False
         while not parm_sanitized:
             parm_sanitized = True
@@ -3065,34 +4024,12 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
             keylist = list(torprmdict.keys())
             keylist.reverse()
             
-            # creating a new function, errfunc
-            # p: parameters
-            # x: angle list
-            # torprmdict: torsion information 
-            # y: tor_energy_list 
-            errfunc = lambda p, x, torprmdict, y: fitfunc(p, x, torprmdict) - y
-
-            # optimize.leastsq is run, found in the scipy library
-            # http://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.leastsq.html
-            # Inputs:
-            # errfunc : the callable function that we supply, based on fitfunc
-            # This is the function for which the squares are attempted to be minimized
-            # pzero : starting parameter estimates
-            # args=(rads(numpy.array(angle_list)), torprmdict, tor_energy_list) :
-            # These are the arguments that errfunc needs aside from 'p' (which will be supplied by
-            # leastsq)
-            # full_output : set to True, leastsq returns all optional outputs
-            # Outputs:
-            # p1 : parameter estimates returned by optimize.leastsq
-            # covx : matrix that can be used to find covariance of parameter estimates
-            # idict : dictionary containing info about the run
-            # msg : string giving cause of failure if one exists
-            # ier : an int. if ier is 1,2,3 or 4, a solution was found, else no solution was found
-            p1,covx,idict,msg,ier = optimize.leastsq(
-                errfunc, pzero, args=(rads(numpy.array(angle_list)),
-                torprmdict, tor_energy_list), full_output = True)
-
-            # Remove parameters found by least.sq that aren't reasonable; 
+            # the fit is linear in the parameters, so solve it directly
+            # p1 : parameter estimates, the offset is the last one
+            A = tor_design_matrix(len(angle_list), basis, torprmdict, prmidx)
+            p1 = numpy.linalg.lstsq(A, numpy.array(tor_energy_list), rcond=None)[0]
+
+            # Remove parameters found by the fit that aren't reasonable; 
             # remove parameters found that are greater than max_amp
             for chkclskey in keylist:
                 for nfold in torprmdict[chkclskey]['prmdict']:
@@ -3107,24 +4044,20 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
             dellist = list(set(dellist))
             dispvar("DELST",dellist)
             prmidx = del_tor_from_fit(dellist,torprmdict)
-            # new parameter array since prm size may have changed due to deletions
-            pzero = [ max_amp ] * prmidx
 
         # Attempts to insert main torsion type if all are removed
         # Rerun leastsq, this time fitting for the force constants of the main torsion
         if is_torprmdict_all_empty(torprmdict):
-            toraboutbnd = rotbndlist[rotbndkey][0]
-            insert_torphasedict(
+            toraboutbnd = session.rotbndlist[rotbndkey][0]
+            insert_torphasedict(session, 
                 mol, toraboutbnd, torprmdict,
                 initangle, write_prm_dict,keyfilter = clskey)
 
             prmidx = insert_torprmdict(mol, torprmdict)
-            pzero = [ max_amp ] * prmidx
 
-            errfunc = lambda p, x, torprmdict, y: fitfunc(p, x, torprmdict) - y
-            p1,covx,idict,msg,ier = optimize.leastsq(
-                errfunc, pzero, args=(rads(numpy.array(angle_list)),
-                torprmdict, tor_energy_list), full_output = True)
+            basis = tor_term_basis(rads(numpy.array(angle_list)), torprmdict)
+            A = tor_design_matrix(len(angle_list), basis, torprmdict, prmidx)
+            p1 = numpy.linalg.lstsq(A, numpy.array(tor_energy_list), rcond=None)[0]
 
         # fill in torprmdict with the parameter estimates
         for chkclskey in torprmdict:
@@ -3142,50 +4075,192 @@ def fit_rot_bond_tors(mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict):
                 else:
                     torprmdict[chkclskey]['offset'] = p1
 
-        figfname = "%s-fit-%d-%d-%d-%d.png" % (molecprefix, a, b, c, d)
-        fig = plt.figure()
+        figfname = "%s-fit-%d-%d-%d-%d.png" % (session.molecprefix, a, b, c, d)
         Sx = numpy.array(cls_angle_dict[clskey])
         fitfunc_dict[clskey] = fitfunc('eval',rads(Sx),torprmdict,debug=False)
-        l1 = plt.plot(Sx,fitfunc_dict[clskey],'r')
-        l2 = plt.plot(Sx,tor_energy_list,'b')
-        plt.legend( (l1[0], l2[0]), ('Fitted Function', 'QM - MM'))
-        # plot figure
-        fig.savefig(figfname)
 
         # write parameter estimates to file
-        write_arr_to_file(txtfname,[Sx,fitfunc_dict[clskey],tor_energy_list])
+        write_arr_to_file(session.path(txtfname),[Sx,fitfunc_dict[clskey],tor_energy_list])
+        # plot figure
+        plot_profiles(session, figfname, [(Sx,fitfunc_dict[clskey],'r','Fitted Function'),
+                                          (Sx,tor_energy_list,'b','QM - MM')])
         #print "\n\n\n"
     return write_prm_dict,fitfunc_dict
 
+def fit_rot_bond_tors_global(session, mol,tor_engy_dict):
+    """
+    Intent: Fit the torsion parameters of all rotatable bonds in one sparse linear least
+    squares system, so that a class key shared between bonds gets one consistent set of
+    parameters
+    Input:
+        mol: OBMol structure
+        tor_engy_dict: (a,b,c,d) -> (angles, qm energies, mm energies) for each tor in scantorlist,
+                       see get_qmmm_rot_bond_energy
+    Output:
+        write_prm_dict: map from class key to parameter information. 
+                        Used to write out new key file
+        fitfunc_dict: energy profile (using the new parameters) to be plotted
+        None is returned if every parameter had to be removed from the fit
+    Referenced By: process_rot_bond_tors
+    Description:
+    1. For each rotatable bond, set up 'torprmdict' and the term profiles as in fit_rot_bond_tors
+    2. Each (class key, nfold) term is one parameter for all bonds. Terms that
+       insert_torprmdict ties together (cooperative terms) share a parameter as well
+    3. Every scan gets its own offset, since QM - MM profiles have arbitrary zeros
+    4. Remove the least connected torsions while there are more parameters than data points
+    5. Solve the system with scipy.sparse.linalg.lsqr, and remove parameters greater than
+       the largest QM - MM amplitude of the scans they appear in, until none are left
+    6. Fill in 'write_prm_dict' and the fitted profile of each scan
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.linalg import lsqr
+
+    fitfunc_dict = {}
+    write_prm_dict = {}
+    scans = []
+    # parent of each (clskey, nfold) term; terms with the same root share a parameter
+    termparent = {}
+    def find_term(term):
+        while termparent[term] != term:
+            term = termparent[term]
+        return term
+
+    for tor in session.scantorlist:
+        a,b,c,d = tor[0:4]
+        if tuple(tor[0:4]) not in tor_engy_dict:
+            continue
+        angle_list,qm_energy_list,mm_energy_list = tor_engy_dict[tuple(tor[0:4])]
+        torprmdict = {}
+        rotbndkey = '%d %d' % (b, c)
+        initangle = mol.GetTorsion(a,b,c,d)
+        for toraboutbnd in session.rotbndlist[rotbndkey]:
+            insert_torphasedict(session, 
+                mol, toraboutbnd, torprmdict, initangle, write_prm_dict)
+        insert_torprmdict(mol, torprmdict)
+
+        qm_energy_list = [en - min(qm_energy_list) for en in qm_energy_list]
+        mm_energy_list = [en - min(mm_energy_list) for en in mm_energy_list]
+        tor_energy_list = [qme - mme for qme,mme in zip(qm_energy_list,mm_energy_list)]
+        basis = tor_term_basis(numpy.radians(angle_list), torprmdict)
+
+        # terms of this bond that insert_torprmdict gave the same parameter index
+        localterms = {}
+        for (chkclskey, torprm) in torprmdict.items():
+            for nfold in torprm['prmdict']:
+                term = (chkclskey, nfold)
+                if term not in termparent:
+                    termparent[term] = term
+                localterms.setdefault(torprm['prmdict'][nfold], []).append(term)
+        for terms in localterms.values():
+            for term in terms[1:]:
+                termparent[find_term(term)] = find_term(terms[0])
+
+        scans.append({'tor': tor, 'clskeys': list(torprmdict.keys()), 'angles': angle_list,
+                      'y': tor_energy_list, 'basis': basis,
+                      'terms': [t for ts in localterms.values() for t in ts],
+                      'max_amp': max(tor_energy_list) - min(tor_energy_list)})
+
+    activeterms = set(termparent)
+    nrows = sum(len(scan['y']) for scan in scans)
+    while True:
+        roots = sorted(set(find_term(term) for term in activeterms))
+        # Remove parameters while # of parameters > # data points
+        if roots and len(roots) + len(scans) > nrows:
+            least_conn_tor = find_least_connected_torsion(
+                dict((term[0], None) for term in activeterms))
+            activeterms = set(t for t in activeterms if t[0] != least_conn_tor)
+            continue
+        if not roots:
+            return None
+        colidx = dict((root, i) for (i, root) in enumerate(roots))
+        nprm = len(roots)
+
+        rows = []
+        cols = []
+        vals = []
+        y = []
+        for (scanidx, scan) in enumerate(scans):
+            rowstart = len(y)
+            npoints = len(scan['y'])
+            for term in scan['terms']:
+                if term not in activeterms:
+                    continue
+                rows.extend(range(rowstart, rowstart + npoints))
+                cols.extend([colidx[find_term(term)]] * npoints)
+                vals.extend(scan['basis'][term])
+            rows.extend(range(rowstart, rowstart + npoints))
+            cols.extend([nprm + scanidx] * npoints)
+            vals.extend([1.0] * npoints)
+            y.extend(scan['y'])
+        A = coo_matrix((vals, (rows, cols)), shape=(len(y), nprm + len(scans))).tocsr()
+        p1 = lsqr(A, numpy.array(y), atol=1e-12, btol=1e-12)[0]
+
+        # largest QM - MM amplitude of the scans each parameter appears in
+        max_amp = {}
+        for scan in scans:
+            for term in scan['terms']:
+                if term in activeterms:
+                    root = find_term(term)
+                    max_amp[root] = max(max_amp.get(root, 0.0), scan['max_amp'])
+        # Remove parameters that aren't reasonable, at most one nfold per class key
+        dellist = []
+        for chkclskey in sorted(set(term[0] for term in activeterms)):
+            for nfold in nfoldlist:
+                term = (chkclskey, nfold)
+                if term in activeterms and \
+                   abs(p1[colidx[find_term(term)]]) > max_amp[find_term(term)]:
+                    dellist.append(term)
+                    break
+        dispvar("DELST",dellist)
+        if not dellist:
+            break
+        activeterms.difference_update(dellist)
+
+    # fill in write_prm_dict with the parameter estimates
+    for scan in scans:
+        for chkclskey in scan['clskeys']:
+            write_prm_dict[chkclskey] = {}
+    for term in activeterms:
+        write_prm_dict[term[0]][term[1]] = p1[colidx[find_term(term)]]
+    for chkclskey in write_prm_dict:
+        if write_prm_dict[chkclskey] == {}:
+            write_prm_dict[chkclskey] = {1:0., 2:0., 3:0.}
+
+    # fitted profile of each scan
+    for (scanidx, scan) in enumerate(scans):
+        a,b,c,d = scan['tor'][0:4]
+        clskey = get_class_key(session, a,b,c,d)
+        fitprofile = numpy.zeros(len(scan['y'])) + p1[nprm + scanidx]
+        for term in scan['terms']:
+            if term in activeterms:
+                fitprofile += p1[colidx[find_term(term)]] * scan['basis'][term]
+        fitfunc_dict[clskey] = fitprofile
+
+        Sx = numpy.array(scan['angles'])
+        figfname = "%s-fit-%d-%d-%d-%d.png" % (session.molecprefix, a, b, c, d)
+        txtfname = "%s-fit-%d-%d-%d-%d.txt" % (session.molecprefix, a, b, c, d)
+        write_arr_to_file(session.path(txtfname),[Sx,fitprofile,scan['y']])
+        plot_profiles(session, figfname, [(Sx,fitprofile,'r','Fitted Function'),
+                                          (Sx,scan['y'],'b','QM - MM')])
+    return write_prm_dict,fitfunc_dict
+
 def write_key_file(write_prm_dict,tmpkey1basename,tmpkey2basename):
     """
     Intent: Output the new key file based on parameters in write_prm_dict
     """
-    tmpfh1 = open(tmpkey1basename, "r")
-    tmpfh2 = open(tmpkey2basename, "w")
+    keyf = tinkerkey.KeyFile.read(tmpkey1basename)
+    for term in keyf.torsions():
+        cl = term.fields[1:5]
+        clskey = ' '.join(cl) # Order is fine (read from *.prm file)
+        if clskey in write_prm_dict:
+            torline = ' torsion %7s %4s %4s %4s   ' % (cl[0],cl[1],cl[2],cl[3])
+            for (nfold, prm) in list(write_prm_dict[clskey].items()):
+                torline += ' %7.3f %.1f %d' % (prm,foldoffsetlist[nfold - 1], nfold)
+            torline += '\n'
+            term.lines = [torline]
+    keyf.write(tmpkey2basename)
 
-    for line in tmpfh1:
-        m = re.search(r'torsion',line)
-        if m is None:
-            tmpfh2.write(line)
-        else:
-            linarr = line.split()
-            cl = linarr[1:5]
-            clskey = ' '.join(cl) # Order is fine (read from *.prm file)
-            torline = line
-            torvals = [float(ele) for ele in linarr[5:24:3]]
-#            if clskey in write_prm_dict and \
-#               torvals == [0.]*len(torvals):
-            if clskey in write_prm_dict:
-                torline = ' torsion %7s %4s %4s %4s   ' % (cl[0],cl[1],cl[2],cl[3])
-                for (nfold, prm) in list(write_prm_dict[clskey].items()):
-                    torline += ' %7.3f %.1f %d' % (prm,foldoffsetlist[nfold - 1], nfold)
-                torline += '\n'
-            tmpfh2.write(torline)
-    tmpfh1.close()
-    tmpfh2.close()
-
-def eval_rot_bond_parms(mol,anglelist,fitfunc_dict,tmpkey1basename,tmpkey2basename):
+def eval_rot_bond_parms(session, mol,anglelist,fitfunc_dict,tmpkey1basename,tmpkey2basename):
     """
     Intent: 
     For each torsion whose parameters were fit for:
@@ -3196,7 +4271,7 @@ def eval_rot_bond_parms(mol,anglelist,fitfunc_dict,tmpkey1basename,tmpkey2basena
     than the MM Energy (Pre-fit) profiles were. Look at the *png post running poltype to confirm.
     Input:
         mol: OBMol structure
-        anglelist: dihedral angles, default 0-360, increments of 30
+        anglelist: phase list, for torsions not in 'torphasedict'. default 0-360, increments of 30
         fitfunc_dict: energy profile
         tmpkey1basename: Old key file, with old torsion parameters
         tmpkey2basename: New key file, with new torsion parameters
@@ -3204,13 +4279,13 @@ def eval_rot_bond_parms(mol,anglelist,fitfunc_dict,tmpkey1basename,tmpkey2basena
         *energy*.png:
     Referenced By: process_rot_bond_tors
     Description:
-    1. For each torsion whose parameters have been fit for (for each tor in torlist):
-        a. Get each energy profile (MM pre, MM post, QM)
+    1. For each torsion whose parameters have been fit for (for each tor in scantorlist):
+        a. Get each energy profile (MM pre, MM post, QM); the MM post-fit profile is found
+           in-process by 'postfit_mm_tor_energy' unless 'mmpostfitanalyze' is set
         b. Plot the profiles
     """
-    global mm_tor_count
     # for each main torsion
-    for tor in torlist:
+    for tor in session.scantorlist:
         a,b,c,d = tor[0:4]
         torang = mol.GetTorsion(a,b,c,d)
         atmnuma = mol.GetAtom(a).GetAtomicNum()
@@ -3219,21 +4294,27 @@ def eval_rot_bond_parms(mol,anglelist,fitfunc_dict,tmpkey1basename,tmpkey2basena
             continue
 
         # clskey
-        clskey = get_class_key(a, b, c, d)
+        clskey = get_class_key(session, a, b, c, d)
 
         mm_energy_list = []
         mm_energy_list2 = []
         qm_energy_list = []
 
+        phaselist = session.torphasedict.get(tuple(tor[0:4]), anglelist)
+
         # get the qm energy profile
-        qm_energy_list,qang_list = compute_qm_tor_energy(a,b,c,d,torang,anglelist)
+        qm_energy_list,qang_list = compute_qm_tor_energy(session, a,b,c,d,torang,phaselist)
         tmpkeyfname = 'tmp.key'
-        shutil.copy(tmpkey1basename, tmpkeyfname)
+        shutil.copy(session.path(tmpkey1basename), session.path(tmpkeyfname))
         # get the original mm energy profile
-        mm_energy_list,mang_list,tor_e_list = compute_mm_tor_energy(a,b,c,d,torang,anglelist,tmpkeyfname)
-        mm_tor_count += 1
+        mm_energy_list,mang_list,tor_e_list = compute_mm_tor_energy(session, a,b,c,d,torang,phaselist,tmpkeyfname)
+        session.mm_tor_count += 1
         # get the new mm energy profile (uses new parameters to find energies)
-        mm2_energy_list,m2ang_list,tor_e_list2 = compute_mm_tor_energy(a,b,c,d,torang,anglelist,tmpkey2basename)
+        if session.mmpostfitanalyze:
+            mm2_energy_list,m2ang_list,tor_e_list2 = compute_mm_tor_energy(session, a,b,c,d,torang,phaselist,tmpkey2basename)
+        else:
+            mm2_energy_list,tor_e_list2 = postfit_mm_tor_energy(session, a,b,c,d,mang_list,mm_energy_list,tor_e_list,tmpkeyfname,tmpkey2basename)
+            m2ang_list = list(mang_list)
 
         # remove angles for which energy was unable to be found
         del_ang_list = find_del_list(mm_energy_list,mang_list)
@@ -3256,23 +4337,21 @@ def eval_rot_bond_parms(mol,anglelist,fitfunc_dict,tmpkey1basename,tmpkey2basena
         # TBC
         ff_list = [aa+bb for (aa,bb) in zip(mm_energy_list,fitfunc_dict[clskey])]
 
+        txtfname = "%s-energy-%d-%d-%d-%d.txt" % (session.molecprefix, a, b, c, d)
+        write_arr_to_file(session.path(txtfname),[mang_list,mm_energy_list,mm2_energy_list,qm_energy_list,tordif_list])
+
         # output the profiles as plots
-        figfname = "%s-energy-%d-%d-%d-%d.png" % (molecprefix, a, b, c, d)
-        fig = plt.figure()
-        fig.subplots_adjust(right=0.75,left=0.05,top=0.95,bottom=0.05)
-        ax = fig.add_subplot(111)
-        # energy profiles: mm (pre-fit), mm (post-fit), qm
-        plt.plot(mang_list,mm_energy_list,'g',label='MM (prefit)')
-        plt.plot(m2ang_list,mm2_energy_list,'r',label='MM (postfit)')
-        plt.plot(qang_list,qm_energy_list,'b',label='QM')
-        # mm + fit
-        plt.plot(mang_list,ff_list,'md-',label='MM1+Fit')
-        plt.legend(loc=(1.01, .5))
-        fig.savefig(figfname)
-        txtfname = "%s-energy-%d-%d-%d-%d.txt" % (molecprefix, a, b, c, d)
-        write_arr_to_file(txtfname,[mang_list,mm_energy_list,mm2_energy_list,qm_energy_list,tordif_list])
-
-def gen_toromit_list():
+        figfname = "%s-energy-%d-%d-%d-%d.png" % (session.molecprefix, a, b, c, d)
+        # energy profiles: mm (pre-fit), mm (post-fit), qm; and mm + fit
+        plot_profiles(session, figfname,
+                      [(mang_list,mm_energy_list,'g','MM (prefit)'),
+                       (m2ang_list,mm2_energy_list,'r','MM (postfit)'),
+                       (qang_list,qm_energy_list,'b','QM'),
+                       (mang_list,ff_list,'md-','MM1+Fit')],
+                      legendloc=(1.01, .5),
+                      margins={'right': 0.75, 'left': 0.05, 'top': 0.95, 'bottom': 0.05})
+
+def gen_toromit_list(session):
     """
     Intent: if 'omittorsion2' is True, read in the *.toromit file to see which torsions 
     should not be scanned for
@@ -3282,10 +4361,9 @@ def gen_toromit_list():
     Referenced By: main
     Description: Read in file, append information to toromit_list
     """
-    global toromit_list
-    toromitf = open(molecprefix+".toromit")
+    toromitf = open(session.path(session.molecprefix+".toromit"))
     for l in toromitf:
-        toromit_list.append(sorttorsion([int(l.split()[0]), int(l.split()[1]), int(l.split()[2]), int(l.split()[3])]))
+        session.toromit_list.append(sorttorsion([int(l.split()[0]), int(l.split()[1]), int(l.split()[2]), int(l.split()[3])]))
     toromitf.close()
 
 def sorttorsion(keylist):
@@ -3309,7 +4387,7 @@ def sorttorsion(keylist):
     return keylist
 
 # Fit torsion parameters for rotatable bonds
-def process_rot_bond_tors(mol):
+def process_rot_bond_tors(session, mol):
     """
     Intent: Fit torsion parameters for torsions about rotatable bonds 
     Input:
@@ -3322,24 +4400,24 @@ def process_rot_bond_tors(mol):
        profiles for each rotatable bond. 
        Store these profiles in 'cls_qm_engy_dict' and 'cls_mm_engy_dict'.
     2. Use these profiles to fit for the torsion parameters by calling 'fit_rot_bond_tors'
+       (or 'fit_rot_bond_tors_global' if 'globaltorfit' is set)
     3. Evaluate the new parameters output by the fitting fuction and output informational plots 
        by calling 'eval_rot_bond_parms'
     4. Write out the new keyfile (*.key_5) with these new torsion parameters
     """
-    global mm_tor_count
 
-    #create list from 0 - 360 in increments of 30
-    anglist = list(range(0,360,30))
+    #create list from 0 - 360 in increments of 'torscanstep'
+    anglist = list(range(0,360,session.torscanstep))
     tordir = 'qm-torsion'
     tmpkey1basename = 'tinker.key'
     tmpkey2basename = 'tinker.key_2'
     tmpkey1fname = tordir + '/' + tmpkey1basename
-    assert os.path.isdir(tordir), \
+    assert os.path.isdir(session.path(tordir)), \
        "ERROR: Directory '%s' does not exist" % tordir
     # copy *.key_4 to the directory qm-torsion
-    shutil.copy(key4fname, tmpkey1fname)
+    shutil.copy(session.path(session.key4fname), session.path(tmpkey1fname))
     # change directory to qm-torsion
-    os.chdir(tordir)
+    session.chdir(tordir)
 
     # Group all rotatable bonds with the same classes and identify
     # the torsion parameters that need to be fitted.
@@ -3347,59 +4425,406 @@ def process_rot_bond_tors(mol):
     # For each rotatable bond, get torsion energy profile from QM
     # and MM (with no rotatable bond torsion parameters)
     # Get QM and MM (pre-fit) energy profiles for torsion parameters
-    mm_tor_count += 1
-    cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict = get_qmmm_rot_bond_energy(mol,anglist,tmpkey1basename)
+    session.mm_tor_count += 1
+    tor_engy_dict = {}
+    cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict = get_qmmm_rot_bond_energy(session, mol,anglist,tmpkey1basename,tor_engy_dict)
 
     # if the fit has not been done already
-    if torkeyfname is None:
+    if session.torkeyfname is None:
         # do the fit
-        write_prm_dict,fitfunc_dict = fit_rot_bond_tors(
-            mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict)
-        mm_tor_count += 1
+        fitresult = None
+        if session.globaltorfit:
+            fitresult = fit_rot_bond_tors_global(session, mol,tor_engy_dict)
+        if fitresult is None:
+            fitresult = fit_rot_bond_tors(session, 
+                mol,cls_mm_engy_dict,cls_qm_engy_dict,cls_angle_dict)
+        write_prm_dict,fitfunc_dict = fitresult
+        session.mm_tor_count += 1
         # write out new keyfile
-        write_key_file(write_prm_dict,tmpkey1basename,tmpkey2basename)
+        write_key_file(write_prm_dict,session.path(tmpkey1basename),session.path(tmpkey2basename))
     else:
-        shutil.copy('../' + torkeyfname,tmpkey2basename)
+        shutil.copy(session.path('../' + session.torkeyfname),session.path(tmpkey2basename))
     # evaluate the new parameters
-    eval_rot_bond_parms(
+    eval_rot_bond_parms(session, 
         mol,anglist,fitfunc_dict,tmpkey1basename,tmpkey2basename)
-    shutil.copy(tmpkey2basename,'../' + key5fname)
-    os.chdir('..')
+    shutil.copy(session.path(tmpkey2basename),session.path('../' + session.key5fname))
+    session.chdir('..')
 
-#POLTYPE BEGINS HERE
-def main():
-    # log file object
-    global logfh
-    # An array that maps atom ids to the symmetry class they belong to
-    global symmetryclass
-    # the OBMol object
-    global mol
-    global localframe1
-    global localframe2
-    global canonicallabel
-    global rotbndlist
-    global torlist
+def read_batch_manifest(manifestfname):
+    """
+    Intent: Read the structure files and per-molecule options of a batch manifest
+    Input:
+        manifestfname: manifest file name
+    Output:
+        entries: list of (structure file name, list of extra options)
+    Referenced By: run_batch
+    Description:
+    One structure file per line, optionally followed by options for that molecule
+    only. Blank lines and lines starting with '#' are skipped. Relative structure file
+    names are taken from the directory of the manifest.
+    """
+    manifestdir = os.path.dirname(os.path.abspath(manifestfname))
+    entries = []
+    for line in open(manifestfname):
+        linarr = shlex.split(line, comments=True)
+        if len(linarr) == 0:
+            continue
+        structfname = os.path.join(manifestdir, linarr[0])
+        assert os.path.isfile(structfname), "Error: Cannot open " + structfname
+        entries.append((structfname, linarr[1:]))
+    return entries
+
+def prewarm_batch(session):
+    """
+    Intent: Load what all molecules of a batch share, before the worker processes are forked
+    Referenced By: run_batch, run_worker
+    Description:
+    The workers are forked from this process, so they start with the modules imported,
+    the valence SMARTS patterns parsed and the parameter file header read.
+    """
+    valence.Valence(session.output_format).parse_patterns()
+    get_prm_torsionunit(session.paramhead)
+
+def run_batch_molecule(task):
+    """
+    Intent: Run poltype for one molecule of a batch, in a worker process
+    Input:
+        task: (name, working directory, structure file name, argument list)
+    Output:
+        (name, exit status)
+    Referenced By: run_batch, run_worker
+    Description:
+    The output of the molecule goes to poltype-batch.out in its working directory.
+    """
+    (name, moldir, structfname, molargv) = task
+    outfh = open(os.path.join(moldir, 'poltype-batch.out'), 'a')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(outfh.fileno(), sys.stdout.fileno())
+    os.dup2(outfh.fileno(), sys.stderr.fileno())
+    if not os.path.isfile(os.path.join(moldir, os.path.basename(structfname))):
+        shutil.copy(structfname, moldir)
+    status = 0
+    try:
+        session = Session(moldir)
+        parse_options(session, molargv)
+        run_poltype(session)
+    except SystemExit as err:
+        if isinstance(err.code, int):
+            status = err.code
+        elif err.code is not None:
+            print(err.code)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return (name, status)
+
+def strip_options(argv, options):
+    """
+    Intent: Remove the options in 'options', each of which takes a value, from 'argv'
+    Referenced By: run_batch, run_worker, submit_job
+    Description:
+    Both '--option value' and '--option=value' (or '-ovalue' for a short option)
+    are removed.
+    """
+    newargv = []
+    skipnext = False
+    for arg in argv:
+        if skipnext:
+            skipnext = False
+        elif arg in options:
+            skipnext = True
+        elif not [opt for opt in options if arg.startswith(opt + '=' if opt.startswith('--') else opt)]:
+            newargv.append(arg)
+    return newargv
+
+def get_batch_njobs(session):
+    """
+    Intent: Find how many molecules fit in 'batchcores' and 'batchmem' at the same time,
+    each using 'numproc' cores and 'maxmem' memory
+    Referenced By: run_batch, run_worker
+    """
+    ncpu, memmb = get_machine_resources()
+    totcores = session.batchcores if session.batchcores is not None else ncpu
+    totmem = mem_str_to_mb(session.batchmem) if session.batchmem is not None else memmb
+    njobs = max(1, totcores // int(session.numproc))
+    if totmem is not None:
+        njobs = min(njobs, max(1, totmem // mem_str_to_mb(session.maxmem)))
+    return njobs
+
+def batch_molecule_main(task):
+    """
+    Intent: Process target of 'start_batch_molecule'; exits with the status of the molecule
+    """
+    sys.exit(run_batch_molecule(task)[1])
+
+def start_batch_molecule(task):
+    """
+    Intent: Start 'run_batch_molecule' for 'task' in a new forked process
+    Output:
+        multiprocessing.Process; its exit code is the exit status of the molecule
+    Referenced By: run_batch, run_worker
+    Description:
+    Each molecule gets a process of its own, so one that is killed by a signal (the
+    OOM killer, a crash in OpenBabel) only ends with a negative exit code, instead
+    of leaving a pool waiting for a result that never comes.
+    """
+    proc = multiprocessing.get_context('fork').Process(target=batch_molecule_main, args=(task,))
+    proc.start()
+    return proc
+
+def batch_status_str(status):
+    if status == 0:
+        return "done"
+    elif status < 0:
+        return "killed by signal %d" % -status
+    return "failed (%d)" % status
+
+def run_batch(session):
+    """
+    Intent: Run poltype for every molecule in the manifest 'batchfname'
+    Input:
+    Output:
+    Referenced By: main
+    Description:
+    1. Read the manifest and make a working directory for each molecule in 'batchdir'
+    2. Find how many molecules fit in 'batchcores' and 'batchmem' at the same time,
+       each using 'numproc' cores and 'maxmem' memory
+    3. Load the shared resources once (prewarm_batch)
+    4. Run each molecule in its own forked process (start_batch_molecule), with its
+       own Session, so memory held by one molecule (OpenBabel objects, plots) is given
+       back before the next one starts
+    5. Write the exit status of each molecule to batch-summary.txt; a molecule whose
+       process was killed (e.g. by the OOM killer) gets the negative signal number
+    """
+    entries = read_batch_manifest(session.batchfname)
+    if not os.path.isdir(session.batchdir):
+        os.makedirs(session.batchdir)
+
+    # command line options other than the batch options apply to every molecule
+    commonargv = strip_options(sys.argv[1:], batchoptions)
+
+    tasks = []
+    names = set()
+    for (structfname, molopts) in entries:
+        name = os.path.splitext(os.path.basename(structfname))[0]
+        uniqname = name
+        count = 1
+        while uniqname in names:
+            count += 1
+            uniqname = '%s_%d' % (name, count)
+        names.add(uniqname)
+        moldir = os.path.abspath(os.path.join(session.batchdir, uniqname))
+        if not os.path.isdir(moldir):
+            os.makedirs(moldir)
+        molargv = [sys.argv[0], '-s', os.path.basename(structfname)] + commonargv + molopts
+        tasks.append((uniqname, moldir, structfname, molargv))
+
+    njobs = max(1, min(get_batch_njobs(session), len(tasks)))
+    print("poltype batch: %d molecules, %d at a time" % (len(tasks), njobs))
+
+    prewarm_batch(session)
+    failed = []
+    summaryfh = open(os.path.join(session.batchdir, 'batch-summary.txt'), 'w')
+    pending = deque(tasks)
+    running = {}
+    while pending or running:
+        while pending and len(running) < njobs:
+            task = pending.popleft()
+            running[task[0]] = start_batch_molecule(task)
+        multiprocessing.connection.wait([proc.sentinel for proc in running.values()])
+        for (name, proc) in list(running.items()):
+            if proc.exitcode is None:
+                continue
+            del running[name]
+            proc.join()
+            status = proc.exitcode
+            print("%s: %s" % (name, batch_status_str(status)))
+            summaryfh.write("%s %d\n" % (name, status))
+            summaryfh.flush()
+            if status != 0:
+                failed.append(name)
+    summaryfh.close()
+    if failed:
+        print("poltype batch: %d of %d molecules failed" % (len(failed), len(tasks)))
+        sys.exit(1)
+
+def submit_job(session):
+    """
+    Intent: Add the molecule 'molstructfname' to the job queue of the spool directory 'submitdir'
+    Input:
+    Output:
+        the job file is written to <submitdir>/queue
+    Referenced By: main
+    Description:
+    A job is one manifest line (see read_batch_manifest): the absolute structure file
+    name, followed by the other options on the command line. It is written under a
+    temporary name and then renamed, so a worker never reads a partly written job.
+    """
+    structfname = session.path(session.molstructfname)
+    assert os.path.isfile(structfname), "Error: Cannot open " + structfname
+    queuedir = session.path(os.path.join(session.submitdir, 'queue'))
+    if not os.path.isdir(queuedir):
+        os.makedirs(queuedir)
+    molopts = strip_options(sys.argv[1:], ("-s", "--structure") + batchoptions)
+    name = os.path.splitext(os.path.basename(structfname))[0]
+    tmpfh, tmpfname = tempfile.mkstemp(dir=queuedir, prefix=name + '-', suffix='.tmp')
+    jobline = ' '.join(shlex.quote(arg) for arg in [structfname] + molopts) + '\n'
+    os.write(tmpfh, jobline.encode('utf-8'))
+    os.close(tmpfh)
+    jobfname = os.path.splitext(tmpfname)[0] + '.job'
+    os.rename(tmpfname, jobfname)
+    print(jobfname)
+
+def take_worker_job(spooldir):
+    """
+    Intent: Take the oldest job from the queue of 'spooldir'
+    Input:
+        spooldir: spool directory
+    Output:
+        name of the job, or None if the queue is empty
+    Referenced By: run_worker
+    Description:
+    The job file is moved from 'queue' to 'running'. If another worker moved it first,
+    the rename fails and the next job is tried.
+    """
+    queuedir = os.path.join(spooldir, 'queue')
+    jobfnames = []
+    for fname in os.listdir(queuedir):
+        if fname.endswith('.job'):
+            try:
+                jobfnames.append((os.path.getmtime(os.path.join(queuedir, fname)), fname))
+            except OSError:
+                pass
+    for (mtime, fname) in sorted(jobfnames):
+        try:
+            os.rename(os.path.join(queuedir, fname), os.path.join(spooldir, 'running', fname))
+        except OSError:
+            continue
+        return os.path.splitext(fname)[0]
+    return None
+
+def run_worker(session):
+    """
+    Intent: Run poltype jobs from the spool directory 'workerdir' until told to stop
+    Input:
+    Output:
+    Referenced By: main
+    Description:
+    The spool directory has the subdirectories
+        queue:        jobs waiting to run, added by 'submit_job' (*.job)
+        running:      jobs taken by a worker
+        done, failed: finished jobs, each with its exit status in <job>.status
+        work:         a working directory for each job
+    1. Load the shared resources once (prewarm_batch)
+    2. Take jobs from the queue (take_worker_job) while fewer than the number found by
+       'get_batch_njobs' are running. Several workers may share one spool directory.
+    3. Run each job in a process forked from this one (start_batch_molecule), so
+       it starts with the modules imported and the shared resources loaded. The
+       options on the command line apply to every job, before the options of the job.
+    4. When a job finishes, move it to 'done' or 'failed' and write its exit status
+       (the negative signal number if its process was killed)
+    5. Once the file 'stop' is in the spool directory, take no more jobs and return
+       when the running jobs have finished
+    """
+    spooldir = session.path(session.workerdir)
+    for subdir in ('queue', 'running', 'done', 'failed', 'work'):
+        if not os.path.isdir(os.path.join(spooldir, subdir)):
+            os.makedirs(os.path.join(spooldir, subdir))
+    commonargv = strip_options(sys.argv[1:], batchoptions)
+    njobs = get_batch_njobs(session)
+    print("poltype worker: %s, %d jobs at a time" % (spooldir, njobs))
+
+    prewarm_batch(session)
+    running = {}
+    stopping = False
+    while running or not stopping:
+        for (name, proc) in list(running.items()):
+            if proc.exitcode is None:
+                continue
+            del running[name]
+            proc.join()
+            status = proc.exitcode
+            finishdir = os.path.join(spooldir, 'done' if status == 0 else 'failed')
+            statusfh = open(os.path.join(finishdir, name + '.status'), 'w')
+            statusfh.write("%d\n" % status)
+            statusfh.close()
+            os.rename(os.path.join(spooldir, 'running', name + '.job'),
+                      os.path.join(finishdir, name + '.job'))
+            print("%s: %s" % (name, batch_status_str(status)))
+
+        stopping = os.path.isfile(os.path.join(spooldir, 'stop'))
+        name = None
+        if not stopping and len(running) < njobs:
+            name = take_worker_job(spooldir)
+        if name is None:
+            time.sleep(workerpoll)
+            continue
+
+        jobfname = os.path.join(spooldir, 'running', name + '.job')
+        moldir = os.path.join(spooldir, 'work', name)
+        try:
+            (structfname, molopts) = read_batch_manifest(jobfname)[0]
+        except (AssertionError, IndexError, ValueError) as err:
+            print("%s: bad job: %s" % (name, err))
+            os.rename(jobfname, os.path.join(spooldir, 'failed', name + '.job'))
+            continue
+        if not os.path.isdir(moldir):
+            os.makedirs(moldir)
+        molargv = [sys.argv[0], '-s', os.path.basename(structfname)] + commonargv + molopts
+        running[name] = start_batch_molecule((name, moldir, structfname, molargv))
 
+def convert_tinker4_polarize(keyf):
+    """
+    Intent: Rewrite the polarize terms of 'keyf' (tinkerkey.KeyFile) in the tinker 4 format
+    Referenced By: main
+    Description:
+    Tinker 4 has no thole damping value, so the third value of each term is dropped
+    """
+    for term in keyf.polarize():
+        ln = ""
+        for (i, field) in enumerate(term.fields):
+            if i != 3:
+                if i == 1:
+                    ln += field + "                          "
+                else:
+                    ln += field + "  "
+        term.lines = [ln + "\n"]
+
+def run_poltype(session):
+    """
+    Intent: Parameterize the molecule of 'session'
+    Input:
+        session: Session with the options already set (see parse_options)
+    Output:
+    Referenced By: main, run_batch_molecule
+    Description:
+    Runs every stage of poltype, from the QM calculations to the final key file, for
+    the structure 'molstructfname'. All state is kept in 'session'; files are written
+    to its working directory.
+    """
     # Initialization. 
     # Setting flags, setting up directories, setting up files
-    parse_options(sys.argv)
     copyright()
-    initialize()
-    init_filenames()
+    initialize(session)
+    init_filenames(session)
     
     # Use openbabel to create a 'mol' object from the input molecular structure file. 
     # Openbabel does not play well with certain molecular structure input files,
     # such as tinker xyz files. (normal xyz are fine)
-    assert os.path.isfile(molstructfname), "Error: Cannot open " + molstructfname
+    assert os.path.isfile(session.path(session.molstructfname)), "Error: Cannot open " + session.molstructfname
     obConversion = openbabel.OBConversion()
-    inFormat = obConversion.FormatFromExt(molstructfname)
+    inFormat = obConversion.FormatFromExt(session.molstructfname)
     obConversion.SetInFormat(inFormat)
-    mol = openbabel.OBMol()
-    obConversion.ReadFile(mol, molstructfname)
+    session.mol = openbabel.OBMol()
+    obConversion.ReadFile(session.mol, session.path(session.molstructfname))
 
     # Begin log. *-poltype.log
-    logfh = open(logfname,"a")
-    logfh.write("Running on host: " + gethostname() + "\n")
+    session.logfh = open(session.path(session.logfname),"a")
+    session.logfh.write("Running on host: " + gethostname() + "\n")
 
     # QM calculations are done here
     # First the molecule is optimized. (-opt) 
@@ -3408,20 +4833,20 @@ def main():
     # This is used by GDMA to find multipoles
     # Then information for generating the electrostatic potential grid is found (-esp)
     # This information is used by cubegen
-    optmol = run_gaussian(mol)
+    optmol = run_gaussian(session, session.mol)
 
     # End here if qm calculations were all that needed to be done 
-    if qmonly:
+    if session.qmonly:
         now = time.strftime("%c",time.localtime())
-        logfh.write(now + " poltype QM-only complete.\n")
-        logfh.close()
+        session.logfh.write(now + " poltype QM-only complete.\n")
+        session.logfh.close()
         sys.exit(0)
 
     # Initializing arrays
-    symmetryclass = [ 0 ] * mol.NumAtoms()
-    canonicallabel = [ 0 ] * mol.NumAtoms()
-    localframe1 = [ 0 ] * mol.NumAtoms()
-    localframe2 = [ 0 ] * mol.NumAtoms()
+    session.symmetryclass = [ 0 ] * session.mol.NumAtoms()
+    session.canonicallabel = [ 0 ] * session.mol.NumAtoms()
+    session.localframe1 = [ 0 ] * session.mol.NumAtoms()
+    session.localframe2 = [ 0 ] * session.mol.NumAtoms()
 
     # Finds the symmetry class for each atom
     # For example in the molecule ethanol: CH3-CH2-OH
@@ -3429,74 +4854,81 @@ def main():
     # The 2 Hydrogens bound to the second carbon all belong to a second symmetry class
     # The rest of the atoms all belong to their own individual symmetry classes
     # Many babel tools are used in finding the symmetry classes
-    gen_canonicallabels(mol)
+    gen_canonicallabels(session, session.mol)
    
     # scaling of multipole values for certain atom types
     # checks if the molecule contains any atoms that should have their multipole values scaled
-    scalelist = process_types(mol)
+    scalelist = process_types(session, session.mol)
     
     # if the omittorsion2 flag has been selected, poltype will know not to scan for the torsions
     # of certain rotatble bonds
-    if(omittorsion2):
-        gen_toromit_list()
+    if(session.omittorsion2):
+        gen_toromit_list(session)
    
     # Find rotatable bonds for future torsion scans
-    (torlist, rotbndlist) = get_torlist(mol)
-    torlist = get_torlist_opt_angle(optmol, torlist)
+    (session.torlist, session.rotbndlist) = get_torlist(session, session.mol)
+    session.torlist = get_torlist_opt_angle(optmol, session.torlist)
+    session.scantorlist = dedup_torlist(session, session.torlist)
 
     # Obtain multipoles from Gaussian fchk file using GDMA
-    if not os.path.isfile(gdmafname):
-        run_gdma()
+    if not os.path.isfile(session.path(session.gdmafname)):
+        run_gdma(session)
 
     # Set up input file for poledit
     # find multipole local frame definitions 
-    lfzerox = gen_peditinfile(mol)
+    lfzerox = gen_peditinfile(session, session.mol)
     
     
-    if (not os.path.isfile(xyzfname) or not os.path.isfile(keyfname)):
+    if (not os.path.isfile(session.path(session.xyzfname)) or not os.path.isfile(session.path(session.keyfname))):
         # Run poledit
-        cmdstr = peditexe + " 1 " + gdmafname + " < " + peditinfile
-        call_subsystem(cmdstr)
+        cmdstr = session.peditexe + " 1 " + session.gdmafname + " < " + session.peditinfile
+        call_subsystem(session, cmdstr)
+        keyf = tinkerkey.KeyFile.read(session.path(session.keyfname))
         # Add header to the key file output by poledit
-        prepend_keyfile(keyfname)
+        prepend_keyfile(session, keyf)
+    else:
+        keyf = tinkerkey.KeyFile.read(session.path(session.keyfname))
     # post process local frames written out by poledit
-    post_proc_localframes(keyfname, lfzerox)
+    post_proc_localframes(session, keyf, lfzerox)
+    keyf.write(session.path(session.keyfname))
     # generate the electrostatic potential grid used for multipole fitting
-    gen_esp_grid()
+    gen_esp_grid(session)
 
     # Average multipoles based on molecular symmetry
     # Does this using the script avgmpoles.pl which is found in the poltype directory
     # Atoms that belong to the same symm class will now have only one common multipole definition
-    if uniqidx:
-        shutil.copy(keyfname, key2fname)
-        prepend_keyfile(key2fname)
-    elif ((not os.path.isfile(xyzoutfile) or
-            not os.path.isfile(key2fname)) and
-            not uniqidx):
+    if session.uniqidx:
+        prepend_keyfile(session, keyf)
+        keyf.write(session.path(session.key2fname))
+    elif ((not os.path.isfile(session.path(session.xyzoutfile)) or
+            not os.path.isfile(session.path(session.key2fname))) and
+            not session.uniqidx):
         # gen input file
-        gen_avgmpole_groups_file()
+        gen_avgmpole_groups_file(session)
         # call avgmpoles.pl
-        avgmpolecmdstr = avgmpolesexe + " " + keyfname + " " + xyzfname + " " + grpfname + " " + key2fname + " " + xyzoutfile + " " + str(prmstartidx)
-        call_subsystem(avgmpolecmdstr)
-        prepend_keyfile(key2fname)
+        avgmpolecmdstr = avgmpolesexe + " " + session.keyfname + " " + session.xyzfname + " " + session.grpfname + " " + session.key2fname + " " + session.xyzoutfile + " " + str(session.prmstartidx)
+        call_subsystem(session, avgmpolecmdstr)
+        keyf = tinkerkey.KeyFile.read(session.path(session.key2fname))
+        prepend_keyfile(session, keyf)
+        keyf.write(session.path(session.key2fname))
 
-    if espfit:
+    if session.espfit:
         # Optimize multipole parameters to QM ESP Grid (*.cube_2)
         # tinker's potential utility is called, with option 6.
         # option 6 reads: 'Fit Electrostatic Parameters to a Target Grid' 
-        if not os.path.isfile(key3fname):
-            optmpolecmd = potentialexe + " 6 " + xyzoutfile + " -k " + key2fname + " " + qmesp2fname + " N 0.5"
-            call_subsystem(optmpolecmd)
+        if not os.path.isfile(session.path(session.key3fname)):
+            optmpolecmd = session.potentialexe + " 6 " + session.xyzoutfile + " -k " + session.key2fname + " " + session.qmesp2fname + " N 0.5"
+            call_subsystem(session, optmpolecmd)
     else:
-        shutil.copy(key2fname, key3fname)
+        shutil.copy(session.path(session.key2fname), session.path(session.key3fname))
     # Remove header terms from the keyfile
-    rm_esp_terms_keyfile(key3fname)
+    keyf = tinkerkey.KeyFile.read(session.path(session.key3fname))
+    rm_esp_terms_keyfile(session, keyf)
+    keyf.write(session.path(session.key3fname))
 
-    if not os.path.isfile(key4fname):
-        shutil.copy(key3fname, key4fname)
-        
+    if not os.path.isfile(session.path(session.key4fname)):
         # Multipoles are scaled if needed using the scale found in process_types
-        post_process_mpoles(key4fname, scalelist)
+        post_process_mpoles(keyf, scalelist)
         
         # Now that multipoles have been found
         # Other parameters such as opbend, vdw, etc. are found here using a look up table
@@ -3506,102 +4938,85 @@ def main():
         # Finds aromatic carbons and associated hydrogens and corrects polarizability
         # Find opbend values using a look up table
         # Outputs a list of rotatable bonds (found in get_torlist) in a form usable by valence.py
-        oblist, rotbndlist_forvalence = gen_valinfile(mol)
+        oblist, rotbndlist_forvalence = gen_valinfile(session, session.mol)
 
         # Map from idx to symm class is made for valence.py
         idxtoclass=[]
-        for i in range(mol.NumAtoms()):
-            idxtoclass.append(get_class_number(i+1))
-        v = valence.Valence(output_format)
+        for i in range(session.mol.NumAtoms()):
+            idxtoclass.append(get_class_number(session, i+1))
+        v = valence.Valence(session.output_format)
         v.setidxtoclass(idxtoclass)
         dorot = True
 
         # valence.py method is called to find parameters and append them to the keyfile
-        v.appendtofile(key4fname, optmol, oblist, dorot, rotbndlist_forvalence) 
+        keyf.extend(v.guesslines(optmol, oblist, dorot, rotbndlist_forvalence))
+        keyf.write(session.path(session.key4fname))
 
     # Torsion scanning then fitting. *.key_5 will contain updated torsions
     # default, parmtors = True
-    if (parmtors):
+    if (session.parmtors):
         # torsion scanning
-        gen_torsion(optmol)
-    if (parmtors):
+        gen_torsion(session, optmol)
+    if (session.parmtors):
         # torsion fitting
-        process_rot_bond_tors(optmol)
+        process_rot_bond_tors(session, optmol)
     else:
-        shutil.copy(key4fname,key5fname)
+        shutil.copy(session.path(session.key4fname),session.path(session.key5fname))
 
     #If the output format is set to tinker 4, a key_6
     #is created with parameters in the tinker 4 format
-    if output_format == 4:
-        key5 = open(key5fname)
-        key6 = open(keyfname+"_6","w")
-        for line in key5:
-            if 'polarize' in line:
-                ln = ""
-                for i in range(len(line.split())):
-                    if i != 3:
-                        if i == 1:
-                            ln += line.split()[i] + "                          "
-                        else:
-                            ln += line.split()[i] + "  "
-                ln += "\n"
-                key6.write(ln)
-            else:
-                key6.write(line)
+    if session.output_format == 4:
+        keyf = tinkerkey.KeyFile.read(session.path(session.key5fname))
+        convert_tinker4_polarize(keyf)
+        keyf.write(session.path(session.keyfname+"_6"))
 
-    gen_tinker5_to_4_convert_input(mol, amoeba_conv_spec_fname)
+    gen_tinker5_to_4_convert_input(session, session.mol, amoeba_conv_spec_fname)
 
     # A series of tests are done so you one can see whether or not the parameterization values
-    # found are acceptable and to what degree
-    logfh.write("\n")
-    logfh.write("=========================================================\n")
-    logfh.write("Minimizing structure\n\n")
-    logfh.flush()
-    os.fsync(logfh.fileno())
-
-    cmd='cp ' + xyzoutfile + ' ' + tmpxyzfile
-    os.system(cmd)
-    cmd='cp ' + key5fname + ' ' + tmpkeyfile
-    os.system(cmd)
-    cmd = minimizeexe + ' ' + tmpxyzfile + ' 0.1 '
-    call_subsystem(cmd)
-    logfh.flush()
-    os.fsync(logfh.fileno())
-
-    logfh.write("\n")
-    logfh.write("=========================================================\n")
-    logfh.write("QM Dipole moment\n\n")
-    logfh.flush()
-    os.fsync(logfh.fileno())
-    grepcmd = 'grep -A7 "Dipole moment" ' + logespfname
-    call_subsystem(grepcmd)
-    logfh.flush()
-    os.fsync(logfh.fileno())
-
-    logfh.write("\n")
-    logfh.write("=========================================================\n")
-    logfh.write("MM Dipole moment\n\n")
-    logfh.flush()
-    os.fsync(logfh.fileno())
-    cmd=analyzeexe + ' ' +  xyzoutfile + ' em | grep -A11 Charge'
-    call_subsystem(cmd,iscritical=True)
-
-    gen_superposeinfile()
-    logfh.write("\n")
-    logfh.write("=========================================================\n")
-    logfh.write("Structure RMSD Comparison\n\n")
-    logfh.flush()
-    os.fsync(logfh.fileno())
-    cmd = superposeexe + ' ' + xyzoutfile + ' ' + tmpxyzfile + '_2' + ' < ' + superposeinfile + '| grep -A1000 "Root Mean"'
-    call_subsystem(cmd)
-
-    logfh.write("\n")
-    logfh.write("=========================================================\n")
-    logfh.write("Electrostatic Potential Comparision\n\n")
-    logfh.flush()
-    os.fsync(logfh.fileno())
-    cmd=potentialexe + ' 5 ' + xyzoutfile + ' ' + qmesp2fname + ' N | grep -A1000 "Average Electrostatic"'
-    call_subsystem(cmd)
+    # found are acceptable and to what degree. The independent tests run at the same time;
+    # the RMSD comparison needs the minimized structure. The output of each test is
+    # written to the log file under its own heading, in a fixed order.
+    cmd='cp ' + session.xyzoutfile + ' ' + session.tmpxyzfile
+    call_subsystem(session, cmd)
+    cmd='cp ' + session.key5fname + ' ' + session.tmpkeyfile
+    call_subsystem(session, cmd)
+    gen_superposeinfile(session)
+    pendingplots = start_deferred_plots(session)
+    mincmd = session.minimizeexe + ' ' + session.tmpxyzfile + ' 0.1 '
+    grepcmd = 'grep -A7 "Dipole moment" ' + session.logespfname
+    dipolecmd = session.analyzeexe + ' ' +  session.xyzoutfile + ' em | grep -A11 Charge'
+    potentialcmd = session.potentialexe + ' 5 ' + session.xyzoutfile + ' ' + session.qmesp2fname + ' N | grep -A1000 "Average Electrostatic"'
+    superposecmd = session.superposeexe + ' ' + session.xyzoutfile + ' ' + session.tmpxyzfile + '_2' + ' < ' + session.superposeinfile + '| grep -A1000 "Root Mean"'
+    minresult, grepresult, dipoleresult, potentialresult = call_subsystems(session, 
+        [mincmd, grepcmd, dipolecmd, potentialcmd], 4, logoutput=False)
+    superposeresult = call_subsystems(session, [superposecmd], logoutput=False)[0]
+
+    for (title, result) in [("Minimizing structure", minresult),
+                            ("QM Dipole moment", grepresult),
+                            ("MM Dipole moment", dipoleresult),
+                            ("Structure RMSD Comparison", superposeresult),
+                            ("Electrostatic Potential Comparision", potentialresult)]:
+        session.logfh.write("\n")
+        session.logfh.write("=========================================================\n")
+        session.logfh.write(title + "\n\n")
+        session.logfh.write(result.output)
+    finish_deferred_plots(session, pendingplots)
+    session.logfh.flush()
+    if dipoleresult.returncode != 0:
+        sys.exit(1)
+
+#POLTYPE BEGINS HERE
+def main():
+    session = Session()
+    parse_options(session, sys.argv)
+    if session.submitdir is not None:
+        submit_job(session)
+    elif session.workerdir is not None:
+        run_worker(session)
+    elif session.batchfname is not None:
+        run_batch(session)
+    else:
+        run_poltype(session)
 
 if __name__ == '__main__':
     main()
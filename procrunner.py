@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+##################################################################
+#
+# Title: procrunner.py
+# Description: Runner for external programs (Gaussian, Tinker, GDMA)
+#               with per-process output capture, timeouts and
+#               resource accounting
+#
+# Poltype is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Poltype is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+##################################################################
+
+import os
+import re
+import time
+import shlex
+import signal
+import asyncio
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+from concurrent import futures
+
+# Characters that need a shell to be interpreted (redirection, pipes, globs, ...)
+SHELL_CHARS = re.compile(r'[<>|;&*?$`(){}\[\]~]')
+
+class ProcessJob(object):
+    """
+    Intent: Description of one external program run
+    Input:
+        cmd: command string, or list of arguments. A string that needs no shell
+             features is split and run directly; otherwise it is run by /bin/sh
+        cwd: working directory (default: current directory)
+        env: extra environment variables for this process
+        stdinfname: file to use as standard input
+        stdoutfname: file to write standard output to; by default output is captured
+        timeout: seconds after which the process (and its children) is killed
+    """
+    def __init__(self, cmd, cwd=None, env=None, stdinfname=None, stdoutfname=None, timeout=None):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.stdinfname = stdinfname
+        self.stdoutfname = stdoutfname
+        self.timeout = timeout
+
+    def cmdstr(self):
+        if isinstance(self.cmd, str):
+            return self.cmd
+        return ' '.join(shlex.quote(arg) for arg in self.cmd)
+
+# returncode: exit code (negative signal number if killed)
+# walltime: seconds; maxrss: peak resident set size in kB
+# output: captured stdout and stderr (empty if written to stdoutfname)
+ProcessResult = namedtuple('ProcessResult',
+    ['cmd', 'returncode', 'walltime', 'maxrss', 'output', 'timedout'])
+
+def run_process(job):
+    """
+    Intent: Run one external program and wait for it
+    Input:
+        job: ProcessJob
+    Output:
+        ProcessResult
+    Description:
+    The process gets its own session so that a timeout kills the whole process group
+    (e.g. a shell and the program it started). os.wait4 is used instead of Popen.wait
+    to get the peak memory use of the process.
+    """
+    if isinstance(job.cmd, str) and SHELL_CHARS.search(job.cmd) is None:
+        args = shlex.split(job.cmd)
+        shell = False
+    else:
+        args = job.cmd
+        shell = isinstance(job.cmd, str)
+
+    env = None
+    if job.env:
+        env = dict(os.environ)
+        env.update(job.env)
+
+    stdinfh = None
+    if job.stdinfname is not None:
+        stdinfh = open(job.stdinfname, 'rb')
+    if job.stdoutfname is not None:
+        outfh = open(job.stdoutfname, 'wb')
+    else:
+        outfh = tempfile.TemporaryFile()
+
+    timedout = []
+    start = time.time()
+    try:
+        try:
+            p = subprocess.Popen(args, shell=shell, cwd=job.cwd, env=env,
+                stdin=stdinfh, stdout=outfh, stderr=subprocess.STDOUT,
+                start_new_session=True)
+        except OSError as err:
+            output = '%s: %s\n' % (job.cmdstr(), err)
+            return ProcessResult(job.cmdstr(), 127, time.time() - start, 0, output, False)
+
+        timer = None
+        if job.timeout is not None:
+            def kill():
+                timedout.append(True)
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            timer = threading.Timer(job.timeout, kill)
+            timer.daemon = True
+            timer.start()
+        pid, status, rusage = os.wait4(p.pid, 0)
+        if timer is not None:
+            timer.cancel()
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        walltime = time.time() - start
+
+        output = ''
+        if job.stdoutfname is None:
+            outfh.seek(0)
+            output = outfh.read().decode('utf-8', 'replace')
+    finally:
+        outfh.close()
+        if stdinfh is not None:
+            stdinfh.close()
+    return ProcessResult(job.cmdstr(), p.returncode, walltime, rusage.ru_maxrss,
+        output, bool(timedout))
+
+async def run_processes_async(jobs, maxjobs=1, callback=None):
+    """
+    Intent: Run many external programs, at most 'maxjobs' at a time
+    Input:
+        jobs: list of ProcessJob
+        maxjobs: maximum number of processes running at the same time
+        callback: called as callback(job, result) when each process finishes
+    Output:
+        results: list of ProcessResult, in the order of 'jobs'
+    Description:
+    Each process is waited for in a worker thread ('run_process'), because only
+    os.wait4 reports its resource use; the event loop schedules the jobs.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(maxjobs)
+    with futures.ThreadPoolExecutor(max_workers=maxjobs) as executor:
+        async def run_one(job):
+            async with semaphore:
+                result = await loop.run_in_executor(executor, run_process, job)
+            if callback is not None:
+                callback(job, result)
+            return result
+        return await asyncio.gather(*[run_one(job) for job in jobs])
+
+def run_processes(jobs, maxjobs=1, callback=None):
+    """
+    Intent: Blocking wrapper around 'run_processes_async'
+    """
+    if not jobs:
+        return []
+    return asyncio.run(run_processes_async(jobs, max(1, maxjobs), callback))
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+##################################################################
+#
+# Title: qmcache.py
+# Description: Persistent on-disk cache of Gaussian results, keyed
+#               by geometry, charge, multiplicity, route and restraints
+#
+# Poltype is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Poltype is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+##################################################################
+
+import os
+import re
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+
+# Bump this when the key layout changes so that old entries are no longer found
+CACHE_VERSION = 1
+
+# Coordinates are rounded to this many decimals (Angstrom) before hashing
+COORD_DECIMALS = 4
+
+class QMCache:
+    """
+    Intent: Content-addressed store of finished Gaussian jobs
+    The key of a job is a hash of its canonicalized *.com file: route section,
+    charge and multiplicity, rounded coordinates and all trailing sections
+    (modredundant restraints, Gen basis sets). Link 0 commands (%Mem, %Nproc,
+    %Chk, %RWF), MaxDisk and the title are left out, since they do not change
+    the result. Each entry keeps the *.log file, optionally the *.fchk file, the
+    parsed energy and the final geometry. Entries are evicted least recently used
+    first once the cache grows past 'maxsize' bytes.
+    """
+    def __init__(self, cachedir, maxsize, program=''):
+        self.cachedir = os.path.abspath(cachedir)
+        self.maxsize = maxsize
+        self.program = os.path.basename(program)
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        self.dbfname = os.path.join(self.cachedir, 'index.sqlite')
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'key TEXT PRIMARY KEY, energy REAL, geometry TEXT, '
+                       'logpath TEXT, fchkpath TEXT, size INTEGER, '
+                       'created REAL, lastused REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.dbfname, timeout=600)
+
+    def com_key(self, comfname):
+        """
+        Intent: Return the cache key of the Gaussian input file 'comfname'
+        """
+        canon = ['poltype-qmcache %d' % CACHE_VERSION, self.program]
+        canon.extend(canonicalize_com(comfname))
+        return hashlib.sha256('\n'.join(canon).encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        """
+        Intent: Return the entry for 'key' as a dict, or None if it is not cached
+        A hit counts as a use for the LRU eviction.
+        """
+        with self._connect() as db:
+            row = db.execute('SELECT energy, geometry, logpath, fchkpath FROM entries '
+                             'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.isfile(os.path.join(self.cachedir, row[2])):
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+            db.execute('UPDATE entries SET lastused = ? WHERE key = ?', (time.time(), key))
+        entry = {'energy': row[0], 'geometry': json.loads(row[1]),
+                 'log': os.path.join(self.cachedir, row[2]), 'fchk': None}
+        if row[3] and os.path.isfile(os.path.join(self.cachedir, row[3])):
+            entry['fchk'] = os.path.join(self.cachedir, row[3])
+        return entry
+
+    def restore_log(self, key, logfname, needfchk=False):
+        """
+        Intent: Copy the cached *.log file for 'key' to 'logfname'
+        Output: True on a cache hit, False otherwise
+        With 'needfchk', an entry without an *.fchk file (e.g. formchk failed after the
+        log was stored) is a miss, so that the job is run again.
+        """
+        entry = self.lookup(key)
+        if entry is None or (needfchk and entry['fchk'] is None):
+            return False
+        _copy_atomic(entry['log'], logfname)
+        return True
+
+    def restore_fchk(self, key, fchkfname):
+        """
+        Intent: Copy the cached *.fchk file for 'key' to 'fchkfname'
+        Output: True on a cache hit that has an fchk file, False otherwise
+        """
+        entry = self.lookup(key)
+        if entry is None or entry['fchk'] is None:
+            return False
+        _copy_atomic(entry['fchk'], fchkfname)
+        return True
+
+    def store_log(self, key, logfname):
+        """
+        Intent: Add the finished Gaussian job in 'logfname' to the cache under 'key'
+        """
+        relpath = self._relpath(key, '.log')
+        _copy_atomic(logfname, os.path.join(self.cachedir, relpath))
+        energy, geometry = parse_gaussian_log(logfname)
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, NULL, ?, ?, ?)',
+                       (key, energy, json.dumps(geometry), relpath,
+                        os.path.getsize(logfname), now, now))
+        self.evict()
+
+    def store_fchk(self, key, fchkfname):
+        """
+        Intent: Attach the formatted checkpoint file 'fchkfname' to the entry for 'key'
+        """
+        with self._connect() as db:
+            row = db.execute('SELECT logpath FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return
+        relpath = self._relpath(key, '.fchk')
+        _copy_atomic(fchkfname, os.path.join(self.cachedir, relpath))
+        with self._connect() as db:
+            db.execute('UPDATE entries SET fchkpath = ?, size = size + ?, lastused = ? '
+                       'WHERE key = ?', (relpath, os.path.getsize(fchkfname), time.time(), key))
+        self.evict()
+
+    def evict(self):
+        """
+        Intent: Remove least recently used entries until the cache fits in 'maxsize'
+        """
+        with self._connect() as db:
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= self.maxsize:
+                return
+            rows = db.execute('SELECT key, logpath, fchkpath, size FROM entries '
+                              'ORDER BY lastused').fetchall()
+            for (key, logpath, fchkpath, size) in rows:
+                if total <= self.maxsize:
+                    break
+                for relpath in (logpath, fchkpath):
+                    if relpath and os.path.isfile(os.path.join(self.cachedir, relpath)):
+                        os.remove(os.path.join(self.cachedir, relpath))
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                total -= size
+
+    def _relpath(self, key, ext):
+        subdir = os.path.join(self.cachedir, key[:2])
+        if not os.path.isdir(subdir):
+            try:
+                os.makedirs(subdir)
+            except OSError:
+                if not os.path.isdir(subdir):
+                    raise
+        return os.path.join(key[:2], key + ext)
+
+def _copy_atomic(srcfname, dstfname):
+    """
+    Intent: Copy a file so that readers never see a partly written 'dstfname'
+    """
+    dstdir = os.path.dirname(os.path.abspath(dstfname))
+    tmpfh, tmpfname = tempfile.mkstemp(dir=dstdir, prefix='.qmcache-')
+    os.close(tmpfh)
+    try:
+        shutil.copyfile(srcfname, tmpfname)
+        os.replace(tmpfname, dstfname)
+    except BaseException:
+        if os.path.isfile(tmpfname):
+            os.remove(tmpfname)
+        raise
+
+def canonicalize_com(comfname):
+    """
+    Intent: Reduce a Gaussian input file to the parts that determine its result
+    Input:
+        comfname: Gaussian *.com file
+    Output:
+        canon: list of normalized lines
+    Description:
+    1. Skip Link 0 (%) commands
+    2. Route section: join, lowercase, collapse white space and drop MaxDisk
+    3. Skip the title section
+    4. Keep the charge and multiplicity line
+    5. Round the coordinates to COORD_DECIMALS
+    6. Keep every following section (restraints, basis sets) with normalized white space
+    """
+    lines = [line.strip() for line in open(comfname)]
+    sections = [[]]
+    for line in lines:
+        if line.startswith('%') and len(sections) == 1 and not sections[0]:
+            continue
+        if line == '':
+            if sections[-1]:
+                sections.append([])
+            continue
+        sections[-1].append(line)
+    if not sections[-1]:
+        sections.pop()
+
+    canon = []
+    route = ' '.join(sections[0]).lower()
+    route = re.sub(r'maxdisk=\S+', '', route)
+    canon.append('route ' + ' '.join(route.split()))
+    if len(sections) > 2:
+        geometry = sections[2]
+        canon.append('chgmult ' + ' '.join(geometry[0].split()))
+        for atomline in geometry[1:]:
+            fields = atomline.split()
+            try:
+                coords = ['%.*f' % (COORD_DECIMALS, float(x)) for x in fields[1:4]]
+                # avoid distinct keys for -0.0000 and 0.0000
+                coords = [x if float(x) != 0.0 else '%.*f' % (COORD_DECIMALS, 0.0) for x in coords]
+                canon.append('atom %s %s' % (fields[0].capitalize(), ' '.join(coords)))
+            except (ValueError, IndexError):
+                canon.append('atom ' + ' '.join(fields))
+    for section in sections[3:]:
+        canon.append('section')
+        canon.extend(' '.join(line.split()) for line in section)
+    return canon
+
+def parse_gaussian_log(logfname):
+    """
+    Intent: Find the final energy (Hartree) and geometry in a Gaussian *.log file
+    Output:
+        energy: last MP2 energy if present, else last SCF energy (None if neither is found)
+        geometry: list of [atomic number, x, y, z] from the last 'Standard orientation'
+    """
+    energy = None
+    scfenergy = None
+    geometry = []
+    orientlines = None
+    for line in open(logfname):
+        m = re.search(r'SCF Done:\s+E\(\S+\)\s+=\s+(-?\d+\.\d+)', line)
+        if m is not None:
+            scfenergy = float(m.group(1))
+        m = re.search(r'EUMP2 =\s+(-?\d+\.\d+D[+-]\d+)', line)
+        if m is not None:
+            energy = float(m.group(1).replace('D', 'E'))
+        if 'Standard orientation' in line:
+            orientlines = []
+            continue
+        if orientlines is not None:
+            orientlines.append(line)
+            # header is 4 lines, then atoms until the closing dashes
+            if len(orientlines) > 5 and line.strip().startswith('---'):
+                geometry = []
+                for atomline in orientlines[4:-1]:
+                    fields = atomline.split()
+                    geometry.append([int(fields[1])] + [float(x) for x in fields[3:6]])
+                orientlines = None
+    if energy is None:
+        energy = scfenergy
+    return energy, geometry
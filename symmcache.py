@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+##################################################################
+#
+# Title: symmcache.py
+# Description: Persistent on-disk cache of atom symmetry classes,
+#               keyed by the canonical SMILES of the molecule
+#
+# Poltype is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Poltype is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+##################################################################
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+# Bump this when the symmetry class algorithm changes so that old entries are no longer found
+SYMMETRY_VERSION = 1
+
+class SymmetryCache:
+    """
+    Intent: Store of the symmetry classes of molecules seen in earlier runs
+    The key of a molecule is a hash of its canonical SMILES (with explicit hydrogens),
+    SYMMETRY_VERSION and the version of the toolkit that made the SMILES. The classes
+    are stored in canonical atom order, i.e. the order of the atoms in the SMILES, so
+    that an entry can be used for any input file of the same molecule whatever the
+    order of its atoms.
+    """
+    def __init__(self, cachedir, toolkit=''):
+        self.cachedir = os.path.abspath(cachedir)
+        self.toolkit = toolkit
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        self.dbfname = os.path.join(self.cachedir, 'symmetry.sqlite')
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS symmetry ('
+                       'key TEXT PRIMARY KEY, smiles TEXT, classes TEXT, created REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.dbfname, timeout=600)
+
+    def smiles_key(self, smiles):
+        """
+        Intent: Return the cache key of the canonical SMILES 'smiles'
+        """
+        canon = ['poltype-symmcache %d' % SYMMETRY_VERSION, self.toolkit, smiles]
+        return hashlib.sha256('\n'.join(canon).encode('utf-8')).hexdigest()
+
+    def lookup(self, smiles):
+        """
+        Intent: Return the symmetry classes stored for 'smiles' in canonical atom order,
+        or None if the molecule is not cached
+        """
+        key = self.smiles_key(smiles)
+        with self._connect() as db:
+            row = db.execute('SELECT smiles, classes FROM symmetry WHERE key = ?',
+                             (key,)).fetchone()
+        if row is None or row[0] != smiles:
+            return None
+        return json.loads(row[1])
+
+    def store(self, smiles, classes):
+        """
+        Intent: Add the symmetry classes 'classes' (in canonical atom order) for 'smiles'
+        """
+        key = self.smiles_key(smiles)
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO symmetry VALUES (?, ?, ?, ?)',
+                       (key, smiles, json.dumps(classes), time.time()))
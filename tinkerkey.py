@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+##################################################################
+#
+# Title: tinkerkey.py
+# Description: In-memory model of a tinker key file, so that each
+#               post-processing stage edits parsed terms instead of
+#               rewriting the file line by line
+#
+# Poltype is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Poltype is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+##################################################################
+
+import os
+
+# Number of lines that follow the first line of a term; the multipole values
+# (dipole and three rows of the quadrupole) are written below the frame and charge
+CONTINUATION_LINES = {'multipole': 4}
+
+# Keywords of the force field parameter terms; every other term is part of the header
+VALENCE_KEYWORDS = ('vdw', 'vdwpr', 'vdwpair', 'bond', 'angle', 'anglep', 'strbnd',
+                    'ureybrad', 'opbend', 'opdist', 'improper', 'imptors', 'pitors',
+                    'strtors', 'angtors', 'tortors')
+PARAMETER_KEYWORDS = ('atom', 'multipole', 'polarize', 'torsion') + VALENCE_KEYWORDS
+
+class KeyTerm:
+    """
+    Intent: One term of a key file: a keyword line and its continuation lines
+    The lines are kept as written (with their newlines), so a term that is not
+    edited is written back unchanged.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+
+    @property
+    def fields(self):
+        return self.lines[0].split()
+
+    @property
+    def keyword(self):
+        fields = self.fields
+        if not fields:
+            return ''
+        return fields[0].lower()
+
+    @property
+    def atomtype(self):
+        """
+        Intent: Atom type (or class) of an atom, multipole or polarize term, else None
+        """
+        fields = self.fields
+        if len(fields) < 2:
+            return None
+        return fields[1]
+
+class KeyFile:
+    """
+    Intent: Parsed tinker key file
+    The file is a list of KeyTerm objects in file order. 'header', 'atoms',
+    'multipoles', 'polarize', 'valence' and 'torsions' return the terms of each kind;
+    editing a returned term edits the key file. Nothing is written to disk until 'write'.
+    """
+    def __init__(self, terms=None):
+        self.terms = terms if terms is not None else []
+
+    @classmethod
+    def read(cls, keyfname):
+        keyfh = open(keyfname)
+        keyf = cls(parse_terms(keyfh.readlines()))
+        keyfh.close()
+        return keyf
+
+    def write(self, keyfname):
+        """
+        Intent: Write the key file to 'keyfname' so that readers never see it partly written
+        """
+        tmpfname = keyfname + "_tmp"
+        keyfh = open(tmpfname, 'w')
+        for term in self.terms:
+            keyfh.writelines(term.lines)
+        keyfh.close()
+        os.replace(tmpfname, keyfname)
+
+    def prepend(self, lines):
+        self.terms[0:0] = parse_terms(lines)
+
+    def extend(self, lines):
+        self.terms.extend(parse_terms(lines))
+
+    def remove(self, test):
+        """
+        Intent: Drop every term for which test(term) is true
+        """
+        self.terms = [term for term in self.terms if not test(term)]
+
+    def merge_duplicates(self, keyword):
+        """
+        Intent: Keep one 'keyword' term per atom type
+        The term stays in the place of the first definition of its atom type and takes
+        the lines of the last one (e.g. the multipoles written by a potential fit).
+        """
+        terms = []
+        termidx = {}
+        for term in self.terms:
+            if term.keyword == keyword and term.atomtype is not None:
+                if term.atomtype in termidx:
+                    terms[termidx[term.atomtype]] = term
+                    continue
+                termidx[term.atomtype] = len(terms)
+            terms.append(term)
+        self.terms = terms
+
+    def select(self, *keywords):
+        return [term for term in self.terms if term.keyword in keywords]
+
+    def header(self):
+        return [term for term in self.terms
+                if term.keyword and term.keyword not in PARAMETER_KEYWORDS]
+
+    def atoms(self):
+        return self.select('atom')
+
+    def multipoles(self):
+        return self.select('multipole')
+
+    def polarize(self):
+        return self.select('polarize')
+
+    def valence(self):
+        return self.select(*VALENCE_KEYWORDS)
+
+    def torsions(self):
+        return self.select('torsion')
+
+def parse_terms(lines):
+    """
+    Intent: Group key file lines into KeyTerm objects
+    Input:
+        lines: list of lines, with newlines
+    Output:
+        terms: list of KeyTerm; blank lines and comments are terms of their own
+    """
+    terms = []
+    ln = 0
+    while ln < len(lines):
+        fields = lines[ln].split()
+        nextra = 0
+        if fields:
+            nextra = CONTINUATION_LINES.get(fields[0].lower(), 0)
+        terms.append(KeyTerm(lines[ln:ln + 1 + nextra]))
+        ln += 1 + nextra
+    return terms
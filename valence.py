@@ -28,13 +28,419 @@
 
 import openbabel
 import math
+import threading
 radian = 57.29577951308232088
+
+# Parsed SMARTS patterns, shared by all Valence objects in this process
+smartspatterns = {}
+# OBSmartsPattern keeps the result of its last Match, so parsing and matching
+# a shared pattern is done under this lock
+smartslock = threading.Lock()
+
+def get_smarts_pattern(smarts):
+    """
+    Return the OBSmartsPattern for 'smarts'; each SMARTS string is parsed only once per process.
+    The caller must hold 'smartslock'.
+    """
+    sp = smartspatterns.get(smarts)
+    if sp is None:
+        sp = openbabel.OBSmartsPattern()
+        sp.Init(smarts)
+        smartspatterns[smarts] = sp
+    return sp
+
+# Requirements of each SMARTS string on the atoms of a molecule (see smarts_requirements)
+smartsrequirements = {}
+
+ALIPHATIC_SYMBOLS = {'B': 5, 'C': 6, 'N': 7, 'O': 8, 'F': 9, 'P': 15, 'S': 16,
+                     'Cl': 17, 'Br': 35, 'I': 53}
+AROMATIC_SYMBOLS = {'b': 5, 'c': 6, 'n': 7, 'o': 8, 'p': 15, 's': 16}
+
+def smarts_atom_primitive(text, i):
+    """
+    Read one primitive of a bracket atom starting at text[i].
+    Returns (atoms, i) where 'atoms' is the set of (atomic number, aromatic) pairs the
+    primitive allows, or None if it does not restrict the element (H count, degree,
+    charge, ring, '*', 'a', recursive SMARTS, ...), and i is the index after the primitive.
+    """
+    ch = text[i]
+    if ch == '$' and text[i+1:i+2] == '(':
+        depth = 0
+        while i < len(text):
+            if text[i] == '(':
+                depth += 1
+            elif text[i] == ')':
+                depth -= 1
+                if depth == 0:
+                    return None, i + 1
+            i += 1
+        return None, i
+    if ch == '#':
+        j = i + 1
+        while j < len(text) and text[j].isdigit():
+            j += 1
+        z = int(text[i+1:j])
+        return frozenset([(z, False), (z, True)]), j
+    if ch.isupper():
+        if text[i:i+2] in ALIPHATIC_SYMBOLS:
+            return frozenset([(ALIPHATIC_SYMBOLS[text[i:i+2]], False)]), i + 2
+        if i + 1 < len(text) and text[i+1].islower():
+            # other two letter element
+            return None, i + 2
+        if ch in ALIPHATIC_SYMBOLS:
+            return frozenset([(ALIPHATIC_SYMBOLS[ch], False)]), i + 1
+    elif ch in AROMATIC_SYMBOLS and text[i:i+2] not in ('se', 'as'):
+        return frozenset([(AROMATIC_SYMBOLS[ch], True)]), i + 1
+    # any other primitive and its count (H3, D4, v0, ++, @@, ...)
+    j = i + 1
+    while j < len(text) and (text[j].isdigit() or text[j] == ch and ch in '+-@'):
+        j += 1
+    return None, j
+
+def smarts_bracket_end(smarts, i):
+    """
+    Return the index of the ']' that closes the bracket atom opened at smarts[i].
+    Brackets inside recursive SMARTS ('$(...)') are nested, so they are counted.
+    """
+    depth = 0
+    j = i
+    while j < len(smarts):
+        if smarts[j] == '[':
+            depth += 1
+        elif smarts[j] == ']':
+            depth -= 1
+            if depth == 0:
+                return j
+        j += 1
+    raise ValueError("unclosed bracket atom in SMARTS '%s'" % smarts)
+
+def smarts_split(text, sep):
+    """
+    Split the bracket atom 'text' at the operator 'sep', leaving the operators inside
+    recursive SMARTS ('$(...)') alone
+    """
+    parts = []
+    depth = 0
+    start = 0
+    for (i, ch) in enumerate(text):
+        if ch in '([':
+            depth += 1
+        elif ch in ')]':
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+def smarts_bracket_atoms(text):
+    """
+    Return the set of (atomic number, aromatic) pairs a bracket atom (without the brackets)
+    can match, or None if it can match any element.
+    Operator precedence: '!' > '&' (or no operator) > ',' > ';'
+    """
+    lowand = None
+    for part in smarts_split(text, ';'):
+        orset = frozenset()
+        for alt in smarts_split(part, ','):
+            andset = None
+            i = 0
+            while i < len(alt):
+                if alt[i] == '&':
+                    i += 1
+                    continue
+                negate = alt[i] == '!'
+                if negate:
+                    i += 1
+                atoms, i = smarts_atom_primitive(alt, i)
+                if atoms is not None and not negate:
+                    andset = atoms if andset is None else andset & atoms
+            if andset is None or orset is None:
+                orset = None
+            else:
+                orset = orset | andset
+        if orset is not None:
+            lowand = orset if lowand is None else lowand & orset
+    return lowand
+
+def smarts_requirements(smarts):
+    """
+    Return what a molecule needs for 'smarts' to possibly match: a list of
+    (atoms, count) pairs, meaning the molecule must have at least 'count' atoms whose
+    (atomic number, aromatic) pair is in 'atoms'. Pattern atoms that can match any
+    element add no requirement, so the test is conservative.
+    """
+    if smarts in smartsrequirements:
+        return smartsrequirements[smarts]
+    counts = {}
+    i = 0
+    while i < len(smarts):
+        ch = smarts[i]
+        atoms = None
+        isatom = True
+        if ch == '[':
+            j = smarts_bracket_end(smarts, i)
+            atoms = smarts_bracket_atoms(smarts[i+1:j])
+            i = j + 1
+        elif smarts[i:i+2] in ALIPHATIC_SYMBOLS:
+            atoms = frozenset([(ALIPHATIC_SYMBOLS[smarts[i:i+2]], False)])
+            i += 2
+        elif ch in ALIPHATIC_SYMBOLS:
+            atoms = frozenset([(ALIPHATIC_SYMBOLS[ch], False)])
+            i += 1
+        elif ch in AROMATIC_SYMBOLS:
+            atoms = frozenset([(AROMATIC_SYMBOLS[ch], True)])
+            i += 1
+        else:
+            # bonds, branches, ring closures, '*'
+            isatom = False
+            i += 1
+        # an empty set comes from contradictory primitives, leave those to OpenBabel
+        if isatom and atoms:
+            counts[atoms] = counts.get(atoms, 0) + 1
+    requirements = list(counts.items())
+    smartsrequirements[smarts] = requirements
+    return requirements
+
+def mol_atom_summary(mol):
+    """
+    Count the atoms of 'mol' by (atomic number, aromatic) pair
+    """
+    summary = {}
+    for atom in openbabel.OBMolAtomIter(mol):
+        key = (atom.GetAtomicNum(), bool(atom.IsAromatic()))
+        summary[key] = summary.get(key, 0) + 1
+    return summary
+
+def smarts_can_match(smarts, summary):
+    """
+    Return False if 'smarts' cannot match a molecule with the atom summary 'summary'
+    (see mol_atom_summary); True if it may match
+    """
+    for (atoms, count) in smarts_requirements(smarts):
+        if sum([summary.get(atom, 0) for atom in atoms]) < count:
+            return False
+    return True
+
+# Bonds between the pattern atoms of each SMARTS string (see smarts_bonds)
+smartsbonds = {}
+
+def smarts_bonds(smarts):
+    """
+    Return the bonded pairs of pattern atoms of 'smarts' as a set of (i, j) tuples, i < j,
+    with the atoms numbered in the order they appear (as in a match), or None if the
+    string uses syntax that is not read here.
+    """
+    if smarts in smartsbonds:
+        return smartsbonds[smarts]
+    bonds = set()
+    natoms = 0
+    prev = None
+    branches = []
+    rings = {}
+    i = 0
+    while i < len(smarts):
+        ch = smarts[i]
+        isatom = True
+        if ch == '[':
+            depth = 0
+            j = i
+            while j < len(smarts):
+                if smarts[j] == '[':
+                    depth += 1
+                elif smarts[j] == ']':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                j += 1
+            i = j + 1
+        elif smarts[i:i+2] in ALIPHATIC_SYMBOLS:
+            i += 2
+        elif ch in ALIPHATIC_SYMBOLS or ch in AROMATIC_SYMBOLS or ch == '*':
+            i += 1
+        else:
+            isatom = False
+        if isatom:
+            if prev is not None:
+                bonds.add((prev, natoms))
+            prev = natoms
+            natoms += 1
+            continue
+        if ch == '(':
+            branches.append(prev)
+        elif ch == ')':
+            if not branches:
+                bonds = None
+                break
+            prev = branches.pop()
+        elif ch == '.':
+            prev = None
+        elif ch.isdigit() or ch == '%':
+            if ch == '%':
+                label = smarts[i+1:i+3]
+                i += 2
+            else:
+                label = ch
+            if prev is None:
+                bonds = None
+                break
+            if label in rings:
+                bonds.add((rings.pop(label), prev))
+            else:
+                rings[label] = prev
+        elif ch not in '-=#:~@/\\!&,;':
+            bonds = None
+            break
+        i += 1
+    smartsbonds[smarts] = bonds
+    return bonds
+
+def smarts_is_chain(smarts, positions):
+    """
+    Return True if the pattern atoms at 'positions' of a match of 'smarts' are
+    bonded one after the other (a bond, angle or torsion chain), False if they are
+    not or if this cannot be told from the SMARTS string
+    """
+    if len(positions) < 2:
+        return True
+    bonds = smarts_bonds(smarts)
+    if bonds is None:
+        return False
+    for k in range(len(positions) - 1):
+        pair = (min(positions[k], positions[k+1]), max(positions[k], positions[k+1]))
+        if pair not in bonds:
+            return False
+    return True
+
+def mol_bonds(mol):
+    """
+    Return the (a,b) atom index tuples of all bonds of 'mol', in both directions
+    """
+    tuples = []
+    for bond in openbabel.OBMolBondIter(mol):
+        a = bond.GetBeginAtomIdx()
+        b = bond.GetEndAtomIdx()
+        tuples.append((a, b))
+        tuples.append((b, a))
+    return tuples
+
+def mol_angles(mol):
+    """
+    Return the (a,b,c) atom index tuples of all angles of 'mol', in both directions
+    """
+    tuples = []
+    for atom in openbabel.OBMolAtomIter(mol):
+        nbrs = [nbr.GetIdx() for nbr in openbabel.OBAtomAtomIter(atom)]
+        for a in nbrs:
+            for c in nbrs:
+                if a != c:
+                    tuples.append((a, atom.GetIdx(), c))
+    return tuples
+
+def mol_torsions(mol):
+    """
+    Return the (a,b,c,d) atom index tuples of all torsions of 'mol', in both directions
+    """
+    nbrs = {}
+    for atom in openbabel.OBMolAtomIter(mol):
+        nbrs[atom.GetIdx()] = [nbr.GetIdx() for nbr in openbabel.OBAtomAtomIter(atom)]
+    tuples = []
+    for (b, c) in mol_bonds(mol):
+        for a in nbrs[b]:
+            for d in nbrs[c]:
+                if a != c and d != b and a != d:
+                    tuples.append((a, b, c, d))
+    return tuples
+
 class Valence:
     def __init__(self,output_format):
-        self.sp = openbabel.OBSmartsPattern()
         #for tinker4 format, set o_f to 4, for tinker5 format, set o_f to 5
         self.o_f = output_format
         self.missed_torsions = []
+        # matches of each SMARTS string in 'matchmol' (see match)
+        self.matchmol = None
+        self.matchcache = {}
+        self.matchsummary = None
+        # only parse the SMARTS patterns (see parse_patterns)
+        self.parseonly = False
+
+    def match(self, mol, smarts):
+        """
+        Return the atom index tuples of all matches of 'smarts' in 'mol'.
+        The matches are kept for the last molecule, so a pattern used by several
+        *guess methods is matched only once. Patterns that need elements the
+        molecule does not have (see smarts_can_match) are not matched at all.
+        """
+        if self.parseonly:
+            with smartslock:
+                get_smarts_pattern(smarts)
+            return []
+        if mol is not self.matchmol:
+            self.matchmol = mol
+            self.matchcache = {}
+            self.matchsummary = mol_atom_summary(mol)
+        maplist = self.matchcache.get(smarts)
+        if maplist is None and not smarts_can_match(smarts, self.matchsummary):
+            maplist = []
+            self.matchcache[smarts] = maplist
+        if maplist is None:
+            with smartslock:
+                sp = get_smarts_pattern(smarts)
+                sp.Match(mol)
+                maplist = [tuple(ia) for ia in sp.GetMapList()]
+            self.matchcache[smarts] = maplist
+        return maplist
+
+    def parse_patterns(self):
+        """
+        Parse the SMARTS patterns of all *guess methods without matching them, so that
+        processes forked afterwards (e.g. by the poltype batch mode) share them
+        """
+        mol = openbabel.OBMol()
+        self.setidxtoclass([])
+        self.parseonly = True
+        try:
+            self.vdwguess(mol)
+            self.bondguess(mol)
+            self.angguess(mol)
+            self.sbguess(mol)
+            self.torguess(mol, True, [])
+            self.pitorguess(mol)
+        finally:
+            self.parseonly = False
+
+    def first_matches(self, mol, vals, keyof, positions, universe):
+        """
+        Find the match that sets the parameter of each key.
+        'vals' is a list of SMARTS -> value dicts from generic to specific, and a later
+        match overrides an earlier one with the same key. The matches are visited in
+        reverse, so the first one seen for a key is the one that would be written last
+        and the remaining matches of that key are skipped. Once every key in 'universe'
+        is set, patterns whose mapped atoms form a chain (see smarts_is_chain), and so
+        can only give keys in 'universe', are not matched at all.
+        Input:
+            keyof: function of the mapped atom indices of a match; returns its key, or
+                   None if the match is not used
+            positions: function (v, skey); returns the positions of the mapped atoms in a match
+            universe: keys of all bonds, angles, ... of 'mol'
+        Output:
+            winners: dict key -> (v, skey, mapped atom indices)
+        """
+        winners = {}
+        remaining = set(universe)
+        for v in reversed(vals):
+            for skey in reversed(list(v)):
+                pos = positions(v, skey)
+                if not remaining and not self.parseonly and smarts_is_chain(skey, pos):
+                    continue
+                for ia in reversed(self.match(mol, skey)):
+                    atoms = tuple([ia[p] for p in pos])
+                    key = keyof(atoms)
+                    if key is None or key in winners:
+                        continue
+                    winners[key] = (v, skey, atoms)
+                    remaining.discard(key)
+        return winners
 
     def setidxtoclass(self, symmclass):
         self.idxtoclass = symmclass
@@ -449,31 +855,32 @@ class Valence:
         vals.append(vdwparamvals3)
         vals.append(vdwparamvals2)
         vals.append(vdwparamvals1)
-        d = dict()
-        for v in vals:
-            for skey in iter(v):
-                openbabel.OBSmartsPattern.Init(self.sp,skey)
-                self.sp.Match(mol)
-                for ia in self.sp.GetMapList():
-                    #key1 = '%d ' % idxtoclass.get(ia[0])
-                    key1 = self.idxtoclass[ia[0] - 1]
-                    if(len(v[skey]) == 3):
-                        key2 = 'vdw%10d%8.4f%9.4f%6.3f' % (key1, v[skey][0], v[skey][1], v[skey][2])
-                    else:
-                        key2 = 'vdw%10d%8.4f%9.4f' % (key1, v[skey][0], v[skey][1])
-                    d.update({key1 : key2})
-                    #if key1 not in found:
-                        #found.append(key1)
-                        #if(v[skey][2] != dfltred):
-                            #key2 = "vdw\t\t" + key1 + "\t\t\t" + '%f %f %f' % (v[skey][0], v[skey][1], v[skey][2])
-                            #key2 = 'vdw%10d%8.3f%9.3f%6.2f' % (key1, v[skey][0], v[skey][1], v[skey][2])
-                        #else:
-                            #key2 = "vdw\t\t" + key1 + "\t\t\t" + '%f %f' % (v[skey][0], v[skey][1])
-                            #print "lol"
-                        #addToOutString(key2)
+        classes = []
+        for atom in openbabel.OBMolAtomIter(mol):
+            if self.idxtoclass[atom.GetIdx() - 1] not in classes:
+                classes.append(self.idxtoclass[atom.GetIdx() - 1])
+        winners = self.first_matches(mol, vals, lambda atoms: self.idxtoclass[atoms[0] - 1],
+            lambda v, skey: [0], classes)
+        # '*' matches every atom first, so the parameters are listed in atom order
         x = []
-        for v in iter(d.values()):
-            x.append(v)
+        for key1 in classes:
+            if key1 not in winners:
+                continue
+            (v, skey, ia) = winners[key1]
+            if(len(v[skey]) == 3):
+                key2 = 'vdw%10d%8.4f%9.4f%6.3f' % (key1, v[skey][0], v[skey][1], v[skey][2])
+            else:
+                key2 = 'vdw%10d%8.4f%9.4f' % (key1, v[skey][0], v[skey][1])
+            x.append(key2)
+            #if key1 not in found:
+                #found.append(key1)
+                #if(v[skey][2] != dfltred):
+                    #key2 = "vdw\t\t" + key1 + "\t\t\t" + '%f %f %f' % (v[skey][0], v[skey][1], v[skey][2])
+                    #key2 = 'vdw%10d%8.3f%9.3f%6.2f' % (key1, v[skey][0], v[skey][1], v[skey][2])
+                #else:
+                    #key2 = "vdw\t\t" + key1 + "\t\t\t" + '%f %f' % (v[skey][0], v[skey][1])
+                    #print "lol"
+                #addToOutString(key2)
         return x
 
     def bondguess(self, mol):
@@ -856,22 +1263,17 @@ class Valence:
         vals.append(bondparamvals3)
         vals.append(bondparamvals2)
         vals.append(bondparamvals1)
+        winners = self.first_matches(mol, vals, self.bondkey, lambda v, skey: [0, 1],
+            [self.bondkey(atoms) for atoms in mol_bonds(mol)])
         d = dict()
-        for v in vals:
-            for skey in iter(v):
-                openbabel.OBSmartsPattern.Init(self.sp,skey)
-                self.sp.Match(mol)
-                for ia in self.sp.GetMapList():
-                    sortedlist = [self.idxtoclass[ia[0] - 1], self.idxtoclass[ia[1] - 1]]
-                    sortedlist.sort()
-                    key1 = sortedlist
-                    key1string = '%d %d ' % (key1[0], key1[1])
+        for (key1string, (v, skey, ia)) in winners.items():
+            key1 = [int(k) for k in key1string.split()]
 #                    if(len(v[skey]) == 2):
-                    blen = mol.GetBond(ia[0],ia[1]).GetLength()
-                    key2 = 'bond%9d%6d%11.4f%10.4f' % (key1[0], key1[1], v[skey][0], blen)
+            blen = mol.GetBond(ia[0],ia[1]).GetLength()
+            key2 = 'bond%9d%6d%11.4f%10.4f' % (key1[0], key1[1], v[skey][0], blen)
 #                    else:
 #                        key2 = '#bond%10s%10.6f %s' % (key1string,v[skey][0],"error, parameter not found in amoeba parameters, resorted to tinker's analyze.x parameters")
-                    d.update({key1string : key2})
+            d.update({key1string : key2})
         x = []
         for v in iter(d.values()): 
             x.append(v)
@@ -1423,23 +1825,18 @@ class Valence:
         vals.append(angparamvals2)
         vals.append(angparamvals1)
 
+        anglekey = lambda atoms: self.anglekey(mol, atoms)
+        winners = self.first_matches(mol, vals, anglekey, lambda v, skey: [0, 1, 2],
+            set([anglekey(atoms) for atoms in mol_angles(mol)]) - set([None]))
         d = dict()
-        for v in vals:
-            for skey in iter(v):
-                openbabel.OBSmartsPattern.Init(self.sp,skey)
-                self.sp.Match(mol)
-                for ia in self.sp.GetMapList():
-                    sortedlist = [self.idxtoclass[ia[0] - 1], self.idxtoclass[ia[1] - 1], self.idxtoclass[ia[2] - 1]]
-                    if(mol.GetAtom(ia[0]).GetAtomicNum() > mol.GetAtom(ia[2]).GetAtomicNum()):
-                        continue
-                    key1 = self.sortfirstlast(sortedlist)
-                    a = mol.GetAtom(ia[0])
-                    b = mol.GetAtom(ia[1])
-                    c = mol.GetAtom(ia[2])
-                    angle = mol.GetAngle(a,b,c)
-                    key2 = 'angle%8d%6d%6d%11.4f%10.4f' % (key1[0], key1[1], key1[2], v[skey][0], angle)
-                    key1string = '%d %d %d' % (key1[0], key1[1], key1[2])
-                    d.update({key1string : key2})
+        for (key1string, (v, skey, ia)) in winners.items():
+            key1 = [int(k) for k in key1string.split()]
+            a = mol.GetAtom(ia[0])
+            b = mol.GetAtom(ia[1])
+            c = mol.GetAtom(ia[2])
+            angle = mol.GetAngle(a,b,c)
+            key2 = 'angle%8d%6d%6d%11.4f%10.4f' % (key1[0], key1[1], key1[2], v[skey][0], angle)
+            d.update({key1string : key2})
         x = []
         sortedtuple = sorted(iter(d.items()),
             key=lambda k_v1: (k_v1[0].split()[1],k_v1[0].split()[0],k_v1[0].split()[2]))
@@ -1844,21 +2241,16 @@ class Valence:
         vals.append(sbparamvals2)
         vals.append(sbparamvals1)
 
+        anglekey = lambda atoms: self.anglekey(mol, atoms)
+        winners = self.first_matches(mol, vals, anglekey, lambda v, skey: [0, 1, 2],
+            set([anglekey(atoms) for atoms in mol_angles(mol)]) - set([None]))
         d = dict()
-        for v in vals:
-            for skey in iter(v):
-                openbabel.OBSmartsPattern.Init(self.sp,skey)
-                self.sp.Match(mol)
-                for ia in self.sp.GetMapList():
-                    sortedlist = [self.idxtoclass[ia[0] - 1], self.idxtoclass[ia[1] - 1], self.idxtoclass[ia[2] - 1]]
-                    if(mol.GetAtom(ia[0]).GetAtomicNum() > mol.GetAtom(ia[2]).GetAtomicNum()):
-                        continue
-                    key1 = self.sortfirstlast(sortedlist)
-                    key2 = 'strbnd%7d%6d%6d%11.4f%10.4f' % (key1[0], key1[1], key1[2], v[skey][0], v[skey][1])
-                    key1string = '%d %d %d' % (key1[0], key1[1], key1[2])
-                    d.update({key1string : key2})
-                    if(v[skey][0] == 0 and v[skey][1] == 0):
-                        del d[key1string]
+        for (key1string, (v, skey, ia)) in winners.items():
+            key1 = [int(k) for k in key1string.split()]
+            key2 = 'strbnd%7d%6d%6d%11.4f%10.4f' % (key1[0], key1[1], key1[2], v[skey][0], v[skey][1])
+            if(v[skey][0] == 0 and v[skey][1] == 0):
+                continue
+            d.update({key1string : key2})
         x = []
         sortedtuple = sorted(iter(d.items()),
             key=lambda k_v2: (k_v2[0].split()[1],k_v2[0].split()[0],k_v2[0].split()[2]))
@@ -2403,46 +2795,36 @@ class Valence:
         vals.append(torvals5)
         vals.append(torparamvals1)
         torsunit = .5
+        torpositions = lambda v, skey: [p - 1 for p in v[skey][0:4]] if len(v[skey]) == 7 else [0, 1, 2, 3]
+        winners = self.first_matches(mol, vals, self.torsionkey, torpositions,
+            [self.torsionkey(atoms) for atoms in mol_torsions(mol)])
         d = dict()
-        zeroed = False
-        for v in vals:
-            for skey in iter(v):
-                openbabel.OBSmartsPattern.Init(self.sp,skey)
-                self.sp.Match(mol)
-                for ia in self.sp.GetMapList():
-                    if(len(v[skey]) == 7):
-                        sortedlist = [self.idxtoclass[ia[v[skey][0] - 1] - 1], self.idxtoclass[ia[v[skey][1] - 1] - 1], self.idxtoclass[ia[v[skey][2] - 1] - 1], \
-                        self.idxtoclass[ia[v[skey][3] - 1] - 1]]
-                    else:
-                        sortedlist = [self.idxtoclass[ia[0] - 1], self.idxtoclass[ia[1] - 1], self.idxtoclass[ia[2] - 1], self.idxtoclass[ia[3] - 1]]
-                    key1 = self.sorttorsion(sortedlist)
-                    if(dorot):
-                        for r in rotbnds:
-                            sortr = self.sorttorsion([self.idxtoclass[r[0] - 1],self.idxtoclass[r[1] - 1],self.idxtoclass[r[2] - 1],self.idxtoclass[r[3] - 1]])
-                            if(key1 == sortr):
-                                zeroed = True
-                                break
-                    if(len(v[skey]) == 7):
-                        if(zeroed):
-                            key2 = 'torsion%6d%6d%6d%6d%11.4f 0.0 1 %10.4f 180.0 2 %10.4f 0.0 3' % (key1[0], key1[1], key1[2], key1[3], 0.0, 0.0, 0.0)
-                        else:
-                            key2 = 'torsion%6d%6d%6d%6d%11.4f 0.0 1 %10.4f 180.0 2 %10.4f 0.0 3' % (key1[0], key1[1], key1[2], key1[3], .5*v[skey][4]/torsunit, .5*v[skey][5]/torsunit, .5*v[skey][6]/torsunit)
-                    else:
-                        if(zeroed):
-                            key2 = 'torsion%6d%6d%6d%6d%11.4f 0.0 1 %10.4f 180.0 2 %10.4f 0.0 3' % (key1[0], key1[1], key1[2], key1[3], 0.0, 0.0, 0.0)
-                        else:
-                            key2 = 'torsion%6d%6d%6d%6d%11.4f 0.0 1 %10.4f 180.0 2 %10.4f 0.0 3' % (key1[0], key1[1], key1[2], key1[3], v[skey][0]/torsunit, v[skey][1]/torsunit, v[skey][2]/torsunit)
-                    key1string = '%d %d %d %d' % (key1[0], key1[1], key1[2], key1[3])
-                    d.update({key1string : key2})
-                    zeroed = False
-        x = []
-        for v in iter(d.values()): 
-            x.append(v)
-            if(float(v.split()[5]) == 0.0 and float(v.split()[8]) == 0.0 and float(v.split()[11]) == 0.0): self.missed_torsions.append([int(v.split()[1]),int(v.split()[2]),int(v.split()[3]),int(v.split()[4])])
+        for (key1string, (v, skey, ia)) in winners.items():
+            key1 = [int(k) for k in key1string.split()]
+            zeroed = False
+            if(dorot):
+                for r in rotbnds:
+                    sortr = self.sorttorsion([self.idxtoclass[r[0] - 1],self.idxtoclass[r[1] - 1],self.idxtoclass[r[2] - 1],self.idxtoclass[r[3] - 1]])
+                    if(key1 == sortr):
+                        zeroed = True
+                        break
+            if(len(v[skey]) == 7):
+                if(zeroed):
+                    key2 = 'torsion%6d%6d%6d%6d%11.4f 0.0 1 %10.4f 180.0 2 %10.4f 0.0 3' % (key1[0], key1[1], key1[2], key1[3], 0.0, 0.0, 0.0)
+                else:
+                    key2 = 'torsion%6d%6d%6d%6d%11.4f 0.0 1 %10.4f 180.0 2 %10.4f 0.0 3' % (key1[0], key1[1], key1[2], key1[3], .5*v[skey][4]/torsunit, .5*v[skey][5]/torsunit, .5*v[skey][6]/torsunit)
+            else:
+                if(zeroed):
+                    key2 = 'torsion%6d%6d%6d%6d%11.4f 0.0 1 %10.4f 180.0 2 %10.4f 0.0 3' % (key1[0], key1[1], key1[2], key1[3], 0.0, 0.0, 0.0)
+                else:
+                    key2 = 'torsion%6d%6d%6d%6d%11.4f 0.0 1 %10.4f 180.0 2 %10.4f 0.0 3' % (key1[0], key1[1], key1[2], key1[3], v[skey][0]/torsunit, v[skey][1]/torsunit, v[skey][2]/torsunit)
+            d.update({key1string : key2})
         sortedtuple = sorted(iter(d.items()),
             key=lambda k_v3: (k_v3[0].split()[1],k_v3[0].split()[2],
                                 k_v3[0].split()[0],k_v3[0].split()[3]))
         x = [ t[1] for t in sortedtuple ]
+        for v in x:
+            if(float(v.split()[5]) == 0.0 and float(v.split()[8]) == 0.0 and float(v.split()[11]) == 0.0): self.missed_torsions.append([int(v.split()[1]),int(v.split()[2]),int(v.split()[3]),int(v.split()[4])])
         return x
 
     def opbguess(self, opbendvals):
@@ -2477,18 +2859,14 @@ class Valence:
         'cc' : [1, 2, 6.85] \
         })
         vals.append(pitorvals)
+        winners = self.first_matches(mol, vals, self.bondkey,
+            lambda v, skey: [v[skey][0] - 1, v[skey][1] - 1],
+            [self.bondkey(atoms) for atoms in mol_bonds(mol)])
         d = dict()
-        for v in vals:
-            for skey in iter(v):
-                openbabel.OBSmartsPattern.Init(self.sp,skey)
-                self.sp.Match(mol)
-                for ia in self.sp.GetMapList():
-                    sortedlist = [self.idxtoclass[ia[v[skey][0] - 1] - 1], self.idxtoclass[ia[v[skey][1] - 1] - 1]]
-                    sortedlist.sort()
-                    key1 = sortedlist
-                    key1string = '%d %d ' % (key1[0], key1[1])
-                    key2 = 'pitors%7d%6d%11.4f' % (key1[0], key1[1], v[skey][2])
-                    d.update({key1string : key2})
+        for (key1string, (v, skey, ia)) in winners.items():
+            key1 = [int(k) for k in key1string.split()]
+            key2 = 'pitors%7d%6d%11.4f' % (key1[0], key1[1], v[skey][2])
+            d.update({key1string : key2})
         x = []
         for v in iter(d.values()): 
             x.append(v)
@@ -2533,23 +2911,58 @@ class Valence:
 
     def appendtofile(self, vf, mol, opbendvals,dorot,rotbnds):
         f = open(vf, 'a')
+        f.writelines(self.guesslines(mol, opbendvals, dorot, rotbnds))
+        f.close()
+
+    def guesslines(self, mol, opbendvals,dorot,rotbnds):
+        """
+        Return the guessed vdw, bond, angle, strbnd, opbend, torsion and pitors
+        terms as key file lines (with newlines)
+        """
+        lines = []
         for x in self.vdwguess(mol):
-            f.write(x + "\n")
+            lines.append(x + "\n")
         for x in self.bondguess(mol):
-            f.write(x + "\n")
+            lines.append(x + "\n")
         for x in self.angguess(mol):
-            f.write(x + "\n")
+            lines.append(x + "\n")
         for x in self.sbguess(mol):
-            f.write(x + "\n")
+            lines.append(x + "\n")
         #for (opbkey, opbval) in opbendvals:
         #    f.write('opbend %s %.5f %d\n' % (opbkey, opbval[0], opbval[1]))
         for x in self.opbguess(opbendvals):
-            f.write(x + "\n")
+            lines.append(x + "\n")
         for x in self.torguess(mol,dorot,rotbnds):
-            f.write(x + "\n")
+            lines.append(x + "\n")
         for x in self.pitorguess(mol):
-            f.write(x+ "\n")
-        f.close()
+            lines.append(x+ "\n")
+        return lines
+
+    def bondkey(self, atoms):
+        """
+        Return the class key of the bond between atom indices atoms[0], atoms[1]
+        """
+        key1 = [self.idxtoclass[atoms[0] - 1], self.idxtoclass[atoms[1] - 1]]
+        key1.sort()
+        return '%d %d ' % (key1[0], key1[1])
+
+    def anglekey(self, mol, atoms):
+        """
+        Return the class key of the angle atoms[0]-atoms[1]-atoms[2], or None for the
+        direction that starts at the heavier end atom
+        """
+        if(mol.GetAtom(atoms[0]).GetAtomicNum() > mol.GetAtom(atoms[2]).GetAtomicNum()):
+            return None
+        key1 = self.sortfirstlast([self.idxtoclass[atoms[0] - 1], self.idxtoclass[atoms[1] - 1], self.idxtoclass[atoms[2] - 1]])
+        return '%d %d %d' % (key1[0], key1[1], key1[2])
+
+    def torsionkey(self, atoms):
+        """
+        Return the class key of the torsion atoms[0]-atoms[1]-atoms[2]-atoms[3]
+        """
+        key1 = self.sorttorsion([self.idxtoclass[atoms[0] - 1], self.idxtoclass[atoms[1] - 1], \
+            self.idxtoclass[atoms[2] - 1], self.idxtoclass[atoms[3] - 1]])
+        return '%d %d %d %d' % (key1[0], key1[1], key1[2], key1[3])
 
     def sortfirstlast(self, keylist):
         size = len(keylist)